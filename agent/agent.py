@@ -55,7 +55,14 @@ class Agent:
                 model_name=config["GEMINI_MODEL"],
             )
             print(f"[agent] Backend: Gemini — {config['GEMINI_MODEL']}")
-        self.controller = AndroidController(serial=config["DEVICE_SERIAL"])
+        self.controller = AndroidController(
+            serial=config["DEVICE_SERIAL"],
+            screencap_mode=config.get("SCREENCAP_MODE", "png"),
+            screencap_downsample=config.get("SCREENCAP_DOWNSAMPLE", 1),
+            hierarchy_mode=config.get("HIERARCHY_MODE", "stream"),
+            concurrent_capture=config.get("CONCURRENT_CAPTURE", True),
+        )
+        self.save_hierarchy_xml = config.get("SAVE_HIERARCHY_XML", False)
         self.output_dir = config["OUTPUT_DIR"]
         self.max_steps = config.get("MAX_STEPS", 20)
         self.screen_w, self.screen_h = self.controller.screen_size()
@@ -278,13 +285,21 @@ class Agent:
                 print(f"[step {step + 1}] Grid mode: {rows}r x {cols}c")
             else:
                 labeled_path = os.path.join(screenshot_dir, f"step_{step:03d}_labeled.png")
-                xml_path = os.path.join(screenshot_dir, f"step_{step:03d}.xml")
+                xml_path = (os.path.join(screenshot_dir, f"step_{step:03d}.xml")
+                            if self.save_hierarchy_xml else None)
                 labeled_path, elem_list, t_adb, t_hierarchy, t_label = (
                     self.controller.screenshot_with_elements(labeled_path, xml_path)
                 )
+                # with concurrent capture only the part of the dump that outlasted
+                # screencap adds to the step (hierarchy_s in the latency record has all of it)
+                if self.controller.concurrent_capture:
+                    t_hierarchy = max(self.controller.last_capture["observe_s"] - t_adb, 0.0)
                 t_preprocess = t_hierarchy + t_label
                 image_path = labeled_path
                 print(f"[step {step + 1}] Element mode: {len(elem_list)} elements")
+                if not self.controller.last_capture["capture_consistent"]:
+                    print(f"[step {step + 1}] Screenshot and hierarchy finished "
+                          f"{self.controller.last_capture['capture_skew_s']:.2f}s apart; labels may be off")
 
             # ── Screen-change detection ────────────────────────────────
             curr_screenshot = Image.open(image_path).convert("RGB")
@@ -318,6 +333,7 @@ class Agent:
                     "n_elements": len(elem_list),
                     "latency": {
                         "adb_s": round(t_adb, 3),
+                        **self.controller.last_capture,
                         "preprocess_s": round(t_preprocess, 3),
                         "inference_s": 0,
                         "step_total_s": round(time.perf_counter() - step_start, 3),
@@ -377,6 +393,8 @@ class Agent:
             print(
                 f"[step {step + 1}] Latency "
                 f"adb={t_adb:.2f}s  "
+                f"decode={self.controller.last_capture.get('screencap_decode_s', 0):.3f}s "
+                f"({self.controller.screencap_mode})  "
                 f"preprocess={t_preprocess:.2f}s  "
                 f"inference={t_inference:.2f}s  "
                 f"step_total={t_step:.2f}s"
@@ -394,6 +412,7 @@ class Agent:
                 "stall_count": stall_count,
                 "latency": {
                     "adb_s":         round(t_adb, 3),
+                    **self.controller.last_capture,
                     "preprocess_s":  round(t_preprocess, 3),
                     "inference_s":   round(t_inference, 3),
                     "step_total_s":  round(t_step, 3),
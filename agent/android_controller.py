@@ -1,15 +1,34 @@
 from __future__ import annotations
 import os
 import io
+import queue
+import subprocess
+import threading
 import time
-import xml.etree.ElementTree as ET
+import uuid
+from xml.parsers import expat
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+
+import numpy as np
 from ppadb.client import Client as AdbClient
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
+
+from . import overlay, trace
 
 MIN_DIST = 30
 
-@dataclass
+SCREENCAP_MODES = ("png", "raw")
+# android.graphics.PixelFormat codes `screencap` (no -p) can emit -> PIL raw mode
+# that unpacks them to RGB (RGBA_8888, RGBX_8888, BGRA_8888; alpha is dropped)
+_RAW_FORMATS = {1: "RGBX", 2: "RGBX", 5: "BGRX"}
+
+HIERARCHY_MODES = ("stream", "sdcard")
+# node flags _parse_hierarchy collects; parse_ui_elements merges the first two
+HIERARCHY_ATTRIBS = ("clickable", "focusable", "scrollable")
+
+@dataclass(slots=True)
 class UIElement:
     """One interactive element extracted from a uiautomator XML dump."""
     uid: str                        # resource-id or synthetic id
@@ -20,81 +39,303 @@ class UIElement:
     content_desc: str = ""         # content-description
 
 
-def _get_id_from_element(elem) -> str:
-    bounds = elem.attrib["bounds"][1:-1].split("][")
+class ElementStore(Sequence):
+    """
+    Kept UI elements in insertion order (label i is `store[i - 1]`), indexed two ways:
+
+    - centers are hashed into MIN_DIST-sized grid cells, so the "is anything within
+      MIN_DIST already kept" check looks at 9 cells instead of every element;
+    - bboxes are stacked into one numpy array on demand for point hit tests.
+    """
+
+    def __init__(self, elements=(), min_dist: float = MIN_DIST):
+        self.min_dist = min_dist
+        self._elements: list[UIElement] = []
+        self._cells: dict[tuple[int, int], list[UIElement]] = {}
+        self._boxes: np.ndarray | None = None
+        for elem in elements:
+            self.add(elem)
+
+    def __len__(self) -> int:
+        return len(self._elements)
+
+    def __getitem__(self, index):
+        return self._elements[index]
+
+    def __iter__(self):
+        return iter(self._elements)
+
+    def __repr__(self) -> str:
+        return f"ElementStore({self._elements!r})"
+
+    def _cell(self, x: int, y: int) -> tuple[int, int]:
+        return int(x // self.min_dist), int(y // self.min_dist)
+
+    def near(self, x: int, y: int) -> bool:
+        """True if a kept element's center is within min_dist of (x, y)."""
+        cx, cy = self._cell(x, y)
+        limit = self.min_dist ** 2
+        for gx in (cx - 1, cx, cx + 1):
+            for gy in (cy - 1, cy, cy + 1):
+                for e in self._cells.get((gx, gy), ()):
+                    if (e.center[0] - x) ** 2 + (e.center[1] - y) ** 2 <= limit:
+                        return True
+        return False
+
+    def add(self, elem: UIElement) -> bool:
+        """Keep *elem* unless it is within min_dist of a kept one; returns whether it was kept."""
+        if self.near(*elem.center):
+            return False
+        self._elements.append(elem)
+        self._cells.setdefault(self._cell(*elem.center), []).append(elem)
+        self._boxes = None
+        return True
+
+    def hit(self, x: int, y: int) -> int | None:
+        """Label (1-based index) of the smallest element whose bbox contains (x, y), or None."""
+        if not self._elements:
+            return None
+        if self._boxes is None:
+            boxes = np.array([(x1, y1, x2, y2) for (x1, y1), (x2, y2) in (e.bbox for e in self._elements)])
+            # uiautomator can return inverted coords
+            self._boxes = np.concatenate([np.minimum(boxes[:, :2], boxes[:, 2:]),
+                                          np.maximum(boxes[:, :2], boxes[:, 2:])], axis=1)
+        b = self._boxes
+        inside = np.flatnonzero((b[:, 0] <= x) & (x <= b[:, 2]) & (b[:, 1] <= y) & (y <= b[:, 3]))
+        if not inside.size:
+            return None
+        areas = (b[inside, 2] - b[inside, 0]) * (b[inside, 3] - b[inside, 1])
+        return int(inside[np.argmin(areas)]) + 1
+
+
+def _get_id_from_element(attrib: dict) -> str:
+    bounds = attrib["bounds"][1:-1].split("][")
     x1, y1 = map(int, bounds[0].split(","))
     x2, y2 = map(int, bounds[1].split(","))
     elem_w, elem_h = x2 - x1, y2 - y1
 
-    if elem.attrib.get("resource-id"):
-        elem_id = elem.attrib["resource-id"].replace(":", ".").replace("/", "_")
+    if attrib.get("resource-id"):
+        elem_id = attrib["resource-id"].replace(":", ".").replace("/", "_")
     else:
-        elem_id = f"{elem.attrib.get('class', 'View')}_{elem_w}_{elem_h}"
+        elem_id = f"{attrib.get('class', 'View')}_{elem_w}_{elem_h}"
 
-    cd = elem.attrib.get("content-desc", "")
+    cd = attrib.get("content-desc", "")
     if cd and len(cd) < 20:
         elem_id += f"_{cd.replace('/', '_').replace(' ', '').replace(':', '_')}"
     return elem_id
 
 
-def _traverse_tree(xml_path: str, attrib: str, add_index: bool = True) -> list[UIElement]:
+def _parse_hierarchy(
+    xml: str | bytes, attribs: tuple[str, ...] = HIERARCHY_ATTRIBS, add_index: bool = True,
+) -> dict[str, ElementStore]:
     """
-    Parse a uiautomator XML dump and return clickable elements
-    """
-    elem_list: list[UIElement] = []
-    path_stack = []
-    for event, elem in ET.iterparse(xml_path, ["start", "end"]):
-        if event == "start":
-            path_stack.append(elem)
-            if elem.attrib.get(attrib) != "true":
-                continue
-            try:
-                bounds = elem.attrib["bounds"][1:-1].split("][")
-                x1, y1 = map(int, bounds[0].split(","))
-                x2, y2 = map(int, bounds[1].split(","))
-            except (KeyError, ValueError):
-                continue
-            cx, cy = (x1 + x2) // 2, (y1 + y2) // 2
+    One streaming expat pass over a uiautomator XML dump (a file path, or the XML
+    itself as bytes) that sorts every node flagged with one of *attribs* into that
+    attribute's ElementStore (MIN_DIST-deduplicated within each bucket).
 
+    Only the open ancestors are held, each with its id computed at most once, so
+    memory is bounded by tree depth rather than node count.
+    """
+    buckets = {attrib: ElementStore() for attrib in attribs}
+    # one [attributes, memoized id] per open node
+    stack: list[list] = []
+
+    def node_id(entry: list) -> str:
+        if entry[1] is None:
+            entry[1] = _get_id_from_element(entry[0])
+        return entry[1]
+
+    def start(tag: str, attrib: dict) -> None:
+        entry = [attrib, None]
+        stack.append(entry)
+        flagged = [a for a in attribs if attrib.get(a) == "true"]
+        if not flagged:
+            return
+        try:
+            bounds = attrib["bounds"][1:-1].split("][")
+            x1, y1 = map(int, bounds[0].split(","))
+            x2, y2 = map(int, bounds[1].split(","))
+        except (KeyError, ValueError):
+            return
+        cx, cy = (x1 + x2) // 2, (y1 + y2) // 2
+
+        uid = None
+        for a in flagged:
             # skip if too close to an existing element
-            close = False
-            for e in elem_list:
-                ecx, ecy = e.center
-                dist = ((cx - ecx) ** 2 + (cy - ecy) ** 2) ** 0.5
-                if dist <= MIN_DIST:
-                    close = True
-                    break
-            if close:
+            if buckets[a].near(cx, cy):
                 continue
-
-            uid = _get_id_from_element(elem)
-            if add_index:
-                uid += f"_{elem.attrib.get('index', '0')}"
-            # parent prefix
-            if len(path_stack) > 1:
-                uid = _get_id_from_element(path_stack[-2]) + "_" + uid
-
-            elem_list.append(UIElement(
+            if uid is None:
+                uid = node_id(entry)
+                if add_index:
+                    uid += f"_{attrib.get('index', '0')}"
+                # parent prefix (the <hierarchy> root has no bounds, hence no id)
+                if len(stack) > 1 and "bounds" in stack[-2][0]:
+                    uid = node_id(stack[-2]) + "_" + uid
+            buckets[a].add(UIElement(
                 uid=uid,
                 bbox=((x1, y1), (x2, y2)),
                 center=(cx, cy),
-                attrib=attrib,
-                text=elem.attrib.get("text", ""),
-                content_desc=elem.attrib.get("content-desc", ""),
+                attrib=a,
+                text=attrib.get("text", ""),
+                content_desc=attrib.get("content-desc", ""),
             ))
-        elif event == "end":
-            if path_stack:
-                path_stack.pop()
-    return elem_list
+
+    def end(tag: str) -> None:
+        stack.pop()
+
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    if isinstance(xml, bytes):
+        parser.Parse(xml, True)
+    else:
+        with open(xml, "rb") as f:
+            parser.ParseFile(f)
+    return buckets
+
+
+class AdbShellSession:
+    """
+    One long-lived `adb shell` process that commands are written to, instead of a
+    new `adb shell <cmd>` subprocess (process start + adb server handshake) each time.
+
+    Each command is followed by an `echo <sentinel> $?` so its completion and exit
+    status can be read back; a command that misses its timeout kills the session
+    (its state is unknown) and the next `run` starts a fresh one.
+    """
+
+    def __init__(self, adb_path: str = "adb", serial: str | None = None):
+        self._argv = [adb_path] + (["-s", serial] if serial else []) + ["shell"]
+        self._proc: subprocess.Popen | None = None
+        self._lines: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+
+    def _start(self) -> None:
+        self._proc = subprocess.Popen(
+            self._argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            text=True, bufsize=1,
+        )
+        self._lines = queue.Queue()
+        threading.Thread(target=self._read, args=(self._proc, self._lines),
+                         name="adb_shell_reader", daemon=True).start()
+
+    @staticmethod
+    def _read(proc: subprocess.Popen, lines: queue.Queue) -> None:
+        for line in proc.stdout:
+            lines.put(line)
+        lines.put(None)  # EOF: the shell (or adb) exited
+
+    def _alive(self) -> bool:
+        return self._proc is not None and self._proc.poll() is None
+
+    def run(self, *args: str, timeout: float = 5) -> subprocess.CompletedProcess:
+        """Run `args` (joined by spaces, as `adb shell a b c` does) and wait for it to finish."""
+        command = " ".join(args)
+        with self._lock:
+            for attempt in range(2):
+                if not self._alive():
+                    self._start()
+                marker = f"__adb_done_{uuid.uuid4().hex}__"
+                try:
+                    # stdin is the command stream: keep the command from reading it
+                    self._proc.stdin.write(f"{command} </dev/null\necho {marker} $?\n")
+                    self._proc.stdin.flush()
+                except BrokenPipeError:
+                    # the session died while idle (emulator restart, adb reconnect): the command
+                    # was never sent, so it is safe to send it again on a new one
+                    self.close()
+                    if attempt:
+                        raise
+                    continue
+                return self._wait(command, marker, timeout)
+
+    def _wait(self, command: str, marker: str, timeout: float) -> subprocess.CompletedProcess:
+        deadline = time.monotonic() + timeout
+        output = []
+        while True:
+            try:
+                line = self._lines.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                self.close()
+                raise subprocess.TimeoutExpired(command, timeout, output="".join(output))
+            if line is None:
+                # not retried: the command may already have been applied
+                self.close()
+                raise EOFError(f"adb shell exited while running {command!r}")
+            if line.startswith(marker):
+                code = line[len(marker):].strip()
+                return subprocess.CompletedProcess(command, int(code) if code.lstrip("-").isdigit() else -1,
+                                                   stdout="".join(output))
+            output.append(line)
+
+    def close(self) -> None:
+        if self._proc is not None:
+            try:
+                self._proc.kill()
+                self._proc.wait(timeout=2)
+            except Exception:
+                pass
+            self._proc = None
+
+
+def decode_raw_screencap(data: bytes, downsample: int = 1) -> Image.Image:
+    """
+    Parse `screencap` raw output (u32 width, height, pixel format[, colorspace on
+    Android 9+], then width*height*4 pixel bytes) into an RGB image.
+
+    Pixels are viewed in place as one uint32 per pixel: `downsample` keeps every n-th
+    row/column of that view, so skipped pixels are never copied, and PIL's raw unpacker
+    drops the 4th channel in C (a numpy [..., :3] slice is ~5x slower for a full frame).
+    """
+    if len(data) < 12:
+        raise ValueError(f"raw screencap too short ({len(data)} bytes)")
+    width, height, fmt = (int(v) for v in np.frombuffer(data, dtype="<u4", count=3))
+    header = len(data) - width * height * 4
+    if header not in (12, 16):
+        raise ValueError(f"raw screencap size mismatch: {len(data)} bytes for {width}x{height}")
+    if fmt not in _RAW_FORMATS:
+        raise ValueError(f"unsupported raw screencap pixel format {fmt}")
+    pixels = np.frombuffer(data, dtype=np.uint32, offset=header).reshape(height, width)
+    if downsample > 1:
+        pixels = np.ascontiguousarray(pixels[::downsample, ::downsample])
+    return Image.frombytes("RGB", (pixels.shape[1], pixels.shape[0]), pixels.data, "raw", _RAW_FORMATS[fmt])
+
+
+def _timed_submit(pool: ThreadPoolExecutor, fn):
+    """Run fn on the pool; the future resolves to (result, perf_counter at completion)."""
+    return pool.submit(lambda: (fn(), time.perf_counter()))
 
 
 class AndroidController:
-    def __init__(self, serial: str, host: str = "127.0.0.1", port: int = 5037):
+    def __init__(
+        self, serial: str, host: str = "127.0.0.1", port: int = 5037,
+        screencap_mode: str = "png", screencap_downsample: int = 1,
+        hierarchy_mode: str = "stream", concurrent_capture: bool = True,
+        capture_skew_tolerance_s: float = 0.5,
+    ):
         """
         Connect to the ADB server and select a device by serial.
         Make sure `adb start-server` has been run (Android Studio does this
         automatically when you launch an emulator).
+
+        screencap_mode: "png" = `screencap -p` (PNG-encoded on the device, decoded here),
+            "raw" = uncompressed framebuffer bytes parsed straight into an array.
+        screencap_downsample: keep every n-th pixel of the captured frame ("raw" skips
+            them while decoding; "png" resizes after decoding). Element boxes and grid
+            cells are drawn in the downsampled frame; actions keep device coordinates.
+        hierarchy_mode: "stream" = `uiautomator dump` written to the exec stream and
+            parsed in memory, "sdcard" = dump to /sdcard, then `cat` it back. A stream
+            that returns no XML is retried via /sdcard; after 3 in a row the controller
+            stays on "sdcard" (the device's uiautomator can't write to /dev/tty).
+        concurrent_capture: in element mode, run screencap and the hierarchy dump at
+            the same time on separate adb connections instead of one after the other.
+        capture_skew_tolerance_s: frame and tree finishing further apart than this are
+            reported as `capture_consistent: False` in `last_capture`.
         """
+        if screencap_mode not in SCREENCAP_MODES:
+            raise ValueError(f"screencap_mode must be one of {SCREENCAP_MODES}, got {screencap_mode!r}")
+        if hierarchy_mode not in HIERARCHY_MODES:
+            raise ValueError(f"hierarchy_mode must be one of {HIERARCHY_MODES}, got {hierarchy_mode!r}")
         client = AdbClient(host=host, port=port)
         self.device = client.device(serial)
         if self.device is None:
@@ -102,6 +343,48 @@ class AndroidController:
                 f"Device '{serial}' not found. "
                 f"Run `adb devices` to check connected devices."
             )
+        self.screencap_mode = screencap_mode
+        self.screencap_downsample = max(int(screencap_downsample), 1)
+        self.hierarchy_mode = hierarchy_mode
+        self._stream_misses = 0
+        self.concurrent_capture = concurrent_capture
+        self.capture_skew_tolerance_s = capture_skew_tolerance_s
+        self._capture_pool = (ThreadPoolExecutor(max_workers=2, thread_name_prefix="capture")
+                              if concurrent_capture else None)
+        # timings of the most recent capture, for per-step latency records
+        self.last_capture: dict = {}
+
+    def capture(self) -> tuple[Image.Image, float]:
+        """
+        Grab the current frame as an RGB image. Returns (image, t_adb_s), where t_adb_s is
+        the transfer time; decode time is in `last_capture` alongside mode and byte count.
+        """
+        mode = self.screencap_mode
+        t0 = time.perf_counter()
+        if mode == "raw":
+            # exec: is a raw binary stream (no pty, no newline translation)
+            conn = self.device.create_connection()
+            with conn:
+                conn.send("exec:/system/bin/screencap")
+                data = conn.read_all()
+        else:
+            data = self.device.screencap()
+        t_adb = time.perf_counter() - t0
+        trace.complete("adb.screencap", t0, t0 + t_adb, "adb", mode=mode, bytes=len(data))
+
+        t1 = time.perf_counter()
+        if mode == "raw":
+            img = decode_raw_screencap(data, self.screencap_downsample)
+        else:
+            img = Image.open(io.BytesIO(data)).convert("RGB")
+            if self.screencap_downsample > 1:
+                img = img.resize((img.width // self.screencap_downsample, img.height // self.screencap_downsample),
+                                 Image.BILINEAR)
+        t_decode = time.perf_counter() - t1
+        trace.complete("screencap_decode", t1, t1 + t_decode, "controller", mode=mode)
+        self.last_capture = {"screencap_mode": mode, "screencap_decode_s": round(t_decode, 4),
+                             "screencap_bytes": len(data)}
+        return img, t_adb
 
     def screen_size(self) -> tuple[int, int]:
         """
@@ -116,94 +399,125 @@ class AndroidController:
                 return int(w), int(h)
         raise RuntimeError(f"Could not parse screen size from: {output!r}")
 
-    def get_ui_hierarchy(self, xml_save_path: str) -> str:
-        """
-        Dump the UI hierarchy via uiautomator and pull the XML to *xml_save_path*.
-        Returns the local path on success.
-        """
+    def _dump_hierarchy_stream(self) -> bytes | None:
+        """`uiautomator dump` to /dev/tty over an exec: stream; None if no XML came back."""
+        with trace.span("adb.uiautomator_dump", "adb", mode="stream") as args:
+            conn = self.device.create_connection()
+            with conn:
+                conn.send("exec:uiautomator dump --compressed /dev/tty")
+                data = conn.read_all()
+            args["bytes"] = len(data)
+        # the XML is followed by "UI hierchary dumped to: /dev/tty"
+        start, end = data.find(b"<?xml"), data.rfind(b"</hierarchy>")
+        if start < 0 or end < 0:
+            return None
+        return data[start:end + len(b"</hierarchy>")]
+
+    def _dump_hierarchy_sdcard(self) -> bytes:
         device_xml = "/sdcard/ui_dump.xml"
-        self.device.shell(f"uiautomator dump --compressed {device_xml}")
-        os.makedirs(os.path.dirname(xml_save_path) or ".", exist_ok=True)
+        with trace.span("adb.uiautomator_dump", "adb", mode="sdcard"):
+            self.device.shell(f"uiautomator dump --compressed {device_xml}")
         # pull via shell cat (ppadb doesn't have pull)
-        xml_bytes = self.device.shell(f"cat {device_xml}")
-        with open(xml_save_path, "w") as f:
-            f.write(xml_bytes)
-        return xml_save_path
+        with trace.span("adb.cat_xml", "adb"):
+            return self.device.shell(f"cat {device_xml}").encode()
+
+    def get_ui_hierarchy(self, xml_save_path: str | None = None) -> bytes:
+        """
+        Dump the UI hierarchy via uiautomator and return the XML bytes; they are also
+        written to *xml_save_path* when one is given.
+        """
+        xml = None
+        if self.hierarchy_mode == "stream":
+            xml = self._dump_hierarchy_stream()
+            self._stream_misses = 0 if xml is not None else self._stream_misses + 1
+            if self._stream_misses >= 3:
+                print("[controller] uiautomator dump to /dev/tty returned no XML 3x; using /sdcard from now on")
+                self.hierarchy_mode = "sdcard"
+        if xml is None:
+            xml = self._dump_hierarchy_sdcard()
+        if xml_save_path:
+            os.makedirs(os.path.dirname(xml_save_path) or ".", exist_ok=True)
+            with open(xml_save_path, "wb") as f:
+                f.write(xml)
+        return xml
 
     @staticmethod
-    def parse_ui_elements(xml_path: str) -> list[UIElement]:
+    @trace.traced("parse_ui_elements", "controller")
+    def parse_ui_elements(xml: str | bytes) -> ElementStore:
         """
-        Parse a uiautomator XML dump and return a merged, de-duplicated list
-        of clickable + focusable elements (clickable first).
+        Parse a uiautomator XML dump (path or bytes) and return a merged,
+        de-duplicated list of clickable + focusable elements (clickable first).
         """
-        clickable = _traverse_tree(xml_path, "clickable", add_index=True)
-        focusable = _traverse_tree(xml_path, "focusable", add_index=True)
-
-        merged = list(clickable)
-        for fe in focusable:
-            close = False
-            for ce in clickable:
-                dist = (
-                    (fe.center[0] - ce.center[0]) ** 2
-                    + (fe.center[1] - ce.center[1]) ** 2
-                ) ** 0.5
-                if dist <= MIN_DIST:
-                    close = True
-                    break
-            if not close:
-                merged.append(fe)
+        buckets = _parse_hierarchy(xml)
+        merged = buckets["clickable"]
+        # focusables are already MIN_DIST apart from each other, so checking them
+        # against the growing store only ever rejects ones close to a clickable
+        for fe in buckets["focusable"]:
+            merged.add(fe)
         return merged
 
     def screenshot_with_elements(
         self,
         labeled_path: str,
         xml_save_path: str | None = None,
-    ) -> tuple[str, list[UIElement], float, float, float]:
+    ) -> tuple[str, ElementStore, float, float, float]:
         """
         Capture a screenshot, dump the UI hierarchy, label each interactive
-        element with a number on the image.
+        element with a number on the image. The hierarchy XML is parsed in memory
+        and only written out if *xml_save_path* is given.
+
+        With `concurrent_capture` the screencap and the dump run in parallel, so
+        t_adb_s and t_hierarchy_s overlap; `last_capture` has the wall time of both
+        (observe_s), how far apart they finished (capture_skew_s, capture_consistent),
+        the screencap decode time and the hierarchy mode.
 
         Returns (labeled_path, elem_list, t_adb_s, t_hierarchy_s, t_label_s).
         """
-        t0 = time.perf_counter()
-        png_bytes: bytes = self.device.screencap()
-        t_adb = time.perf_counter() - t0
-
-        t0 = time.perf_counter()
-        if xml_save_path is None:
-            xml_save_path = labeled_path.replace(".png", ".xml")
-        self.get_ui_hierarchy(xml_save_path)
-        elem_list = self.parse_ui_elements(xml_save_path)
-        t_hierarchy = time.perf_counter() - t0
+        def hierarchy():
+            t0 = time.perf_counter()
+            xml = self.get_ui_hierarchy(xml_save_path)
+            return xml, self.parse_ui_elements(xml), time.perf_counter() - t0
+
+        t_start = time.perf_counter()
+        if self._capture_pool is not None:
+            frame = _timed_submit(self._capture_pool, self.capture)
+            tree = _timed_submit(self._capture_pool, hierarchy)
+            (img, t_adb), t_frame_done = frame.result()
+            (xml, elem_list, t_hierarchy), t_tree_done = tree.result()
+        else:
+            img, t_adb = self.capture()
+            t_frame_done = time.perf_counter()
+            xml, elem_list, t_hierarchy = hierarchy()
+            t_tree_done = time.perf_counter()
+        # both observations are taken near the end of their round trip (uiautomator
+        # waits for the UI to idle before snapshotting), so compare completion times
+        skew = abs(t_tree_done - t_frame_done)
+        self.last_capture.update(
+            hierarchy_mode=self.hierarchy_mode, hierarchy_bytes=len(xml),
+            hierarchy_s=round(t_hierarchy, 4), observe_s=round(max(t_frame_done, t_tree_done) - t_start, 4),
+            capture_concurrent=self._capture_pool is not None, capture_skew_s=round(skew, 4),
+            capture_consistent=skew <= self.capture_skew_tolerance_s,
+        )
 
         # ── Draw labels on screenshot ───────────────────────────────────
         t0 = time.perf_counter()
-        img = Image.open(io.BytesIO(png_bytes)).convert("RGB")
         draw = ImageDraw.Draw(img)
-
-        try:
-            font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", size=28)
-        except OSError:
-            font = ImageFont.load_default()
+        ds = self.screencap_downsample
 
         for idx, elem in enumerate(elem_list, 1):
             (x1, y1), (x2, y2) = elem.bbox
-            # draw bounding box
-            draw.rectangle([x1, y1, x2, y2], outline=(255, 116, 113), width=3)
-            # draw label at center
-            cx, cy = elem.center
+            # draw bounding box (element coordinates are device pixels)
+            draw.rectangle([x1 // ds, y1 // ds, x2 // ds, y2 // ds], outline=(255, 116, 113), width=max(3 // ds, 1))
+            # label at center on a black background for readability (cached badge)
             label = str(idx)
-            # background rectangle for readability
-            tw = len(label) * 14 + 8
-            th = 28
-            lx = cx - tw // 2
-            ly = cy - th // 2
-            draw.rectangle([lx, ly, lx + tw, ly + th], fill=(0, 0, 0, 180))
-            draw.text((lx + 4, ly + 2), label, fill=(255, 116, 113), font=font)
+            overlay.draw_label(img, label, elem.center[0] // ds, elem.center[1] // ds,
+                               28 // ds, (len(label) * 14 + 8) // ds, 28 // ds)
 
         os.makedirs(os.path.dirname(labeled_path) or ".", exist_ok=True)
-        img.save(labeled_path)
+        with trace.span("png_save", "controller"):
+            img.save(labeled_path)
         t_label = time.perf_counter() - t0
+        trace.complete("draw_labels", t0, t0 + t_label, "controller", elements=len(elem_list))
 
         return labeled_path, elem_list, t_adb, t_hierarchy, t_label
 
@@ -215,33 +529,24 @@ class AndroidController:
         """
         Capture a screenshot and annotate it with a numbered cell grid.
 
-        Returns (grid_path, rows, cols, t_adb_s, t_preprocess_s).
+        Returns (grid_path, rows, cols, t_adb_s, t_preprocess_s); the screencap
+        decode time is in `last_capture`.
         """
         CELL_W, CELL_H = 80, 119
         cols = 1280 // CELL_W   # 16
         rows = 2856 // CELL_H   # 24
 
-        t0 = time.perf_counter()
-        png_bytes: bytes = self.device.screencap()
-        t_adb = time.perf_counter() - t0
+        img, t_adb = self.capture()
 
         t0 = time.perf_counter()
-        img = Image.open(io.BytesIO(png_bytes)).convert("RGB")
-        draw = ImageDraw.Draw(img)
-        color = (255, 116, 113)
-        font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", size=25)
-
-        for r in range(rows):
-            for c in range(cols):
-                label = r * cols + c + 1
-                x0, y0 = c * CELL_W, r * CELL_H
-                x1, y1 = x0 + CELL_W, y0 + CELL_H
-                draw.rectangle([x0, y0, x1, y1], outline=color, width=3)
-                draw.text((x0 + 4, y0 + 4), str(label), fill=color, font=font)
+        ds = self.screencap_downsample
+        overlay.draw_grid(img, rows, cols, CELL_W, CELL_H, 25 // ds, width=max(3 // ds, 1), scale=ds)
 
         os.makedirs(os.path.dirname(grid_path) or ".", exist_ok=True)
-        img.save(grid_path)
+        with trace.span("png_save", "controller"):
+            img.save(grid_path)
         t_preprocess = time.perf_counter() - t0
+        trace.complete("draw_grid", t0, t0 + t_preprocess, "controller")
 
         return grid_path, rows, cols, t_adb, t_preprocess
 
@@ -249,9 +554,11 @@ class AndroidController:
     # Actions
     # ------------------------------------------------------------------
 
+    @trace.traced("adb.tap", "adb")
     def tap(self, x: int, y: int) -> None:
         self.device.input_tap(x, y)
 
+    @trace.traced("adb.swipe", "adb")
     def swipe(
         self,
         x1: int,
@@ -262,21 +569,27 @@ class AndroidController:
     ) -> None:
         self.device.input_swipe(x1, y1, x2, y2, duration_ms)
 
+    @trace.traced("adb.long_press", "adb")
     def long_press(self, x: int, y: int, duration_ms: int = 1000) -> None:
         self.device.input_swipe(x, y, x, y, duration_ms)
 
+    @trace.traced("adb.type_text", "adb")
     def type_text(self, text: str) -> None:
         self.device.input_text(text)
 
+    @trace.traced("adb.clear_text", "adb")
     def clear_text(self) -> None:
         self.device.input_keycombination("113 29")
         self.device.input_keyevent("67")
 
+    @trace.traced("adb.enter", "adb")
     def enter(self) -> None:
         self.device.input_keyevent("KEYCODE_ENTER")
 
+    @trace.traced("adb.back", "adb")
     def back(self) -> None:
         self.device.input_keyevent("KEYCODE_BACK")
 
+    @trace.traced("adb.home", "adb")
     def home(self) -> None:
         self.device.input_keyevent("KEYCODE_HOME")
@@ -6,6 +6,9 @@ Wraps agent logic into AndroidWorld's EnvironmentInteractingAgent interface.
 import os
 import subprocess
 import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
@@ -13,9 +16,18 @@ from PIL import Image, ImageDraw, ImageFont
 from android_world.agents import base_agent
 from android_world.env import json_action, adb_utils, tools
 
-from .android_controller import UIElement, _traverse_tree, MIN_DIST
-from .parse import parse_element_response, parse_grid_response, parse_response
-from .model import DynamicLoRAVLLMModel, GeminiModel, VLLMModel
+from .android_controller import AdbShellSession, ElementStore, UIElement
+from .parse import (
+    StreamingActionParser, parse_element_response, parse_grid_response, parse_response,
+    response_fields, response_regex, unmatched_examples,
+)
+from .model import (
+    IMAGE_CACHE, DynamicLoRAVLLMModel, GeminiModel, ImageTransport, SplitPrompt, VLLMModel,
+    set_request_affinity,
+)
+from .response_cache import CachedModel, unwrap_model
+from .server_metrics import ServerMetricsCollector
+from . import overlay, trace
 from .prompt import (
     build_element_prompt,
     build_grid_prompt,
@@ -57,32 +69,13 @@ def _draw_numbered_grid(
     gc = GRID_COLS if grid_cols is None else grid_cols
     cw = CELL_W if cell_w is None else cell_w
     ch = CELL_H if cell_h is None else cell_h
-    draw = ImageDraw.Draw(img)
-    color = (255, 116, 113)
-    font_size = max(20, min(cw, ch) // 4)
-    try:
-        font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", size=font_size)
-    except OSError:
-        font = ImageFont.load_default()
-
-    for r in range(gr):
-        for c in range(gc):
-            label = r * gc + c + 1
-            x0, y0 = c * cw, r * ch
-            x1, y1 = x0 + cw, y0 + ch
-            draw.rectangle([x0, y0, x1, y1], outline=color, width=3)
-            draw.text((x0 + 4, y0 + 4), str(label), fill=color, font=font)
-    return img
+    # geometry is fixed per run: outlines and numbers come from overlay's cache
+    return overlay.draw_grid(img, gr, gc, cw, ch, max(20, min(cw, ch) // 4))
 
 
 # ── Helper: draw element labels ─────────────────────────────────────
 def _draw_element_labels(img: Image.Image, elem_list: list[UIElement]) -> Image.Image:
     draw = ImageDraw.Draw(img)
-    try:
-        font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", size=28)
-    except OSError:
-        font = ImageFont.load_default()
-
     for idx, elem in enumerate(elem_list, 1):
         (x1, y1), (x2, y2) = elem.bbox
         # Normalize: uiautomator can return inverted coords (x1>x2 or y1>y2)
@@ -92,15 +85,10 @@ def _draw_element_labels(img: Image.Image, elem_list: list[UIElement]) -> Image.
         if x1 == x2 or y1 == y2:
             continue
         draw.rectangle([x1, y1, x2, y2], outline=(255, 116, 113), width=3)
-        # label at center
+        # label at center (cached badge: black box + number)
         cx, cy = elem.center
         label = str(idx)
-        tw = len(label) * 14 + 8
-        th = 28
-        lx = cx - tw // 2
-        ly = cy - th // 2
-        draw.rectangle([lx, ly, lx + tw, ly + th], fill=(0, 0, 0, 180))
-        draw.text((lx + 4, ly + 2), label, fill=(255, 116, 113), font=font)
+        overlay.draw_label(img, label, cx, cy, 28, len(label) * 14 + 8, 28)
     return img
 
 def _annotate_thinking(img: Image.Image, thinking: str) -> Image.Image:
@@ -139,7 +127,7 @@ def _annotate_thinking(img: Image.Image, thinking: str) -> Image.Image:
     return new_img
 
 
-def _process_aw_ui_elements(aw_elements: list) -> list[UIElement]:
+def _process_aw_ui_elements(aw_elements: list) -> ElementStore:
     """
     Convert AndroidWorld's State.ui_elements into our UIElement format,
     applying deduplication based on MIN_DIST.
@@ -192,12 +180,7 @@ def _process_aw_ui_elements(aw_elements: list) -> list[UIElement]:
             other.append(ui_elem)
             
     # deduplicate: clickable first
-    merged = []
-    for elem in clickable + other:
-        if not any(((elem.center[0] - m.center[0]) ** 2 + (elem.center[1] - m.center[1]) ** 2) ** 0.5 <= MIN_DIST for m in merged):
-            merged.append(elem)
-            
-    return merged
+    return ElementStore(clickable + other)
 
 
 def _area_to_xy(
@@ -323,6 +306,18 @@ def _action_to_aw(
 DIFF_THUMBNAIL_SIZE = (270, 600)
 
 
+def _history_summary(result: dict, raw_response: str, usage: dict) -> str:
+    """History entry text for a step: pass-3/Summary field, else a fallback."""
+    summary = usage.get("pass3_summary") or result.get("summary")
+    if summary:
+        return summary
+    if usage.get("early_stopped"):
+        # EARLY_ACTION="cancel" stopped decoding after the Action line; the head of the
+        # response would be Observation/Thought text, so describe the action instead
+        return result.get("action_raw") or _action_dict_to_str(result["parsed_action"])
+    return raw_response[:100]
+
+
 def _action_dict_to_str(action: dict) -> str:
     """Convert a parsed action dict back to a compact function-call string."""
     name = action.get("action", "unknown")
@@ -381,6 +376,23 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
         transition_pause: float = 3.0,
     ):
         super().__init__(env=env, name="agentic_rl", transition_pause=transition_pause)
+        self._transition_pause_s = transition_pause or 0.0
+
+        # Per-mode wire encoding for screenshots (see IMAGE_TRANSPORT in config.yaml)
+        transport_cfg = {
+            "url": config.get("IMAGE_URL_MODE", "data"),
+            "media_dir": config.get("IMAGE_MEDIA_DIR"),
+            **((config.get("IMAGE_TRANSPORT") or {}).get(config.get("AGENT_MODE", "element")) or {}),
+        }
+        image_transport = ImageTransport.from_config(transport_cfg)
+
+        # Stop reading the stream once the Action line is complete ("cancel"), or keep the
+        # Summary tail decoding in the background ("background"). vLLM backends only.
+        self._early_action = config.get("EARLY_ACTION", "off")
+        # Constrain the action pass to the mode's response grammar (parse.response_regex)
+        self._guided_decoding = config.get("GUIDED_DECODING", "off")
+        # "prefix": order prompt content static -> dynamic so vLLM's prefix cache hits
+        self._prompt_layout = config.get("PROMPT_LAYOUT", "default")
 
         backend = config.get("BACKEND", "gemini").lower()
         if backend == "vllm_dynamic_lora":
@@ -393,6 +405,12 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
                 think_max_tokens=config.get("THINK_MAX_TOKENS"),
                 action_max_tokens=config.get("ACTION_MAX_TOKENS"),
                 lora_as_tool=config.get("LORA_AS_TOOL", False),
+                image_transport=image_transport,
+                pass2_prewarm=config.get("PASS2_PREWARM", False),
+                background_pass3=config.get("PASS3_BACKGROUND", False),
+                early_action=self._early_action,
+                guided_decoding=self._guided_decoding,
+                prompt_layout=self._prompt_layout,
             )
             print(
                 f"[aw_adapter] Backend: vLLM dynamic-LoRA — "
@@ -403,12 +421,30 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
                 api_key=config["VLLM_API_KEY"],
                 model_name=config["VLLM_MODEL"],
                 base_url=config.get("VLLM_BASE_URL", "http://127.0.0.1:8000/v1"),
+                image_transport=image_transport,
+                early_action=self._early_action,
+                guided_decoding=self._guided_decoding,
+                prompt_layout=self._prompt_layout,
             )
         else:
             self.model = GeminiModel(
                 api_key=config["GEMINI_API_KEY"],
                 model_name=config["GEMINI_MODEL"],
+                image_transport=image_transport,
+            )
+
+        # Record/replay (text, usage) per request, e.g. to rerun parser changes without a GPU
+        if config.get("RESPONSE_CACHE"):
+            self.model = CachedModel(self.model, config["RESPONSE_CACHE"], config.get("RESPONSE_CACHE_MODE", "record"))
+
+        # Poll the vLLM server's /metrics so each step records queueing, prefix-cache and KV activity
+        self.server_metrics: ServerMetricsCollector | None = None
+        if config.get("SERVER_METRICS") and backend in ("vllm", "vllm_dynamic_lora"):
+            self.server_metrics = ServerMetricsCollector(
+                config.get("VLLM_BASE_URL", "http://127.0.0.1:8000/v1"),
+                interval_s=config.get("SERVER_METRICS_INTERVAL_S", 0.5),
             )
+        self._server_mark: dict | None = None
 
         self.agent_mode = config.get("AGENT_MODE", "element")
         self.thinking_mode = config.get("THINKING_MODE", False)
@@ -438,6 +474,10 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
                 self.grid_prompt = custom_prompt_text
             elif self.agent_mode == "element":
                 self.element_prompt = custom_prompt_text
+            if self._guided_decoding != "off":
+                # the grammar follows the built-in prompts' response format
+                print("[aw_adapter] GUIDED_DECODING disabled: custom prompt format is unknown")
+                self._guided_decoding = "off"
 
 
         # 2-level hierarchical grid (grid2level mode)
@@ -452,6 +492,8 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
             self._coarse_rows, self._coarse_cols,
             prompt_style=self.prompt_style,
         )
+        if self._guided_decoding != "off":
+            self._check_guided_grammar()
         if self.agent_mode == "grid2level":
             print(
                 f"grid2level: coarse {self._coarse_rows}x{self._coarse_cols} "
@@ -463,28 +505,246 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
         os.makedirs(self.output_dir, exist_ok=True)
 
         self._adb_path = os.path.expanduser(config.get("ADB_PATH", "") or "adb")
+        # Raw taps/swipes/keys go over one persistent `adb shell` instead of a process per command
+        self._adb_session = AdbShellSession(self._adb_path) if config.get("ADB_SHELL_SESSION", True) else None
 
         self.max_history_steps = config.get("MAX_HISTORY_STEPS", 0)
         print(f"max history steps: {self.max_history_steps}")
         self._history: list[dict] = []
         self._step_count = 0
-        self._elem_list: list[UIElement] = []
+        self._elem_list = ElementStore()
 
         self._screen_change_threshold = config.get("SCREEN_CHANGE_THRESHOLD", 0.02)
         self._max_stall_steps = config.get("MAX_STALL_STEPS", 3)
         self._stall_action = config.get("STALL_ACTION", "nudge")
+        # "nbest": sample STALL_NBEST_N candidates in one request and execute the best untried one
+        self._nbest_n = config.get("STALL_NBEST_N", 4)
+        self._nbest_temperature = config.get("STALL_NBEST_TEMPERATURE", 0.8)
         self._prev_screenshot: Image.Image | None = None
         self._stall_count = 0
         self._max_stall_count = 0
 
+        # Step PNGs are artifacts only: the model gets the in-memory frame, and the
+        # annotated copy is written by a background worker off the critical path.
+        self._save_step_images = config.get("SAVE_STEP_IMAGES", True)
+        self._artifact_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="aw_artifacts")
+        self._pending_artifacts: list[Future] = []
+        self.last_observation: Image.Image | None = None
+        # Summaries still being decoded in the background (PASS3_BACKGROUND pass 3, or the
+        # stream tail after EARLY_ACTION="background"): future -> {"entry", "prefix", "latency"}
+        self._pending_summaries: dict[Future, dict] = {}
+
+        IMAGE_CACHE.configure(
+            max_entries=config.get("IMAGE_CACHE_MAX_ENTRIES"),
+            max_bytes=int(config["IMAGE_CACHE_MAX_MB"] * 1024 * 1024) if config.get("IMAGE_CACHE_MAX_MB") else None,
+        )
+        self._image_cache_mark = IMAGE_CACHE.stats()
+
+    def _persist_artifact(
+        self, img: Image.Image, path: str, annotation_text: str | None = None,
+        summary_future: Future | None = None,
+    ) -> str | None:
+        """
+        Queue `img` (annotated with `annotation_text` when given) to be written to *path*.
+        A pending background summary is appended to the annotation once it lands.
+        Returns *path*, or None when SAVE_STEP_IMAGES is off. Only a record for people:
+        the model's history frames are the in-memory images (see `_append_history`).
+        """
+        if not self._save_step_images:
+            return None
+
+        def write():
+            text = annotation_text
+            if summary_future is not None and text is not None:
+                try:
+                    text += f"\n\n=== SUMMARY ===\n{summary_future.result()[0]}"
+                except Exception:
+                    pass
+            with trace.span("annotate_thinking"):
+                out = _annotate_thinking(img, text) if text is not None else img
+            with trace.span("png_save", path=os.path.basename(path)):
+                out.save(path)
+
+        self._pending_artifacts.append(self._artifact_pool.submit(write))
+        return path
+
+    def _reap_artifacts(self) -> None:
+        """Drop finished artifact writes, reporting failures, without waiting for the rest."""
+        pending = []
+        for fut in self._pending_artifacts:
+            if not fut.done():
+                pending.append(fut)
+            elif fut.exception() is not None:
+                print(f"  [aw_adapter] WARNING: artifact write failed: {fut.exception()}")
+        self._pending_artifacts = pending
+
+    @trace.traced("flush_artifacts")
+    def flush_artifacts(self) -> None:
+        """Block until every queued artifact write has finished (e.g. before reading one back)."""
+        pending, self._pending_artifacts = self._pending_artifacts, []
+        for fut in pending:
+            try:
+                fut.result()
+            except Exception as e:
+                print(f"  [aw_adapter] WARNING: artifact write failed: {e}")
+
+    def _append_history(
+        self, entry: dict, image: Image.Image | None = None,
+        summary_future: Future | None = None, summary_prefix: str = "",
+    ) -> None:
+        """
+        Append a history entry. The in-memory frame is kept on the entry (only for the
+        last MAX_HISTORY_STEPS entries) and is what the model sees, whether or not the
+        annotated step PNG is also written.
+        With a background `summary_future`, entry["summary"] is provisional and is
+        replaced by `summary_prefix + summary` in `_resolve_summaries`.
+        """
+        if self.max_history_steps > 0 and image is not None:
+            entry["image"] = image
+            for h in self._history[:-(self.max_history_steps - 1) or None]:
+                h.pop("image", None)
+        if summary_future is not None:
+            pending = self._pending_summaries.setdefault(summary_future, {})
+            pending["entry"] = entry
+            pending["prefix"] = summary_prefix
+        self._history.append(entry)
+
+    @trace.traced("resolve_summaries")
+    def _resolve_summaries(self) -> None:
+        """
+        Wait for background summaries (normally long done by now: they ran during action
+        execution and transition_pause), patch them into history, and add their tokens
+        to the step latency dicts they belong to.
+        """
+        pending, self._pending_summaries = self._pending_summaries, {}
+        for fut, rec in pending.items():
+            try:
+                summary, extra_usage = fut.result()
+            except Exception as e:
+                print(f"  [aw_adapter] WARNING: background summary failed, keeping provisional one: {e}")
+                continue
+            entry = rec.get("entry")
+            if entry is not None and summary:
+                entry["summary"] = f"{rec.get('prefix', '')}{summary}"
+            latency = rec.get("latency")
+            if latency is not None:
+                for key in ("prompt_tokens", "completion_tokens", "total_tokens", "cached_tokens"):
+                    latency[key] = latency.get(key, 0) + extra_usage.get(key, 0)
+                if latency.get("prompt_tokens"):
+                    latency["prefix_hit_rate"] = round(latency.get("cached_tokens", 0) / latency["prompt_tokens"], 4)
+                latency["summary_s"] = round(extra_usage.get("ttft_s", 0.0) + extra_usage.get("decode_s", 0.0), 4)
+
     def _adb_shell(self, *args, timeout: int = 5):
-        return subprocess.run([self._adb_path, "shell"] + list(args), timeout=timeout)
+        """Run `adb shell args`; a non-zero exit raises CalledProcessError, so the step records it."""
+        with trace.span("adb.shell", "adb", cmd=" ".join(args)):
+            if self._adb_session is not None:
+                result = self._adb_session.run(*args, timeout=timeout)
+            else:
+                result = subprocess.run([self._adb_path, "shell"] + list(args), timeout=timeout)
+        result.check_returncode()
+        return result
+
+    def get_post_transition_state(self):
+        # traced as the harness's transition_pause sleep followed by the screenshot + a11y fetch
+        t0 = time.perf_counter()
+        state = super().get_post_transition_state()
+        if trace.enabled():
+            t1 = time.perf_counter()
+            pause = min(self._transition_pause_s, t1 - t0)
+            trace.complete("transition_pause", t0, t0 + pause, "env")
+            trace.complete("env.get_state", t0 + pause, t1, "env")
+        return state
+
+    @property
+    def _backend(self):
+        """The concrete model behind any RESPONSE_CACHE wrapper, for backend checks."""
+        return unwrap_model(self.model)
+
+    def _action_parser_kwargs(self, parse_fn) -> dict:
+        """generate() kwargs for streaming action extraction with `parse_fn` (vLLM backends only)."""
+        if self._early_action == "off" or isinstance(self._backend, GeminiModel):
+            return {}
+        return {"action_parser": StreamingActionParser(parse_fn)}
+
+    def _guided_kwargs(self, mode: str, fields: tuple[str, ...], thinking_mode: bool = True) -> dict:
+        """generate() kwargs constraining the action pass to `mode`'s response grammar."""
+        if self._guided_decoding == "off" or isinstance(self._backend, GeminiModel):
+            return {}
+        style = dict(prompt_style=self.prompt_style, thinking_mode=thinking_mode)
+        if isinstance(self._backend, DynamicLoRAVLLMModel):
+            # Pass 2 continues after the <think> prefill straight into the action line
+            return {"guided_regex": response_regex(mode, ("Action",), ("Summary",), **style)}
+        return {"guided_regex": response_regex(mode, fields, **style)}
+
+    def _check_guided_grammar(self) -> None:
+        """Turn GUIDED_DECODING off if the prompt in use shows actions its grammar would forbid."""
+        if self.agent_mode == "grid2level":
+            fine_w, fine_h = FINE_IMG_TARGET_SIZE
+            prompts = [("grid2level", self.coarse_prompt, True),
+                       ("grid2level_fine", build_fine_grid_prompt(
+                           SCREEN_W, SCREEN_H, fine_w // self._fine_cols, fine_h // self._fine_rows,
+                           self._fine_rows, self._fine_cols), True)]
+        else:
+            prompt = {"raw": self.raw_prompt, "grid": self.grid_prompt}.get(self.agent_mode, self.element_prompt)
+            prompts = [(self.agent_mode, prompt, self.thinking_mode)]
+        for mode, prompt, thinking in prompts:
+            bad = unmatched_examples(prompt, mode, self.prompt_style, thinking)
+            if bad:
+                print(f"[aw_adapter] GUIDED_DECODING disabled: {mode} grammar rejects prompt "
+                      f"({self.prompt_style}) examples {bad}")
+                self._guided_decoding = "off"
+                return
+
+    def _action_valid(self, action: dict) -> bool:
+        """Whether `action` can be executed against the current screen."""
+        if "element" in action:
+            return isinstance(action["element"], int) and 1 <= action["element"] <= len(self._elem_list)
+        if "area" in action:
+            return isinstance(action["area"], int) and 1 <= action["area"] <= GRID_ROWS * GRID_COLS
+        if action["action"] in ("tap_raw", "swipe_raw"):
+            coords = [v for k, v in action.items() if k != "action"]
+            return all(0.0 <= c <= 1.0 for c in coords)
+        return True
+
+    def _rank_candidates(self, candidates: list[tuple[str, float]], parse_fn) -> tuple[str, dict]:
+        """
+        Pick which n-best candidate to execute: a valid action not already tried during
+        this stall, then a valid repeat, then anything; ties go to the higher mean logprob.
+        Returns (raw_response, nbest_info).
+        """
+        tried = {_action_dict_to_str(h.get("action", {})) for h in self._history[-self._stall_count:]}
+        seen: set[str] = set()
+        rows = []
+        for text, logprob in candidates:
+            result = parse_fn(text)
+            if result is None:
+                key, status = None, "unparseable"
+            else:
+                key = _action_dict_to_str(result["parsed_action"])
+                if not self._action_valid(result["parsed_action"]):
+                    status = "invalid"
+                elif key in tried:
+                    status = "repeat"
+                elif key in seen:
+                    status = "duplicate"
+                else:
+                    status = "novel"
+                seen.add(key)
+            rows.append({"action": key, "logprob": round(logprob, 4), "status": status})
+
+        tier = {"novel": 0, "repeat": 1, "duplicate": 1, "invalid": 2, "unparseable": 3}
+        best = min(range(len(rows)), key=lambda i: (tier[rows[i]["status"]], -candidates[i][1]))
+        for i, row in enumerate(rows):
+            mark = "*" if i == best else " "
+            print(f"  [nbest]{mark} {row['status']:<11} logprob={row['logprob']:.3f}  {row['action']}")
+        return candidates[best][0], {"chosen": best, "candidates": rows}
 
     def _build_latency_dict(
         self, t_screenshot: float, t_preprocess: float, t_prompt: float,
         t_inference: float, t_action: float, t_step_total: float, token_usage: dict
     ) -> dict:
-        return {
+        cache = IMAGE_CACHE.stats()
+        latency = {
             "screenshot_s":  round(t_screenshot, 3),
             "preprocess_s":  round(t_preprocess, 3),
             "prompt_s":      round(t_prompt, 3),
@@ -494,19 +754,66 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
             "prompt_tokens": token_usage.get("prompt_tokens", 0),
             "completion_tokens": token_usage.get("completion_tokens", 0),
             "total_tokens":  token_usage.get("total_tokens", 0),
+            # prefix-cache hits (vLLM --enable-prompt-tokens-details / Gemini implicit caching)
+            "cached_tokens": token_usage.get("cached_tokens", 0),
+            "prefix_hit_rate": round(token_usage.get("cached_tokens", 0) / token_usage["prompt_tokens"], 4)
+                               if token_usage.get("prompt_tokens") else 0.0,
             "ttft_s":        token_usage.get("ttft_s", 0.0),
             "decode_s":      token_usage.get("decode_s", 0.0),
             "tpot_ms":       round(token_usage.get("tpot_s", 0.0) * 1000, 2),
+            # image-encoding cache activity since the start of this step
+            "image_cache_hits":   cache["hits"] - self._image_cache_mark["hits"],
+            "image_cache_misses": cache["misses"] - self._image_cache_mark["misses"],
         }
-
-    def reset_episode(self) -> None:
+        if "pass2_ttft_s" in token_usage:
+            # dynamic-LoRA only: pass-2 TTFT, tagged by whether its prefix was prewarmed
+            latency["pass2_ttft_s"] = token_usage["pass2_ttft_s"]
+            latency["pass2_prewarmed"] = token_usage.get("pass2_prewarmed", False)
+            latency["pass1_cached_tokens"] = token_usage.get("pass1_cached_tokens", 0)
+            latency["pass2_cached_tokens"] = token_usage.get("pass2_cached_tokens", 0)
+        if token_usage.get("early_stopped"):
+            latency["early_stopped"] = True
+        if self._server_mark is not None:
+            # server-side queueing / prefix-cache / KV activity over this step's window, up to
+            # the latest background sample (no scrape on the step path; lags <= interval_s)
+            latency["server"] = self.server_metrics.window(self._server_mark, refresh=False)
+        if token_usage.get("summary_future") is not None:
+            # background summary tokens are added when it is resolved
+            self._pending_summaries.setdefault(token_usage["summary_future"], {})["latency"] = latency
+        return latency
+
+    def reset_episode(self, output_dir: str | None = None) -> None:
+        """
+        Clear per-episode state. The model (and its keep-alive HTTP connections) and the
+        prompts are kept, so one adapter can run every task; pass `output_dir` to send the
+        next episode's artifacts elsewhere.
+        """
+        self.flush_artifacts()
+        if output_dir is not None:
+            self.output_dir = output_dir
+            os.makedirs(self.output_dir, exist_ok=True)
+        # with several VLLM_BASE_URLs, keep this episode on one server's prefix cache
+        set_request_affinity(f"episode-{uuid.uuid4().hex}")
+        self._pending_summaries = {}
+        self.last_observation = None
         self._history = []
         self._step_count = 0
-        self._elem_list = []
+        self._elem_list = ElementStore()
         self._prev_screenshot = None
         self._stall_count = 0
         self._max_stall_count = 0
-    
+        if self._adb_session is not None:
+            # a fresh shell per task; the next command restarts it
+            self._adb_session.close()
+
+    def close(self) -> None:
+        """Release what the adapter holds open: pending artifact writes, server sampling, the adb shell."""
+        self.flush_artifacts()
+        if self.server_metrics is not None:
+            self.server_metrics.stop()
+        if self._adb_session is not None:
+            self._adb_session.close()
+
     def initialize_chrome(self):
         print("Running additional chrome initialization...")
         # handle chrome initialization problem for browser tasks
@@ -543,6 +850,20 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
         time.sleep(2.0)
         print("Done additional chrome initialization")
 
+    def _history_text(self, describe=lambda h: h["summary"]) -> str:
+        """
+        "Actions taken so far" lines, one per step via `describe(entry)`. The "prefix"
+        layout leaves out the steps sent as history frames (their summaries follow the
+        frames), so the text before the frames only grows once the window slides.
+        """
+        history = self._history
+        if self._prompt_layout == "prefix" and self.max_history_steps > 0:
+            history = history[:-self.max_history_steps]
+        if not history:
+            return ""
+        lines = [f"  Step {i + 1}: {describe(h)}" for i, h in enumerate(history)]
+        return "Actions taken so far:\n" + "\n".join(lines) + "\n\n"
+
     def _build_prompt(self, goal: str, is_coarse: bool = False, history_text: str | None = None) -> str:
         if is_coarse:
             sys_prompt = self.coarse_prompt
@@ -556,10 +877,7 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
 
         # history_text can be overridden (e.g. pass action-call strings instead of English summaries)
         if history_text is None:
-            history_text = ""
-            if self._history:
-                lines = [f"  Step {i + 1}: {h['summary']}" for i, h in enumerate(self._history)]
-                history_text = "Actions taken so far:\n" + "\n".join(lines) + "\n\n"
+            history_text = self._history_text()
 
         elem_text = ""
         if not is_coarse and self.agent_mode == "element" and self._elem_list:
@@ -588,6 +906,21 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
             )
 
         max_steps = self._max_steps or 25
+        if self._prompt_layout == "prefix":
+            # head: system prompt (shared by every step and task), task (shared by the
+            # episode) and the steps older than the frame window; the model layer sends
+            # the history frames next, then this step's tail and the current frame
+            n_frames = min(len(self._history), self.max_history_steps) if self.max_history_steps > 0 else 0
+            return SplitPrompt(
+                f"{sys_prompt}\n\n"
+                f"Task: {goal}\n\n"
+                f"{history_text}",
+                f"{elem_text}"
+                f"{stall_text}"
+                f"Current step: {self._step_count + 1} / {max_steps}\n"
+                f"What is the next action?",
+                first_step=len(self._history) - n_frames + 1,
+            )
         return (
             f"{stall_text}"
             f"{sys_prompt}\n\n"
@@ -598,6 +931,12 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
             f"What is the next action?"
         )
 
+    def _pass1_prompt(self, goal: str, history_summary: str, instructions: str) -> str:
+        """Dynamic-LoRA pass-1 prompt; the "prefix" layout puts the static instructions first."""
+        if self._prompt_layout == "prefix":
+            return f"{instructions.rstrip()}\n\nTask: {goal}\n\n{history_summary}"
+        return f"Task: {goal}\n\n{history_summary}{instructions}"
+
     def _build_fine_prompt(self, goal: str, fine_cell_w: int, fine_cell_h: int) -> str:
         fine_sys = build_fine_grid_prompt(
             SCREEN_W, SCREEN_H, fine_cell_w, fine_cell_h,
@@ -626,10 +965,17 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
 
         self._step_count += 1
         t_step_start = time.perf_counter()
+        self._image_cache_mark = IMAGE_CACHE.stats()
+        self._server_mark = self.server_metrics.mark() if self.server_metrics else None
 
         t0 = time.perf_counter()
         state = self.get_post_transition_state()
         t_screenshot = time.perf_counter() - t0
+        trace.complete("screenshot", t0, t0 + t_screenshot)
+        # background summaries overlapped the action + transition pause; artifact
+        # writes are not waited on (history frames are in memory)
+        self._resolve_summaries()
+        self._reap_artifacts()
         pixels = state.pixels
         img = Image.fromarray(pixels).convert("RGB")
 
@@ -665,16 +1011,19 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
         coarse_img = _draw_numbered_grid(
             img.copy(), self._coarse_rows, self._coarse_cols,
             self._coarse_cell_w, self._coarse_cell_h)
-        coarse_img.save(coarse_path)
+        self.last_observation = coarse_img
         t_preprocess = time.perf_counter() - t0
+        trace.complete("preprocess", t0, t0 + t_preprocess)
 
         t0 = time.perf_counter()
         coarse_prompt = self._build_prompt(goal, is_coarse=True)
         t_prompt = time.perf_counter() - t0
+        trace.complete("prompt", t0, t0 + t_prompt)
 
         stall_temperature = None
         stall_thinking = False
-        if self._stall_action == "escalate" and self._stall_count >= 1:
+        # n-best is only wired into the single-pass step; the coarse/fine flow escalates
+        if self._stall_action in ("escalate", "nbest") and self._stall_count >= 1:
             stall_temperature = min(0.3 + 0.2 * self._stall_count, 1.0)
             stall_thinking = self._stall_count >= 2
             print(f"  [stall-escalation] temp={stall_temperature:.1f}  thinking={stall_thinking}")
@@ -682,31 +1031,27 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
         t0 = time.perf_counter()
         history_window = self._history[-self.max_history_steps:] if self.max_history_steps > 0 else []
         coarse_kwargs: dict = dict(
-            image_path=coarse_path,
+            image_path=coarse_img,
             history=history_window,
             temperature=stall_temperature,
             enable_thinking=stall_thinking,
             thinking_budget=self._thinking_budget,
             max_tokens=self._max_tokens,
+            **self._action_parser_kwargs(parse_element_response),
+            **self._guided_kwargs("grid2level", response_fields(self.prompt_style)),
         )
-        if isinstance(self.model, DynamicLoRAVLLMModel):
+        if isinstance(self._backend, DynamicLoRAVLLMModel):
             # Pass 1 gets English summary history; pass 2 gets action-call history
             history_summary = ""
             if self._history:
                 lines = [f"  Step {i + 1}: {h['summary']}" for i, h in enumerate(self._history)]
                 history_summary = "Actions taken so far:\n" + "\n".join(lines) + "\n\n"
             # print(f"\n\033[34m[PASS 1 HISTORY SUMMARY]\033[0m\n\033[36m{history_summary}\033[0m")
-            coarse_kwargs["pass1_prompt"] = (
-                f"Task: {goal}\n\n"
-                f"{history_summary}"
+            coarse_kwargs["pass1_prompt"] = self._pass1_prompt(goal, history_summary, (
                 "Look at the screenshot of an Android phone. "
                 "Think carefully about what the next action should be to accomplish the task."
-            )
-            action_history_text = ""
-            if self._history:
-                lines = [f"  Step {i + 1}: {_action_dict_to_str(h.get('action', {}))}"
-                         for i, h in enumerate(self._history)]
-                action_history_text = "Actions taken so far:\n" + "\n".join(lines) + "\n\n"
+            ))
+            action_history_text = self._history_text(lambda h: _action_dict_to_str(h.get("action", {})))
             # print(f"\n\033[34m[PASS 2 ACTION HISTORY]\033[0m\n\033[32m{action_history_text}\033[0m")
             coarse_kwargs["pass2_prompt"] = self._build_prompt(goal, is_coarse=True,
                                                                history_text=action_history_text)
@@ -716,6 +1061,7 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
             ]
         coarse_raw, coarse_usage = self.model.generate(coarse_prompt, **coarse_kwargs)
         t_inference_coarse = time.perf_counter() - t0
+        trace.complete("inference_coarse", t0, t0 + t_inference_coarse)
 
         annotation_text = coarse_raw
         if "pass1_raw" in coarse_usage:
@@ -725,8 +1071,8 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
             if coarse_usage.get("pass3_summary"):
                 annotation_text += f"\n\n=== PASS 3 ===\n{coarse_usage['pass3_summary']}"
 
-        coarse_annotated = _annotate_thinking(coarse_img, annotation_text)
-        coarse_annotated.save(coarse_path)
+        coarse_path = self._persist_artifact(coarse_img, coarse_path, annotation_text,
+                                             coarse_usage.get("summary_future"))
 
         print(
             f"\033[36m ==[step {self._step_count} COARSE]=="
@@ -743,10 +1089,11 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
         coarse_result = parse_element_response(coarse_raw)
         if coarse_result is None:
             print(f"  [step {self._step_count}] WARNING: could not parse coarse response")
-            self._history.append({"summary": "Parse error, retrying", "action": {"action": "noop"}, "image_path": coarse_path})
+            self._append_history({"summary": "Parse error, retrying", "action": {"action": "noop"}, "image_path": coarse_path}, coarse_img)
             t_step_total = time.perf_counter() - t_step_start
             return base_agent.AgentInteractionResult(done=False, data={
                 "step": self._step_count,
+                "parse_error": True,
                 "latency": self._build_latency_dict(t_screenshot, t_preprocess, t_prompt, t_inference_coarse, 0.0, t_step_total, coarse_usage),
             })
 
@@ -758,22 +1105,23 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
         if not is_targeting:
             is_done = coarse_action["action"] == "done"
             t0 = time.perf_counter()
+            action_error = None
             if not is_done:
                 try:
                     self._execute_non_grid_action(coarse_action)
                 except Exception as e:
-                    print(f"[step {self._step_count}] WARNING executing (continuing): {e}")
+                    action_error = f"{type(e).__name__}: {e}"
+                    print(f"[step {self._step_count}] WARNING executing (continuing): {action_error}")
             t_action = time.perf_counter() - t0
+            trace.complete("action", t0, t0 + t_action)
             t_step_total = time.perf_counter() - t_step_start
 
-            summary_val = coarse_usage.get("pass3_summary") or coarse_result.get("summary")
-            if not summary_val:
-                summary_val = coarse_raw[:100]
-            self._history.append({
+            summary_val = _history_summary(coarse_result, coarse_raw, coarse_usage)
+            self._append_history({
                 "summary": summary_val,
                 "action": coarse_action,
                 "image_path": coarse_path,
-            })
+            }, coarse_img, summary_future=coarse_usage.get("summary_future"))
             return base_agent.AgentInteractionResult(
                 done=is_done,
                 data={
@@ -786,18 +1134,20 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
                     "mode": "grid2level_coarse",
                     "screen_diff": round(screen_diff, 4),
                     "stall_count": self._stall_count,
+                    **({"action_error": action_error} if action_error else {}),
                 },
             )
 
         zoom_area = coarse_action.get("area") or coarse_action.get("element")
         if zoom_area is None:
             print(f"  [step {self._step_count}] WARNING: targeting action but no area/element")
-            self._history.append({
+            self._append_history({
                 "summary": "Could not determine zoom area",
-                "action": coarse_action, "image_path": coarse_path})
+                "action": coarse_action, "image_path": coarse_path}, coarse_img)
             t_step_total = time.perf_counter() - t_step_start
             return base_agent.AgentInteractionResult(done=False, data={
                 "step": self._step_count,
+                "parse_error": True,
                 "latency": self._build_latency_dict(
                     t_screenshot, t_preprocess, t_prompt,
                     t_inference_coarse, 0.0, t_step_total, coarse_usage)})
@@ -815,16 +1165,22 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
             enlarged.copy(), self._fine_rows, self._fine_cols,
             fine_cell_w, fine_cell_h)
         fine_path = os.path.join(self.output_dir, f"step_{self._step_count:03d}_fine.png")
-        fine_img.save(fine_path)
         t_preprocess_fine = time.perf_counter() - t0
+        trace.complete("preprocess_fine", t0, t0 + t_preprocess_fine)
 
         t0 = time.perf_counter()
         fine_prompt = self._build_fine_prompt(goal, fine_cell_w, fine_cell_h)
         t_prompt_fine = time.perf_counter() - t0
+        trace.complete("prompt_fine", t0, t0 + t_prompt_fine)
 
         t0 = time.perf_counter()
-        fine_raw, fine_usage = self.model.generate(fine_prompt, image_path=fine_path)
+        fine_raw, fine_usage = self.model.generate(
+            fine_prompt, image_path=fine_img,
+            **self._action_parser_kwargs(parse_grid_response),
+            **self._guided_kwargs("grid2level_fine", response_fields()),
+        )
         t_inference_fine = time.perf_counter() - t0
+        trace.complete("inference_fine", t0, t0 + t_inference_fine)
 
         annotation_text = fine_raw
         if "pass1_raw" in fine_usage:
@@ -834,8 +1190,7 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
             if fine_usage.get("pass3_summary"):
                 annotation_text += f"\n\n=== PASS 3 ===\n{fine_usage['pass3_summary']}"
 
-        fine_annotated = _annotate_thinking(fine_img, annotation_text)
-        fine_annotated.save(fine_path)
+        self._persist_artifact(fine_img, fine_path, annotation_text, fine_usage.get("summary_future"))
 
         print(
             f"\033[35m ==[step {self._step_count} FINE]=="
@@ -847,15 +1202,16 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
         fine_result = parse_grid_response(fine_raw)
         if fine_result is None:
             print(f"  [step {self._step_count}] WARNING: could not parse fine response")
-            self._history.append({
+            self._append_history({
                 "summary": f"Zoomed into area {zoom_area} but failed to parse fine action",
                 "action": coarse_action,
                 "image_path": coarse_path,
-            })
+            }, coarse_img)
             combined_usage = self._combine_usage(coarse_usage, fine_usage)
             t_step_total = time.perf_counter() - t_step_start
             return base_agent.AgentInteractionResult(done=False, data={
                 "step": self._step_count,
+                "parse_error": True,
                 "latency": self._build_latency_dict(
                     t_screenshot, t_preprocess + t_preprocess_fine,
                     t_prompt + t_prompt_fine,
@@ -866,26 +1222,27 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
         fine_action = fine_result["parsed_action"]
 
         t0 = time.perf_counter()
+        action_error = None
         try:
             screen_action = self._fine_to_screen_action(
                 fine_action, zoom_area, fine_cell_w, fine_cell_h,
                 target_w, target_h)
             self._execute_screen_action(screen_action)
         except Exception as e:
-            print(f"[step {self._step_count}] WARNING executing fine action (continuing): {e}")
+            action_error = f"{type(e).__name__}: {e}"
+            print(f"[step {self._step_count}] WARNING executing fine action (continuing): {action_error}")
         t_action = time.perf_counter() - t0
+        trace.complete("action", t0, t0 + t_action)
 
         combined_usage = self._combine_usage(coarse_usage, fine_usage)
         t_step_total = time.perf_counter() - t_step_start
 
-        summary = fine_usage.get("pass3_summary") or fine_result.get("summary")
-        if not summary:
-            summary = fine_raw[:100]
-        self._history.append({
+        summary = _history_summary(fine_result, fine_raw, fine_usage)
+        self._append_history({
             "summary": f"[zoom {zoom_area}] {summary}",
             "action": fine_action,
             "image_path": coarse_path,
-        })
+        }, coarse_img, summary_future=fine_usage.get("summary_future"), summary_prefix=f"[zoom {zoom_area}] ")
 
         return base_agent.AgentInteractionResult(
             done=False,
@@ -902,6 +1259,7 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
                 "zoom_area": zoom_area,
                 "screen_diff": round(screen_diff, 4),
                 "stall_count": self._stall_count,
+                **({"action_error": action_error} if action_error else {}),
             },
         )
 
@@ -910,9 +1268,12 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
             "prompt_tokens": u1.get("prompt_tokens", 0) + u2.get("prompt_tokens", 0),
             "completion_tokens": u1.get("completion_tokens", 0) + u2.get("completion_tokens", 0),
             "total_tokens": u1.get("total_tokens", 0) + u2.get("total_tokens", 0),
+            "cached_tokens": u1.get("cached_tokens", 0) + u2.get("cached_tokens", 0),
             "ttft_s": u1.get("ttft_s", 0.0),
             "decode_s": u1.get("decode_s", 0.0) + u2.get("decode_s", 0.0),
             "tpot_s": u1.get("tpot_s", 0.0),
+            # the fine pass's background summary is the one that lands in history
+            **({"summary_future": u2["summary_future"]} if "summary_future" in u2 else {}),
         }
 
     def _fine_to_screen_action(
@@ -1023,6 +1384,7 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
             aw_action = json_action.JSONAction(action_type=json_action.NAVIGATE_HOME)
             self._env.execute_action(aw_action)
 
+    @trace.traced("step")
     def step(self, goal: str, oracle_model=None, oracle_fn=None) -> base_agent.AgentInteractionResult:
         if self.agent_mode == "grid2level":
             return self._step_grid2level(goal)
@@ -1032,11 +1394,18 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
 
         self._step_count += 1
         t_step_start = time.perf_counter()
+        self._image_cache_mark = IMAGE_CACHE.stats()
+        self._server_mark = self.server_metrics.mark() if self.server_metrics else None
 
         # 1. screenshot env, includes transition pause
         t0 = time.perf_counter()
         state = self.get_post_transition_state()
         t_screenshot = time.perf_counter() - t0
+        trace.complete("screenshot", t0, t0 + t_screenshot)
+        # background summaries overlapped the action + transition pause; artifact
+        # writes are not waited on (history frames are in memory)
+        self._resolve_summaries()
+        self._reap_artifacts()
         pixels = state.pixels  # numpy array (H, W, 3)
         img = Image.fromarray(pixels).convert("RGB")
 
@@ -1072,34 +1441,31 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
         t0 = time.perf_counter()
         image_path = os.path.join(self.output_dir, f"step_{self._step_count:03d}.png")
         if self.agent_mode == "raw":
-            img.save(image_path)
             mode_img = img
-            self._elem_list = []
+            self._elem_list = ElementStore()
             mode_str = "raw"
         elif self.agent_mode == "grid":
-            grid_img = _draw_numbered_grid(img.copy())
-            grid_img.save(image_path)  # Temporarily save for the model to read
-            mode_img = grid_img
-            self._elem_list = []
+            mode_img = _draw_numbered_grid(img.copy())
+            self._elem_list = ElementStore()
             mode_str = f"grid ({GRID_ROWS}x{GRID_COLS})"
         else:
             self._elem_list = _process_aw_ui_elements(state.ui_elements)
-            labeled_img = _draw_element_labels(img.copy(), self._elem_list)
-            labeled_img.save(image_path)
-            mode_img = labeled_img
+            mode_img = _draw_element_labels(img.copy(), self._elem_list)
             mode_str = f"element ({len(self._elem_list)} elements)"
+        self.last_observation = mode_img
         t_preprocess = time.perf_counter() - t0
+        trace.complete("preprocess", t0, t0 + t_preprocess)
 
         if oracle_fn and oracle_model:
-            print(f"  [aw_adapter] Querying Oracle on {image_path}...")
-            if oracle_fn(oracle_model, goal, image_path):
+            print(f"  [aw_adapter] Querying Oracle on step {self._step_count} observation...")
+            if oracle_fn(oracle_model, goal, mode_img):
                 print("  \033[32mOracle confirmed task complete before inference.\033[0m")
                 return base_agent.AgentInteractionResult(
                     done=True,
                     data={
                         "step": self._step_count,
                         "action": {"action": "done"},
-                        "image_path": image_path,
+                        "image_path": self._persist_artifact(mode_img, image_path),
                         "mode": self.agent_mode,
                         "latency": self._build_latency_dict(
                             t_screenshot, t_preprocess, 0, 0, 0, time.perf_counter() - t_step_start, {}
@@ -1111,11 +1477,14 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
         t0 = time.perf_counter()
         prompt = self._build_prompt(goal)
         t_prompt = time.perf_counter() - t0
+        trace.complete("prompt", t0, t0 + t_prompt)
 
         # 4. inference (with stall escalation)
         stall_temperature = None
         stall_thinking = False
-        if self._stall_action == "escalate" and self._stall_count >= 1:
+        use_nbest = (self._stall_action == "nbest" and self._stall_count >= 1
+                     and hasattr(self._backend, "generate_n"))
+        if self._stall_action in ("escalate", "nbest") and self._stall_count >= 1 and not use_nbest:
             stall_temperature = min(0.3 + 0.2 * self._stall_count, 1.0)
             stall_thinking = self._stall_count >= 2
             print(f"  [stall-escalation] temp={stall_temperature:.1f}  thinking={stall_thinking}")
@@ -1123,14 +1492,17 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
         t0 = time.perf_counter()
         history_window = self._history[-self.max_history_steps:] if self.max_history_steps > 0 else []
         generate_kwargs: dict = dict(
-            image_path=image_path,
+            image_path=mode_img,
             history=history_window,
             temperature=stall_temperature,
             enable_thinking=stall_thinking,
             thinking_budget=self._thinking_budget,
             max_tokens=self._max_tokens,
+            **self._action_parser_kwargs(partial(parse_response, self.agent_mode)),
+            **self._guided_kwargs(self.agent_mode, response_fields(self.prompt_style, self.thinking_mode),
+                                  self.thinking_mode),
         )
-        if isinstance(self.model, DynamicLoRAVLLMModel):
+        if isinstance(self._backend, DynamicLoRAVLLMModel):
             # Pass 1 (base model reasoning) gets English summary history
             history_summary = ""
             if self._history:
@@ -1138,11 +1510,9 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
                 history_summary = "Actions taken so far:\n" + "\n".join(lines) + "\n\n"
             #print(f"\n\033[34m[PASS 1 HISTORY SUMMARY]\033[0m\n\033[36m{history_summary}\033[0m")
 
-            if getattr(self.model, "lora_as_tool", False):
+            if getattr(self._backend, "lora_as_tool", False):
                 print("using the lora as tool")
-                generate_kwargs["pass1_prompt"] = (
-                    f"Task: {goal}\n\n"
-                    f"{history_summary}"
+                generate_kwargs["pass1_prompt"] = self._pass1_prompt(goal, history_summary, (
                     "You are an agent controlling an Android phone. You interact with the screen using normalized coordinates where (0.0, 0.0) is the top-left and (1.0, 1.0) is the bottom-right.\n\n"
                     "Your response MUST follow this exact format:\n"
                     "  Observation: <Describe what you see on the current screen>\n"
@@ -1198,32 +1568,36 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
                     "  between 0.0 and 1.0. x=0.0 is the left edge, x=1.0 is the right edge,\n"
                     "  y=0.0 is the top edge, y=1.0 is the bottom edge.\n"
                     "- Is_Coordinate_Action is True ONLY for tap() and swipe(). It is FALSE for clear_text() and everything else.\n"
-                )
+                ))
 
             else:
-                generate_kwargs["pass1_prompt"] = (
-                    f"Task: {goal}\n\n"
-                    f"{history_summary}"
+                generate_kwargs["pass1_prompt"] = self._pass1_prompt(goal, history_summary, (
                     "Look at the screenshot of an Android phone. You are an intelligent assistant."
                     "Describe what you see on the current screen and what you think the next action should be to complete the task"
                     "Think step by step and output only your reasoning and be concise, in 2-3 sentences."
                     "If the task is completed, please make note of this in the reasoning."
-                )
+                ))
 
             # Pass 2 (LoRA action head) gets action-call history matching its fine-tuning format
-            action_history_text = ""
-            if self._history:
-                lines = [f"  Step {i + 1}: {_action_dict_to_str(h.get('action', {}))}"
-                         for i, h in enumerate(self._history)]
-                action_history_text = "Actions taken so far:\n" + "\n".join(lines) + "\n\n"
+            action_history_text = self._history_text(lambda h: _action_dict_to_str(h.get("action", {})))
             # print(f"\n\033[34m[PASS 2 ACTION HISTORY]\033[0m\n\033[32m{action_history_text}\033[0m")
             generate_kwargs["pass2_prompt"] = self._build_prompt(goal, history_text=action_history_text)
             generate_kwargs["pass2_history"] = [
                 dict(h, summary=_action_dict_to_str(h.get("action", {})))
                 for h in history_window
             ]
-        raw_response, token_usage = self.model.generate(prompt, **generate_kwargs)
+        nbest = None
+        if use_nbest:
+            # one request, shared prefill: rank STALL_NBEST_N samples instead of retrying one per step
+            generate_kwargs.pop("action_parser", None)
+            generate_kwargs.update(temperature=self._nbest_temperature, enable_thinking=False)
+            print(f"  [stall-nbest] n={self._nbest_n}  temp={self._nbest_temperature:.1f}")
+            candidates, token_usage = self.model.generate_n(prompt, self._nbest_n, **generate_kwargs)
+            raw_response, nbest = self._rank_candidates(candidates, partial(parse_response, self.agent_mode))
+        else:
+            raw_response, token_usage = self.model.generate(prompt, **generate_kwargs)
         t_inference = time.perf_counter() - t0
+        trace.complete("inference", t0, t0 + t_inference)
 
         annotation_text = raw_response
         if "pass1_raw" in token_usage:
@@ -1232,9 +1606,13 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
                 annotation_text += f"\n\n=== PASS 2 ===\n{token_usage['pass2_raw']}"
             if token_usage.get("pass3_summary"):
                 annotation_text += f"\n\n=== PASS 3 ===\n{token_usage['pass3_summary']}"
+        if nbest is not None:
+            annotation_text += "\n\n=== N-BEST ===\n" + "\n".join(
+                f"{'*' if i == nbest['chosen'] else ' '} {c['status']} {c['logprob']:.3f} {c['action']}"
+                for i, c in enumerate(nbest["candidates"]))
 
-        img_annotated = _annotate_thinking(mode_img, annotation_text)
-        img_annotated.save(image_path)
+        image_path = self._persist_artifact(mode_img, image_path, annotation_text,
+                                            token_usage.get("summary_future"))
 
         prompt_tokens = token_usage.get("prompt_tokens", 0)
         completion_tokens = token_usage.get("completion_tokens", 0)
@@ -1262,10 +1640,11 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
         if result is None:
             print(f"  [step {self._step_count}] WARNING: could not parse response, retrying")
             print("  Raw response was:", repr(raw_response))
-            self._history.append({"summary": "Parse error, retrying", "action": {"action": "noop"}, "image_path": image_path})
+            self._append_history({"summary": "Parse error, retrying", "action": {"action": "noop"}, "image_path": image_path}, mode_img)
             t_step_total = time.perf_counter() - t_step_start
             return base_agent.AgentInteractionResult(done=False, data={
                 "step": self._step_count,
+                "parse_error": True,
                 "latency": self._build_latency_dict(t_screenshot, t_preprocess, t_prompt, t_inference, 0.0, t_step_total, token_usage),
             })
 
@@ -1274,6 +1653,7 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
 
         # 7. execute action
         t0 = time.perf_counter()
+        action_error = None
         if not is_done:
             try:
                 if parsed_action["action"] == "tap_raw":
@@ -1327,19 +1707,32 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
                     aw_action = _action_to_aw(parsed_action, elem_list=self._elem_list)
                     self._env.execute_action(aw_action)
             except Exception as e:
-                print(f"[step {self._step_count}] WARNING executing (continuing): {e}")
+                action_error = f"{type(e).__name__}: {e}"
+                print(f"[step {self._step_count}] WARNING executing (continuing): {action_error}")
         t_action = time.perf_counter() - t0
+        trace.complete("action", t0, t0 + t_action)
+
+        raw_hit = None
+        if parsed_action["action"] == "tap_raw":
+            # which UI element the tap landed on, resolved outside the timed action
+            # (raw/grid mode don't keep a labeled list). The store is MIN_DIST-deduplicated,
+            # so a tap on a dropped child reports its kept neighbour, or nothing.
+            x, y = int(parsed_action["x"] * SCREEN_W), int(parsed_action["y"] * SCREEN_H)
+            hit_store = self._elem_list or _process_aw_ui_elements(state.ui_elements)
+            hit = hit_store.hit(x, y)
+            if hit is not None:
+                elem = hit_store[hit - 1]
+                raw_hit = {"uid": elem.uid, "text": elem.text, "content_desc": elem.content_desc}
+                print(f"[aw_adapter] raw tap landed on {elem.text or elem.content_desc or elem.uid!r}")
         t_step_total = time.perf_counter() - t_step_start
 
-        summary_val = token_usage.get("pass3_summary") or result.get("summary")
-        if not summary_val:
-            summary_val = raw_response[:100]
+        summary_val = _history_summary(result, raw_response, token_usage)
         # 8. update history
-        self._history.append({
+        self._append_history({
             "summary": summary_val,
             "action": parsed_action,
             "image_path": image_path,
-        })
+        }, mode_img, summary_future=token_usage.get("summary_future"))
 
         return base_agent.AgentInteractionResult(
             done=is_done,
@@ -1354,6 +1747,9 @@ class AWAgentAdapter(base_agent.EnvironmentInteractingAgent):
                 "n_elements": len(self._elem_list),
                 "screen_diff": round(screen_diff, 4),
                 "stall_count": self._stall_count,
+                **({"nbest": nbest} if nbest is not None else {}),
+                **({"raw_hit": raw_hit} if raw_hit is not None else {}),
+                **({"action_error": action_error} if action_error else {}),
             },
         )
 
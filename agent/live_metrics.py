@@ -0,0 +1,159 @@
+"""
+Live Prometheus metrics for long benchmark runs (stdlib only).
+
+`run_aw_benchmark.py --metrics_port 9400` serves GET /metrics in the Prometheus text
+format while the run is in progress, fed from the same step records that end up in
+results.json. Useful queries:
+
+    rate(aw_bench_steps_total[10m]) * 60                     # steps per minute
+    histogram_quantile(0.9, rate(aw_bench_step_phase_seconds_bucket{phase="inference"}[30m]))
+    rate(aw_bench_tokens_total{kind="completion"}[5m])
+      / rate(aw_bench_decode_seconds_total[5m])              # decode tokens/s
+    time() - aw_bench_last_step_timestamp_seconds > 300      # stuck emulator
+"""
+
+import threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0)
+
+# name -> (type, help)
+_METRICS = {
+    "aw_bench_tasks_total":                ("counter", "Finished task episodes by outcome (success, failure, skipped)."),
+    "aw_bench_steps_total":                ("counter", "Agent steps that returned a record."),
+    "aw_bench_step_crashes_total":         ("counter", "Steps that raised inside the benchmark loop."),
+    "aw_bench_parse_failures_total":       ("counter", "Model responses that could not be parsed into an action."),
+    "aw_bench_stall_terminations_total":   ("counter", "Episodes ended by STALL_ACTION=terminate."),
+    "aw_bench_env_reset_retries_total":    ("counter", "env.reset attempts that failed and were retried."),
+    "aw_bench_adb_reconnects_total":       ("counter", "`adb reconnect` calls issued by the benchmark."),
+    "aw_bench_tokens_total":               ("counter", "Model tokens by kind (prompt, completion, cached)."),
+    "aw_bench_decode_seconds_total":       ("counter", "Client-observed decode time; divide token rates by its rate."),
+    "aw_bench_step_phase_seconds":         ("histogram", "Per-step latency by phase (the step record's latency dict)."),
+    "aw_bench_tasks_remaining":            ("gauge", "Task episodes not yet started or finished."),
+    "aw_bench_running_accuracy":           ("gauge", "Successes / finished episodes so far."),
+    "aw_bench_current_task_step":          ("gauge", "Step index within the running episode, labelled by task."),
+    "aw_bench_decode_tokens_per_second":   ("gauge", "completion_tokens / decode_s of the last step."),
+    "aw_bench_last_step_timestamp_seconds": ("gauge", "Unix time the last step record arrived."),
+}
+
+# latency-dict keys exported as aw_bench_step_phase_seconds{phase=...}
+_PHASES = ("screenshot_s", "preprocess_s", "prompt_s", "inference_s", "action_s", "step_total_s", "ttft_s", "decode_s")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items())) + "}"
+
+
+class LiveMetrics:
+    """In-process metric registry with a /metrics endpoint on a daemon thread."""
+
+    def __init__(self, port: int, host: str = "0.0.0.0"):
+        self._lock = threading.Lock()
+        # name -> {label tuple: value | histogram state}
+        self._values: dict[str, dict[tuple, object]] = {name: {} for name in _METRICS}
+        # counters start at 0 so rate()/increase() see their first increment
+        for name, (kind, _) in _METRICS.items():
+            if kind == "counter":
+                self._values[name][()] = 0
+        self._values["aw_bench_tasks_total"] = {(("outcome", o),): 0 for o in ("success", "failure", "skipped")}
+        self._values["aw_bench_tokens_total"] = {(("kind", k),): 0 for k in ("prompt", "completion", "cached")}
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, fmt, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="live_metrics", daemon=True).start()
+        print(f"[live_metrics] serving http://{host}:{port}/metrics")
+
+    # ── Primitives ───────────────────────────────────────────────────
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            hist = self._values[name].setdefault(key, {"buckets": [0] * len(_BUCKETS), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(_BUCKETS):
+                if value <= bound:
+                    hist["buckets"][i] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in _METRICS.items():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                for key, value in self._values[name].items():
+                    labels = dict(key)
+                    if kind != "histogram":
+                        lines.append(f"{name}{_labels(labels)} {value}")
+                        continue
+                    for bound, count in zip(_BUCKETS, value["buckets"]):
+                        lines.append(f"{name}_bucket{_labels({**labels, 'le': bound})} {count}")
+                    lines += [f"{name}_bucket{_labels({**labels, 'le': '+Inf'})} {value['count']}",
+                              f"{name}_sum{_labels(labels)} {value['sum']}",
+                              f"{name}_count{_labels(labels)} {value['count']}"]
+        return "\n".join(lines) + "\n"
+
+    # ── Benchmark feed ───────────────────────────────────────────────
+
+    def step(self, task: str, data: dict) -> None:
+        """One step record (the `response.data` appended to step_records)."""
+        latency = data.get("latency", {})
+        self.inc("aw_bench_steps_total")
+        for key in _PHASES:
+            if key in latency:
+                self.observe("aw_bench_step_phase_seconds", latency[key], phase=key[:-2])
+        for kind in ("prompt", "completion", "cached"):
+            self.inc("aw_bench_tokens_total", latency.get(f"{kind}_tokens", 0), kind=kind)
+        self.inc("aw_bench_decode_seconds_total", latency.get("decode_s", 0.0))
+        if latency.get("decode_s"):
+            self.set("aw_bench_decode_tokens_per_second",
+                     round(latency.get("completion_tokens", 0) / latency["decode_s"], 2))
+        if data.get("parse_error"):
+            self.inc("aw_bench_parse_failures_total")
+        if data.get("stall_terminated"):
+            self.inc("aw_bench_stall_terminations_total")
+        with self._lock:
+            self._values["aw_bench_current_task_step"].clear()
+        self.set("aw_bench_current_task_step", data.get("step", 0), task=task)
+        self.set("aw_bench_last_step_timestamp_seconds", round(time.time(), 3))
+
+    def task_finished(self, outcome: str, n_success: int, n_done: int, n_remaining: int) -> None:
+        self.inc("aw_bench_tasks_total", outcome=outcome)
+        self.set("aw_bench_running_accuracy", round(n_success / n_done, 4) if n_done else 0.0)
+        self.set("aw_bench_tasks_remaining", n_remaining)
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
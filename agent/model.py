@@ -1,20 +1,263 @@
-import json, base64, os, re, time as _time
+import asyncio, contextvars, json, base64, hashlib, io, os, re, threading, time as _time, urllib.request, uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import ContextVar
+from dataclasses import dataclass, replace
+from functools import partial, wraps
 from pathlib import Path
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+import numpy as np
+from PIL import Image
 try:
     import google.genai as genai
     import google.genai.types as types
     _GOOGLE_GENAI_AVAILABLE = True
 except ImportError:
     _GOOGLE_GENAI_AVAILABLE = False
-from openai import OpenAI
+from openai import APIConnectionError, AsyncOpenAI, OpenAI
+
+from . import trace
+
+
+class ImageCache:
+    """
+    Bounded LRU of encoded image payloads (data URLs, Gemini Parts), shared by every
+    backend in the process.
 
+    ICL examples and history frames are re-sent on every step, so without this the
+    read + base64 work grows quadratically over an episode. Entries are keyed by
+    (kind, abspath, mtime_ns, size): a file that is overwritten in place (e.g. the
+    annotated step_XXX.png) gets a new key instead of a stale payload.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, tuple[object, int]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def configure(self, max_entries: int | None = None, max_bytes: int | None = None) -> None:
+        with self._lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            self._evict()
+
+    def get_or_create(self, key: tuple, factory):
+        """Return the cached value for *key*, or store `factory()` -> (value, nbytes)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        value, nbytes = factory()
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (value, nbytes)
+                self._bytes += nbytes
+                self._evict()
+        return value
+
+    def _evict(self) -> None:
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self._bytes -= nbytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self._entries), "bytes": self._bytes}
+
+
+IMAGE_CACHE = ImageCache()
+
+
+# An image handed to the model layer: a file path, a PIL image, an (H, W, C) uint8
+# array, or already-encoded PNG/JPEG/WebP bytes. In-memory inputs let the adapter
+# start inference without writing the frame to disk first.
+ImageInput = str | os.PathLike | Image.Image | np.ndarray | bytes
+
+
+def _file_key(image_path: str) -> tuple:
+    st = os.stat(image_path)
+    return (os.path.abspath(image_path), st.st_mtime_ns, st.st_size)
+
+
+def _digest(data) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _image_key(image: ImageInput) -> tuple:
+    """Cache key: path+mtime for files, content hash for in-memory images."""
+    if isinstance(image, (str, os.PathLike)):
+        return ("file", *_file_key(image))
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return ("bytes", _digest(image))
+    if isinstance(image, Image.Image):
+        return ("pil", image.mode, image.size, _digest(image.tobytes()))
+    arr = np.ascontiguousarray(image)
+    return ("ndarray", arr.dtype.str, arr.shape, _digest(arr.data))
+
+
+def _sniff_mime(data: bytes) -> str:
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/png"
+
+
+@dataclass(frozen=True)
+class ImageTransport:
+    """
+    How frames are encoded on the wire.
 
-def _image_part_gemini(image_path: str) -> types.Part:
-    return types.Part.from_bytes(data=Path(image_path).read_bytes(), mime_type="image/png")
+    format:     "png" | "jpeg" | "webp"
+    quality:    JPEG/WebP quality (ignored for PNG)
+    max_pixels: downscale (aspect-preserving) so width*height <= max_pixels, in the
+                style of Qwen's `max_pixels`; None sends full resolution.
+    url:        "data" inlines base64 data URLs; "file" writes each frame once into
+                media_dir and sends a file:// URL (vLLM --allowed-local-media-path).
 
-def _image_content(image_path: str) -> dict:
-    img_b64 = base64.b64encode(Path(image_path).read_bytes()).decode() # encode image
-    return {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{img_b64}"}}
+    The default (PNG, no resize) sends already-encoded PNG files/bytes untouched.
+    """
+    format: str = "png"
+    quality: int = 90
+    max_pixels: int | None = None
+    url: str = "data"
+    media_dir: str | None = None
+
+    @classmethod
+    def from_config(cls, cfg: dict | None) -> "ImageTransport":
+        """Build from a config.yaml IMAGE_TRANSPORT entry, e.g. {format: jpeg, quality: 85}."""
+        cfg = cfg or {}
+        media_dir = cfg.get("media_dir")
+        return cls(
+            format=str(cfg.get("format", "png")).lower(),
+            quality=int(cfg.get("quality", 90)),
+            max_pixels=cfg.get("max_pixels"),
+            url=str(cfg.get("url", "data")).lower(),
+            media_dir=os.path.abspath(media_dir) if media_dir else None,
+        )
+
+    def for_endpoint(self, base_url: str | list[str]) -> "ImageTransport":
+        """file:// URLs only work against servers on this host; fall back to data URLs otherwise."""
+        if self.url != "file":
+            return self
+        if not self.media_dir:
+            print("[model] IMAGE_URL_MODE=file needs IMAGE_MEDIA_DIR; using data URLs")
+            return replace(self, url="data")
+        remote = [url for url in _base_urls(base_url) if urlparse(url).hostname not in _LOCAL_HOSTS]
+        if remote:
+            print(f"[model] {', '.join(remote)} not local; using data URLs instead of file://")
+            return replace(self, url="data")
+        return self
+
+
+PNG_PASSTHROUGH = ImageTransport()
+
+_LOCAL_HOSTS = {"127.0.0.1", "localhost", "::1", "0.0.0.0"}
+
+_PIL_FORMATS = {"png": ("PNG", "image/png"), "jpeg": ("JPEG", "image/jpeg"),
+                "jpg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+
+
+def encode_image(image: ImageInput, transport: ImageTransport = PNG_PASSTHROUGH) -> tuple[bytes, str]:
+    """Return (encoded_bytes, mime_type) for any ImageInput under *transport*."""
+    if transport.format not in _PIL_FORMATS:
+        raise ValueError(f"Unknown image transport format: {transport.format!r}")
+    if transport.format == "png" and transport.max_pixels is None:
+        if isinstance(image, (str, os.PathLike)):
+            return Path(image).read_bytes(), "image/png"
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            data = bytes(image)
+            return data, _sniff_mime(data)
+
+    if isinstance(image, (str, os.PathLike)):
+        image = Image.open(image)
+    elif isinstance(image, (bytes, bytearray, memoryview)):
+        image = Image.open(io.BytesIO(image))
+    elif not isinstance(image, Image.Image):
+        image = Image.fromarray(np.asarray(image))
+
+    w, h = image.size
+    if transport.max_pixels and w * h > transport.max_pixels:
+        scale = (transport.max_pixels / (w * h)) ** 0.5
+        image = image.resize((max(1, int(w * scale)), max(1, int(h * scale))), Image.LANCZOS)
+
+    pil_format, mime = _PIL_FORMATS[transport.format]
+    buf = io.BytesIO()
+    if pil_format == "PNG":
+        image.save(buf, format="PNG")
+    else:
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(buf, format=pil_format, quality=transport.quality)
+    return buf.getvalue(), mime
+
+
+def _history_image(h: dict) -> ImageInput | None:
+    """The frame attached to a history entry: in-memory `image` first, else an existing `image_path`."""
+    if h.get("image") is not None:
+        return h["image"]
+    img_p = h.get("image_path")
+    if img_p and os.path.exists(img_p):
+        return img_p
+    return None
+
+
+def _image_part_gemini(image: ImageInput, transport: ImageTransport = PNG_PASSTHROUGH) -> "types.Part":
+    def encode():
+        data, mime = encode_image(image, transport)
+        return types.Part.from_bytes(data=data, mime_type=mime), len(data)
+    return IMAGE_CACHE.get_or_create(("gemini_part", transport, *_image_key(image)), encode)
+
+def image_data_url(image: ImageInput, transport: ImageTransport = PNG_PASSTHROUGH) -> str:
+    """Cached `data:<mime>;base64,...` URL for *image* encoded under *transport*."""
+    def encode():
+        data, mime = encode_image(image, transport)
+        img_b64 = base64.b64encode(data).decode() # encode image
+        url = f"data:{mime};base64,{img_b64}"
+        return url, len(url)
+    return IMAGE_CACHE.get_or_create(("data_url", transport, *_image_key(image)), encode)
+
+def image_file_url(image: ImageInput, transport: ImageTransport) -> str:
+    """
+    Cached file:// URL for *image*: encoded once and written content-addressed into
+    transport.media_dir, so every pass (and every later step) re-sends only the path.
+    """
+    def write():
+        data, mime = encode_image(image, transport)
+        os.makedirs(transport.media_dir, exist_ok=True)
+        path = os.path.join(transport.media_dir, f"{_digest(data)}.{mime.split('/')[1]}")
+        if not os.path.exists(path):
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)  # atomic: the server never sees a partial file
+        url = Path(path).as_uri()
+        return url, len(url)
+    return IMAGE_CACHE.get_or_create(("file_url", transport, *_image_key(image)), write)
+
+def _image_content(image: ImageInput, transport: ImageTransport = PNG_PASSTHROUGH) -> dict:
+    if transport.url == "file":
+        url = image_file_url(image, transport)
+    else:
+        url = image_data_url(image, transport)
+    return {"type": "image_url", "image_url": {"url": url}}
 
 def _format_action(ex: dict) -> str:
     reasoning = ex.get("reasoning", "")
@@ -22,31 +265,497 @@ def _format_action(ex: dict) -> str:
     return f"{reasoning}\n{action_json}" if reasoning else action_json
 
 
+def _stream_usage(usage_data, t_request_start: float, t_first_token: float | None, t_end: float) -> dict:
+    """Build the (unrounded) usage dict shared by every streaming backend."""
+    ttft = (t_first_token - t_request_start) if t_first_token else 0.0
+    decode_s = (t_end - t_first_token) if t_first_token else 0.0
+
+    prompt_tokens = getattr(usage_data, "prompt_tokens", 0) or 0 if usage_data else 0
+    completion_tokens = getattr(usage_data, "completion_tokens", 0) or 0 if usage_data else 0
+    tpot = (decode_s / completion_tokens) if completion_tokens > 0 else 0.0
+    # prefix-cache hits; vLLM only reports them with --enable-prompt-tokens-details
+    details = getattr(usage_data, "prompt_tokens_details", None) if usage_data else None
+    cached_tokens = getattr(details, "cached_tokens", 0) or 0 if details else 0
+
+    if t_first_token:
+        # client-observed phases: queueing + ViT + prefill, then decode
+        if t_first_token > t_request_start:
+            trace.complete("ttft", t_request_start, t_first_token, "model",
+                           prompt_tokens=prompt_tokens, cached_tokens=cached_tokens)
+        trace.complete("decode", t_first_token, t_end, "model", completion_tokens=completion_tokens)
+
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "cached_tokens": cached_tokens,
+        "ttft_s": ttft,
+        "decode_s": decode_s,
+        "tpot_s": tpot,
+    }
+
+
+def _consume_stream(
+    stream, t_request_start: float, action_parser=None, tail_pool: ThreadPoolExecutor | None = None,
+) -> tuple[str, dict]:
+    """
+    Read a streaming chat completion and collect (text, usage_dict).
+
+    With an `action_parser` (parse.StreamingActionParser) reading stops as soon as it
+    yields a complete action, and usage["early_stopped"] is set. The rest of the decode
+    is then aborted by closing the stream or, with a `tail_pool`, drained on that pool:
+    usage["summary_future"] resolves to (summary, tail_usage).
+    """
+    full_text = ""
+    t_first_token: float | None = None
+    usage_data = None
+
+    chunks = iter(stream)
+    for chunk in chunks:
+        # usage comes in the last chunk when stream_options include_usage=True
+        # (and in every chunk with continuous_usage_stats)
+        if hasattr(chunk, "usage") and chunk.usage is not None:
+            usage_data = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            if t_first_token is None:
+                t_first_token = _time.perf_counter()
+            delta = chunk.choices[0].delta.content
+            full_text += delta
+            if action_parser is not None and action_parser.feed(delta) is not None:
+                break
+    else:
+        return full_text, _stream_usage(usage_data, t_request_start, t_first_token, _time.perf_counter())
+
+    usage = _stream_usage(usage_data, t_request_start, t_first_token, _time.perf_counter())
+    usage["early_stopped"] = True
+    if tail_pool is None:
+        stream.close()  # drops the connection; vLLM aborts the request
+    else:
+        usage["summary_future"] = tail_pool.submit(_drain_tail, chunks, full_text, usage, action_parser)
+    return full_text, usage
+
+
+def _drain_tail(chunks, head_text: str, head_usage: dict, action_parser) -> tuple[str, dict]:
+    """Finish a stream `_consume_stream` left early; returns (summary, tail-only usage)."""
+    t_start = _time.perf_counter()
+    full_text = head_text
+    usage_data = None
+    for chunk in chunks:
+        if hasattr(chunk, "usage") and chunk.usage is not None:
+            usage_data = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            full_text += chunk.choices[0].delta.content
+    total = _stream_usage(usage_data, t_start, t_start, _time.perf_counter())
+    prompt_tokens = total["prompt_tokens"] - head_usage["prompt_tokens"] if usage_data else 0
+    completion_tokens = total["completion_tokens"] - head_usage["completion_tokens"] if usage_data else 0
+    tail_usage = dict(
+        total,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+        cached_tokens=0,
+    )
+    return action_parser.summary(full_text), tail_usage
+
+
+async def _aconsume_stream(stream, t_request_start: float, action_parser=None) -> tuple[str, dict]:
+    """
+    Async twin of `_consume_stream` for AsyncOpenAI streams. An early stop always
+    closes the stream: a background tail would not outlive the caller's event loop.
+    """
+    full_text = ""
+    t_first_token: float | None = None
+    usage_data = None
+
+    async for chunk in stream:
+        if hasattr(chunk, "usage") and chunk.usage is not None:
+            usage_data = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+            if t_first_token is None:
+                t_first_token = _time.perf_counter()
+            delta = chunk.choices[0].delta.content
+            full_text += delta
+            if action_parser is not None and action_parser.feed(delta) is not None:
+                break
+    else:
+        return full_text, _stream_usage(usage_data, t_request_start, t_first_token, _time.perf_counter())
+
+    usage = _stream_usage(usage_data, t_request_start, t_first_token, _time.perf_counter())
+    usage["early_stopped"] = True
+    await stream.close()
+    return full_text, usage
+
+
+def _consume_n_stream(stream, t_request_start: float, n: int) -> tuple[list[tuple[str, float]], dict]:
+    """
+    Read a streaming chat completion requested with n=`n`, logprobs=True.
+    Returns ([(text, mean_token_logprob), ...] in choice order, usage_dict);
+    a choice that produced no tokens scores -inf.
+    """
+    texts = [""] * n
+    logprob_sums = [0.0] * n
+    token_counts = [0] * n
+    t_first_token: float | None = None
+    usage_data = None
+
+    for chunk in stream:
+        if hasattr(chunk, "usage") and chunk.usage is not None:
+            usage_data = chunk.usage
+        for choice in chunk.choices or ():
+            if choice.delta.content:
+                if t_first_token is None:
+                    t_first_token = _time.perf_counter()
+                texts[choice.index] += choice.delta.content
+            logprobs = getattr(choice, "logprobs", None)
+            for token in (logprobs.content or ()) if logprobs is not None else ():
+                logprob_sums[choice.index] += token.logprob
+                token_counts[choice.index] += 1
+
+    candidates = [
+        (text, total / count if count else float("-inf"))
+        for text, total, count in zip(texts, logprob_sums, token_counts)
+    ]
+    return candidates, _stream_usage(usage_data, t_request_start, t_first_token, _time.perf_counter())
+
+
+def _guided_body(guided_decoding: str, regex: str | None) -> dict:
+    """
+    extra_body entries constraining the decode to `regex`. vLLM spells this
+    `guided_regex` (<= 0.10) or `structured_outputs.regex` (newer releases).
+    """
+    if regex is None or guided_decoding == "off":
+        return {}
+    if guided_decoding == "guided_regex":
+        return {"guided_regex": regex}
+    if guided_decoding == "structured_outputs":
+        return {"structured_outputs": {"regex": regex}}
+    raise ValueError(
+        f"guided_decoding must be 'off', 'guided_regex' or 'structured_outputs', got {guided_decoding!r}")
+
+
+def _early_action_options(early_action: str) -> ThreadPoolExecutor | None:
+    """Validate an EARLY_ACTION setting; returns the tail-draining pool for "background"."""
+    if early_action not in ("off", "cancel", "background"):
+        raise ValueError(f"early_action must be 'off', 'cancel' or 'background', got {early_action!r}")
+    if early_action == "background":
+        return ThreadPoolExecutor(max_workers=2, thread_name_prefix="stream-tail")
+    return None
+
+
+def _check_layout(prompt_layout: str) -> str:
+    if prompt_layout not in ("default", "prefix"):
+        raise ValueError(f"prompt_layout must be 'default' or 'prefix', got {prompt_layout!r}")
+    return prompt_layout
+
+
+class SplitPrompt(str):
+    """
+    A prompt for the "prefix" layout: a `head` shared across steps (system prompt, task,
+    older history) and a per-step `tail` (element list, stall warning, step counter),
+    with the history frames sent between them. `first_step` numbers the first frame.
+    As a str it is head + tail, for backends and caches that don't split it.
+    """
+
+    def __new__(cls, head: str, tail: str, first_step: int = 1):
+        prompt = super().__new__(cls, head + tail)
+        prompt.head, prompt.tail, prompt.first_step = head, tail, first_step
+        return prompt
+
+
+def _round_usage(usage: dict) -> dict:
+    return dict(
+        usage,
+        ttft_s=round(usage["ttft_s"], 4),
+        decode_s=round(usage["decode_s"], 4),
+        tpot_s=round(usage["tpot_s"], 4),
+    )
+
+
+# Requests made while this is set stick to one endpoint of an EndpointRouter, so an
+# episode's growing prompt prefix keeps hitting the same server's prefix cache.
+_AFFINITY: ContextVar[str | None] = ContextVar("endpoint_affinity", default=None)
+
+
+def set_request_affinity(key: str | None) -> None:
+    """Pin subsequent requests in this context (thread / asyncio task) to one endpoint per `key`."""
+    _AFFINITY.set(key)
+
+
+def _pin_passes(fn):
+    """Keep every request of one multi-pass call on one endpoint, even without an episode affinity."""
+    if asyncio.iscoroutinefunction(fn):
+        @wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            token = _AFFINITY.set(_AFFINITY.get() or f"call-{uuid.uuid4().hex}")
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                _AFFINITY.reset(token)
+        return async_wrapper
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _AFFINITY.set(_AFFINITY.get() or f"call-{uuid.uuid4().hex}")
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _AFFINITY.reset(token)
+    return wrapper
+
+
+def _submit(pool: ThreadPoolExecutor, fn, *args) -> Future:
+    """pool.submit that carries the caller's endpoint affinity onto the worker thread."""
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+async def _acancel(task: asyncio.Task | None) -> None:
+    """Cancel a background task whose result is no longer wanted and wait for it to unwind."""
+    if task is None or task.done():
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+@dataclass(eq=False)
+class _Endpoint:
+    base_url: str
+    client: OpenAI
+    aclient: AsyncOpenAI | None = None
+    healthy: bool = True
+    outstanding: int = 0
+    requests: int = 0
+    failures: int = 0
+
+
+class _LeasedStream:
+    """A streaming response that releases its endpoint lease when exhausted or closed."""
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    def _done(self) -> None:
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        finally:
+            self._done()
+
+    def close(self) -> None:
+        self._stream.close()
+        self._done()
+
+
+class _LeasedAsyncStream(_LeasedStream):
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        finally:
+            self._done()
+
+    async def close(self) -> None:
+        await self._stream.close()
+        self._done()
+
+
+class EndpointRouter:
+    """
+    Spreads chat completions over several OpenAI-compatible (vLLM) endpoints.
+
+    Each request goes to the healthy endpoint with the fewest outstanding requests,
+    unless its context carries an affinity key (`set_request_affinity`, or the
+    per-call pin of the dynamic-LoRA passes): then the endpoint picked for the key's
+    first request is reused while it stays healthy. A connection failure marks the
+    endpoint down and retries the request elsewhere; a background thread polls each
+    server's /health and brings endpoints back.
+
+    `router.chat.completions.create` and `router.async_client().chat.completions.create`
+    stand in for the OpenAI clients' methods. Routers are shared per endpoint list
+    (`EndpointRouter.shared`) so the agent and oracle models see each other's load.
+    """
+
+    MAX_PINS = 4096
+    _shared: dict[tuple, "EndpointRouter"] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, api_key: str, base_urls: list[str], health_interval_s: float = 10.0):
+        # max_retries=0: the SDK would otherwise back off and retry the same dead server
+        # before the APIConnectionError reaches the failover below
+        self.endpoints = [_Endpoint(url, OpenAI(api_key=api_key, base_url=url, max_retries=0)) for url in base_urls]
+        self._api_key = api_key
+        self._pins: OrderedDict[str, _Endpoint] = OrderedDict()
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+        self._async = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=self._acreate)))
+        self._health_interval_s = health_interval_s
+        if health_interval_s > 0:
+            threading.Thread(target=self._health_loop, name="endpoint-health", daemon=True).start()
+        print(f"[router] {len(base_urls)} endpoints: {', '.join(base_urls)}")
+
+    @classmethod
+    def shared(cls, api_key: str, base_urls: list[str]) -> "EndpointRouter":
+        key = (api_key, tuple(base_urls))
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(api_key, base_urls)
+            return cls._shared[key]
+
+    def async_client(self):
+        return self._async
+
+    def stats(self) -> list[dict]:
+        with self._lock:
+            return [{"base_url": e.base_url, "healthy": e.healthy, "outstanding": e.outstanding,
+                     "requests": e.requests, "failures": e.failures} for e in self.endpoints]
+
+    # ── Dispatch ─────────────────────────────────────────────────────
+
+    def _acquire(self, exclude: set) -> _Endpoint:
+        key = _AFFINITY.get()
+        with self._lock:
+            ep = self._pins.get(key) if key else None
+            if ep is None or not ep.healthy or ep in exclude:
+                candidates = [e for e in self.endpoints if e.healthy and e not in exclude]
+                # all marked down: try the rest anyway rather than fail without a request
+                candidates = candidates or [e for e in self.endpoints if e not in exclude]
+                if not candidates:
+                    raise APIConnectionError(request=None, message="no vLLM endpoint reachable")
+                ep = min(candidates, key=lambda e: (e.outstanding, e.requests))
+                if key:
+                    self._pins[key] = ep
+            if key:
+                self._pins.move_to_end(key)
+                while len(self._pins) > self.MAX_PINS:
+                    self._pins.popitem(last=False)
+            ep.outstanding += 1
+            ep.requests += 1
+            return ep
+
+    def _release(self, ep: _Endpoint) -> None:
+        with self._lock:
+            ep.outstanding -= 1
+
+    def _mark_down(self, ep: _Endpoint, error: Exception) -> None:
+        with self._lock:
+            ep.failures += 1
+            was_healthy, ep.healthy = ep.healthy, False
+        if was_healthy:
+            print(f"[router] {ep.base_url} marked down ({error}); failing over")
+
+    def _create(self, **kwargs):
+        tried: set = set()
+        while True:
+            ep = self._acquire(tried)
+            try:
+                response = ep.client.chat.completions.create(**kwargs)
+            except APIConnectionError as e:
+                self._release(ep)
+                self._mark_down(ep, e)
+                tried.add(ep)
+                if len(tried) == len(self.endpoints):
+                    raise
+                continue
+            except Exception:
+                self._release(ep)
+                raise
+            if kwargs.get("stream"):
+                return _LeasedStream(response, partial(self._release, ep))
+            self._release(ep)
+            return response
+
+    async def _acreate(self, **kwargs):
+        tried: set = set()
+        while True:
+            ep = self._acquire(tried)
+            if ep.aclient is None:
+                ep.aclient = AsyncOpenAI(api_key=self._api_key, base_url=ep.base_url, max_retries=0)
+            try:
+                response = await ep.aclient.chat.completions.create(**kwargs)
+            except APIConnectionError as e:
+                self._release(ep)
+                self._mark_down(ep, e)
+                tried.add(ep)
+                if len(tried) == len(self.endpoints):
+                    raise
+                continue
+            except Exception:
+                self._release(ep)
+                raise
+            if kwargs.get("stream"):
+                return _LeasedAsyncStream(response, partial(self._release, ep))
+            self._release(ep)
+            return response
+
+    # ── Health ───────────────────────────────────────────────────────
+
+    @staticmethod
+    def _health_url(base_url: str) -> str:
+        # vLLM serves /health at the server root, next to /v1
+        root = base_url.rstrip("/")
+        return (root[:-3] if root.endswith("/v1") else root) + "/health"
+
+    def _health_loop(self) -> None:
+        while True:
+            _time.sleep(self._health_interval_s)
+            for ep in self.endpoints:
+                try:
+                    with urllib.request.urlopen(self._health_url(ep.base_url), timeout=2) as resp:
+                        ok = resp.status == 200
+                except Exception:
+                    ok = False
+                with self._lock:
+                    changed, ep.healthy = ep.healthy != ok, ok
+                if changed:
+                    print(f"[router] {ep.base_url} {'back up' if ok else 'failed health check'}")
+
+
+def _base_urls(base_url: str | list[str]) -> list[str]:
+    return [base_url] if isinstance(base_url, str) else list(base_url)
+
+
+def _openai_clients(api_key: str, base_url: str | list[str]):
+    """(sync client, async client factory) for one endpoint, or a shared router for several."""
+    urls = _base_urls(base_url)
+    if len(urls) == 1:
+        return OpenAI(api_key=api_key, base_url=urls[0]), lambda: AsyncOpenAI(api_key=api_key, base_url=urls[0])
+    router = EndpointRouter.shared(api_key, urls)
+    return router, router.async_client
+
+
 class GeminiModel:
-    def __init__(self, api_key: str, model_name: str = "gemini-2.0-flash"):
+    def __init__(
+        self,
+        api_key: str,
+        model_name: str = "gemini-2.0-flash",
+        image_transport: ImageTransport | None = None,
+    ):
         if not _GOOGLE_GENAI_AVAILABLE:
             raise ImportError(
                 "google-genai is not installed. Install it with: pip install google-genai"
             )
         self.client = genai.Client(api_key=api_key)
         self.model_name = model_name
+        self.image_transport = image_transport or PNG_PASSTHROUGH
 
-    def generate(
+    def _build_request(
         self,
         prompt: str,
-        image_path: str = None,
-        history: list[dict] = None,
-        examples: list[dict] = None,
-        temperature: float | None = None,
-        enable_thinking: bool = False,
-        thinking_budget: int | None = None,
-        max_tokens: int | None = None,
-    ) -> tuple[str, dict]:
-        """
-        Send a prompt to Gemini and return (text, usage) where
-        usage = {prompt_tokens, completion_tokens, total_tokens, ttft_s, decode_s, tpot_s}
-        Note: Gemini SDK does not expose per-request TTFT/TPOT, so those are 0.
-        """
+        image_path: ImageInput | None,
+        history: list[dict] | None,
+        examples: list[dict] | None,
+        temperature: float | None,
+        thinking_budget: int | None,
+        max_tokens: int | None,
+    ) -> dict:
+        """Build the generate_content kwargs shared by `generate` and `agenerate`."""
         parts: list[types.Part] = []
 
         # ICL examples
@@ -58,7 +767,7 @@ class GeminiModel:
                     f"Screenshot (with coordinate grid):"
                 )
                 parts.append(types.Part.from_text(text=header))
-                parts.append(_image_part_gemini(ex["screenshot"]))
+                parts.append(_image_part_gemini(ex["screenshot"], self.image_transport))
                 parts.append(types.Part.from_text(text=_format_action(ex)))
 
             parts.append(types.Part.from_text(text="=== YOUR TURN ==="))
@@ -68,9 +777,9 @@ class GeminiModel:
             parts.append(types.Part.from_text(text="History of previous steps:"))
             for i, h in enumerate(history):
                 parts.append(types.Part.from_text(text=f"Step {i + 1}:"))
-                img_p = h.get("image_path")
-                if img_p and os.path.exists(img_p):
-                    parts.append(_image_part_gemini(img_p))
+                img_h = _history_image(h)
+                if img_h is not None:
+                    parts.append(_image_part_gemini(img_h, self.image_transport))
 
                 summary = h.get("summary", "")
                 if summary:
@@ -79,7 +788,7 @@ class GeminiModel:
         # Current step
         parts.append(types.Part.from_text(text=prompt))
         if image_path is not None:
-            parts.append(_image_part_gemini(image_path))
+            parts.append(_image_part_gemini(image_path, self.image_transport))
 
         gen_config = {}
         if temperature is not None:
@@ -90,12 +799,14 @@ class GeminiModel:
             gen_config["thinking_config"] = types.ThinkingConfig(
                 thinking_budget=thinking_budget,
             )
-        response = self.client.models.generate_content(
+        return dict(
             model=self.model_name,
             contents=parts,
             config=types.GenerateContentConfig(**gen_config) if gen_config else None,
         )
 
+    @staticmethod
+    def _usage(response) -> dict:
         usage = {}
         if hasattr(response, "usage_metadata") and response.usage_metadata:
             meta = response.usage_metadata
@@ -105,116 +816,256 @@ class GeminiModel:
                 "prompt_tokens": prompt_tokens,
                 "completion_tokens": completion_tokens,
                 "total_tokens": prompt_tokens + completion_tokens,
+                # implicit context caching
+                "cached_tokens": getattr(meta, "cached_content_token_count", 0) or 0,
                 "ttft_s": 0.0,
                 "decode_s": 0.0,
                 "tpot_s": 0.0,
             }
+        return usage
+
+    def generate(
+        self,
+        prompt: str,
+        image_path: ImageInput = None,
+        history: list[dict] = None,
+        examples: list[dict] = None,
+        temperature: float | None = None,
+        enable_thinking: bool = False,
+        thinking_budget: int | None = None,
+        max_tokens: int | None = None,
+    ) -> tuple[str, dict]:
+        """
+        Send a prompt to Gemini and return (text, usage) where
+        usage = {prompt_tokens, completion_tokens, total_tokens, ttft_s, decode_s, tpot_s}
+        Note: Gemini SDK does not expose per-request TTFT/TPOT, so those are 0.
+        """
+        request = self._build_request(
+            prompt, image_path, history, examples, temperature, thinking_budget, max_tokens,
+        )
+        with trace.span("gemini.generate", "model", model=self.model_name):
+            response = self.client.models.generate_content(**request)
+        return response.text, self._usage(response)
 
-        return response.text, usage
+    async def agenerate(
+        self,
+        prompt: str,
+        image_path: ImageInput = None,
+        history: list[dict] = None,
+        examples: list[dict] = None,
+        temperature: float | None = None,
+        enable_thinking: bool = False,
+        thinking_budget: int | None = None,
+        max_tokens: int | None = None,
+    ) -> tuple[str, dict]:
+        """Async `generate` on the google-genai `client.aio` surface; same (text, usage) contract."""
+        request = self._build_request(
+            prompt, image_path, history, examples, temperature, thinking_budget, max_tokens,
+        )
+        with trace.span("gemini.generate", "model", model=self.model_name):
+            response = await self.client.aio.models.generate_content(**request)
+        return response.text, self._usage(response)
 
 
+@trace.traced("build_messages", "model")
 def _build_vllm_messages(
     prompt: str,
-    image_path: str | None,
+    image_path: ImageInput | None,
     history: list[dict] | None,
     examples: list[dict] | None,
+    transport: ImageTransport = PNG_PASSTHROUGH,
+    layout: str = "default",
 ) -> list[dict]:
-    """Construct the OpenAI-style multimodal messages list shared by all vLLM models."""
+    """
+    Construct the OpenAI-style multimodal messages list shared by all vLLM models.
+    `image_path` and history entries may carry in-memory images (see ImageInput);
+    every image is encoded under `transport`.
+
+    layout "default" sends the history frames as their own turn before the prompt;
+    "prefix" orders static to dynamic for prefix caching: the prompt head (see
+    SplitPrompt; a plain str is all head), the history frames with their summaries,
+    the prompt tail, then the current frame.
+    """
     messages: list[dict] = []
 
     if examples:
         for i, ex in enumerate(examples, 1):
             messages.append({"role": "user", "content": [
                 {"type": "text", "text": f"=== EXAMPLE {i} ===\nTask: {ex['task']}"},
-                _image_content(ex["screenshot"]),
+                _image_content(ex["screenshot"], transport),
             ]})
             messages.append({"role": "assistant", "content": _format_action(ex)})
         messages.append({"role": "user", "content": "=== YOUR TURN ==="})
 
+    head, tail, first_step = prompt, "", 1
+    if layout == "prefix" and isinstance(prompt, SplitPrompt):
+        head, tail, first_step = prompt.head, prompt.tail, prompt.first_step
+
+    history_content: list[dict] = []
     if history:
-        history_content = [{"type": "text", "text": "History of previous steps:"}]
+        history_content.append({"type": "text", "text": "History of previous steps:"})
         for i, h in enumerate(history):
-            history_content.append({"type": "text", "text": f"Step {i + 1}:"})
-            img_p = h.get("image_path")
-            if img_p and os.path.exists(img_p):
-                history_content.append(_image_content(img_p))
+            history_content.append({"type": "text", "text": f"Step {first_step + i}:"})
+            img_h = _history_image(h)
+            if img_h is not None:
+                history_content.append(_image_content(img_h, transport))
             summary = h.get("summary", "")
             if summary:
                 history_content.append({"type": "text", "text": f"Action taken: {summary}"})
-        messages.append({"role": "user", "content": history_content})
-
-    content = [{"type": "text", "text": prompt}]
-    if image_path:
-        content.append(_image_content(image_path))
+        if layout != "prefix":
+            messages.append({"role": "user", "content": history_content})
+
+    if layout == "prefix":
+        # everything up to the tail is shared with the next step's request
+        content = [{"type": "text", "text": head}] + history_content
+        if tail:
+            content.append({"type": "text", "text": tail})
+    else:
+        content = [{"type": "text", "text": prompt}]
+    if image_path is not None:
+        content.append(_image_content(image_path, transport))
     messages.append({"role": "user", "content": content})
 
     return messages
 
 
 class VLLMModel:
-    def __init__(self, api_key: str, model_name: str, base_url: str = "http://127.0.0.1:8000/v1"):
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+    def __init__(
+        self,
+        api_key: str,
+        model_name: str,
+        base_url: str | list[str] = "http://127.0.0.1:8000/v1",
+        image_transport: ImageTransport | None = None,
+        early_action: str = "off",
+        guided_decoding: str = "off",
+        prompt_layout: str = "default",
+    ):
+        # a list of base URLs is served through a shared EndpointRouter
+        self.client, self._aclient_factory = _openai_clients(api_key, base_url)
         self.model_name = model_name
+        self.prompt_layout = _check_layout(prompt_layout)
+        self.image_transport = (image_transport or PNG_PASSTHROUGH).for_endpoint(base_url)
+        self._aclient: AsyncOpenAI | None = None
+        # "off" | "cancel" | "background": what to do with the decode after the Action line
+        self.early_action = early_action
+        self._tail_pool = _early_action_options(early_action)
+        # "off" | "guided_regex" | "structured_outputs": how `guided_regex` reaches vLLM
+        self.guided_decoding = guided_decoding
+        _guided_body(guided_decoding, "")  # validate
+
+    @property
+    def aclient(self) -> AsyncOpenAI:
+        """AsyncOpenAI client for `agenerate`, created on first use."""
+        if self._aclient is None:
+            self._aclient = self._aclient_factory()
+        return self._aclient
+
+    def _request_kwargs(
+        self,
+        prompt: str,
+        image_path: ImageInput | None,
+        history: list[dict] | None,
+        examples: list[dict] | None,
+        temperature: float | None,
+        enable_thinking: bool,
+        thinking_budget: int | None,
+        max_tokens: int | None,
+        early_stop: bool = False,
+        guided_regex: str | None = None,
+    ) -> dict:
+        messages = _build_vllm_messages(prompt, image_path, history, examples, self.image_transport,
+                                        self.prompt_layout)
 
-    def generate(self, prompt: str, image_path: str = None, history: list[dict] = None, examples: list[dict] = None, temperature: float | None = None, enable_thinking: bool = False, thinking_budget: int | None = None, max_tokens: int | None = None) -> tuple[str, dict]:
-        """
-        Returns (text, usage) where usage includes:
-          prompt_tokens, completion_tokens, total_tokens,
-          ttft_s  (Time To First Token  = ViT encode + LLM prefill),
-          decode_s (time from first token to last token),
-          tpot_s  (decode_s / completion_tokens, i.e. per-output-token latency)
-        """
-        messages = _build_vllm_messages(prompt, image_path, history, examples)
-
-        t_request_start = _time.perf_counter()
         extra_body = {"chat_template_kwargs": {"enable_thinking": enable_thinking}}
         if thinking_budget is not None:
             extra_body["thinking_token_budget"] = thinking_budget
+        if not enable_thinking:
+            # a thinking trace would not fit the response grammar
+            extra_body.update(_guided_body(self.guided_decoding, guided_regex))
         kwargs = dict(
             model=self.model_name,
             messages=messages,
             stream=True,
-            stream_options={"include_usage": True},
+            # continuous usage keeps token counts available if we stop reading early
+            stream_options={"include_usage": True, "continuous_usage_stats": early_stop},
             extra_body=extra_body,
         )
         if temperature is not None:
             kwargs["temperature"] = temperature
         if max_tokens is not None:
             kwargs["max_tokens"] = max_tokens
-        stream = self.client.chat.completions.create(**kwargs)
+        return kwargs
 
-        full_text = ""
-        t_first_token: float | None = None
-        usage_data = None
+    def _early_parser(self, action_parser, enable_thinking: bool):
+        # A thinking trace may mention "Action:" lines of its own; only stop on real output.
+        if self.early_action == "off" or enable_thinking:
+            return None
+        return action_parser
 
-        for chunk in stream:
-            if chunk.choices and chunk.choices[0].delta.content:
-                if t_first_token is None:
-                    t_first_token = _time.perf_counter()
-                full_text += chunk.choices[0].delta.content
-            # usage comes in the last chunk when stream_options include_usage=True
-            if hasattr(chunk, "usage") and chunk.usage is not None:
-                usage_data = chunk.usage
-
-        t_end = _time.perf_counter()
+    def generate(self, prompt: str, image_path: ImageInput = None, history: list[dict] = None, examples: list[dict] = None, temperature: float | None = None, enable_thinking: bool = False, thinking_budget: int | None = None, max_tokens: int | None = None, action_parser=None, guided_regex: str | None = None) -> tuple[str, dict]:
+        """
+        Returns (text, usage) where usage includes:
+          prompt_tokens, completion_tokens, total_tokens,
+          ttft_s  (Time To First Token  = ViT encode + LLM prefill),
+          decode_s (time from first token to last token),
+          tpot_s  (decode_s / completion_tokens, i.e. per-output-token latency)
 
-        ttft = (t_first_token - t_request_start) if t_first_token else 0.0
-        decode_s = (t_end - t_first_token) if t_first_token else 0.0
+        action_parser: optional parse.StreamingActionParser. Unless early_action is
+            "off", text is returned as soon as its Action line is complete
+            (usage["early_stopped"]); with "background" the remaining decode keeps
+            streaming and usage["summary_future"] resolves to (summary, tail_usage).
 
-        prompt_tokens = getattr(usage_data, "prompt_tokens", 0) or 0 if usage_data else 0
-        completion_tokens = getattr(usage_data, "completion_tokens", 0) or 0 if usage_data else 0
-        tpot = (decode_s / completion_tokens) if completion_tokens > 0 else 0.0
+        guided_regex: optional response grammar (parse.response_regex) applied via
+            vLLM guided decoding unless guided_decoding is "off" or thinking is on.
+        """
+        action_parser = self._early_parser(action_parser, enable_thinking)
+        kwargs = self._request_kwargs(
+            prompt, image_path, history, examples,
+            temperature, enable_thinking, thinking_budget, max_tokens,
+            early_stop=action_parser is not None, guided_regex=guided_regex,
+        )
+        with trace.span("vllm.generate", "model", model=self.model_name):
+            t_request_start = _time.perf_counter()
+            stream = self.client.chat.completions.create(**kwargs)
+            full_text, usage = _consume_stream(stream, t_request_start, action_parser, self._tail_pool)
+        return full_text, _round_usage(usage)
 
-        usage = {
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": prompt_tokens + completion_tokens,
-            "ttft_s": round(ttft, 4),
-            "decode_s": round(decode_s, 4),
-            "tpot_s": round(tpot, 4),
-        }
+    async def agenerate(self, prompt: str, image_path: ImageInput = None, history: list[dict] = None, examples: list[dict] = None, temperature: float | None = None, enable_thinking: bool = False, thinking_budget: int | None = None, max_tokens: int | None = None, action_parser=None, guided_regex: str | None = None) -> tuple[str, dict]:
+        """
+        Async `generate`: same arguments and (text, usage) contract, but built on
+        AsyncOpenAI so many requests can be in flight against one vLLM server
+        (e.g. `asyncio.gather` over episodes, oracle checks or kl_check samples).
+        An early action stop always cancels the rest of the decode here.
+        """
+        action_parser = self._early_parser(action_parser, enable_thinking)
+        kwargs = self._request_kwargs(
+            prompt, image_path, history, examples,
+            temperature, enable_thinking, thinking_budget, max_tokens,
+            early_stop=action_parser is not None, guided_regex=guided_regex,
+        )
+        with trace.span("vllm.generate", "model", model=self.model_name):
+            t_request_start = _time.perf_counter()
+            stream = await self.aclient.chat.completions.create(**kwargs)
+            full_text, usage = await _aconsume_stream(stream, t_request_start, action_parser)
+        return full_text, _round_usage(usage)
 
-        return full_text, usage
+    def generate_n(self, prompt: str, n: int, image_path: ImageInput = None, history: list[dict] = None, examples: list[dict] = None, temperature: float | None = None, enable_thinking: bool = False, thinking_budget: int | None = None, max_tokens: int | None = None, guided_regex: str | None = None) -> tuple[list[tuple[str, float]], dict]:
+        """
+        Sample `n` candidates in a single request (vLLM prefills the prompt once
+        and forks the decode). Returns ([(text, mean_token_logprob), ...], usage);
+        usage counts the prompt once and the completion tokens of all candidates.
+        """
+        kwargs = self._request_kwargs(
+            prompt, image_path, history, examples,
+            temperature, enable_thinking, thinking_budget, max_tokens,
+            guided_regex=guided_regex,
+        )
+        kwargs.update(n=n, logprobs=True)
+        with trace.span("vllm.generate_n", "model", model=self.model_name, n=n):
+            t_request_start = _time.perf_counter()
+            stream = self.client.chat.completions.create(**kwargs)
+            candidates, usage = _consume_n_stream(stream, t_request_start, n)
+        return candidates, _round_usage(usage)
 
 
 class DynamicLoRAVLLMModel:
@@ -237,6 +1088,17 @@ class DynamicLoRAVLLMModel:
 
     Both passes hit the same vLLM server and share the same prompt prefix, so vLLM's
     prefix cache amortises the (expensive) ViT encode + prompt prefill across them.
+
+    With `pass2_prewarm=True` a `max_tokens=1` LoRA request over `pass2_base_messages`
+    is sent concurrently with pass 1, so pass 2's image encode + prompt prefill are
+    already prefix-cached when it arrives and it only prefills the trace.
+
+    With `background_pass3=True` (lora_as_tool mode) pass 3 is submitted to a worker
+    thread and `generate` returns right after pass 2: usage["summary_future"] resolves
+    to (pass3_summary, pass3_usage) while the caller executes the action.
+
+    With `early_action` != "off" and an `action_parser`, pass 2 stops reading as soon
+    as its Action line is complete (see `VLLMModel.generate`).
     """
 
     DEFAULT_THINK_MAX_TOKENS = 512
@@ -247,17 +1109,52 @@ class DynamicLoRAVLLMModel:
         api_key: str,
         base_model: str,
         lora_model: str,
-        base_url: str = "http://127.0.0.1:8000/v1",
+        base_url: str | list[str] = "http://127.0.0.1:8000/v1",
         think_max_tokens: int | None = None,
         action_max_tokens: int | None = None,
         lora_as_tool: bool = False,
+        image_transport: ImageTransport | None = None,
+        pass2_prewarm: bool = False,
+        background_pass3: bool = False,
+        early_action: str = "off",
+        guided_decoding: str = "off",
+        prompt_layout: str = "default",
     ):
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+        # a list of base URLs is served through a shared EndpointRouter
+        self.client, self._aclient_factory = _openai_clients(api_key, base_url)
         self.base_model = base_model
+        self.prompt_layout = _check_layout(prompt_layout)
         self.lora_model = lora_model
         self.think_max_tokens = think_max_tokens or self.DEFAULT_THINK_MAX_TOKENS
         self.action_max_tokens = action_max_tokens or self.DEFAULT_ACTION_MAX_TOKENS
         self.lora_as_tool = lora_as_tool
+        self.image_transport = (image_transport or PNG_PASSTHROUGH).for_endpoint(base_url)
+        self._aclient: AsyncOpenAI | None = None
+        self.pass2_prewarm = pass2_prewarm
+        self._prewarm_pool = (
+            ThreadPoolExecutor(max_workers=2, thread_name_prefix="pass2-prewarm")
+            if pass2_prewarm else None
+        )
+        self.background_pass3 = background_pass3
+        self._pass3_pool = (
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="pass3")
+            if background_pass3 and lora_as_tool else None
+        )
+        # Pass 2 early stop ("off" | "cancel" | "background"). In lora_as_tool mode pass 3
+        # writes the summary, so the tail of pass 2 is always cancelled.
+        self.early_action = early_action
+        self._tail_pool = _early_action_options(
+            "cancel" if lora_as_tool and early_action == "background" else early_action)
+        # Pass 2 (the action pass) is decoded under `guided_regex` when enabled
+        self.guided_decoding = guided_decoding
+        _guided_body(guided_decoding, "")  # validate
+
+    @property
+    def aclient(self) -> AsyncOpenAI:
+        """AsyncOpenAI client for `agenerate`, created on first use."""
+        if self._aclient is None:
+            self._aclient = self._aclient_factory()
+        return self._aclient
 
     @staticmethod
     def _strip_think_wrapper(text: str) -> str:
@@ -267,73 +1164,67 @@ class DynamicLoRAVLLMModel:
         text = re.sub(r"\s*</think>\s*$", "", text, flags=re.IGNORECASE)
         return text.strip()
 
-    def _stream(self, kwargs: dict) -> tuple[str, dict]:
-        """Run a streaming chat completion and collect (text, usage_dict)."""
-        t_request_start = _time.perf_counter()
-        stream = self.client.chat.completions.create(**kwargs)
-
-        full_text = ""
-        t_first_token: float | None = None
-        usage_data = None
-
-        for chunk in stream:
-            if chunk.choices and chunk.choices[0].delta.content:
-                if t_first_token is None:
-                    t_first_token = _time.perf_counter()
-                full_text += chunk.choices[0].delta.content
-            if hasattr(chunk, "usage") and chunk.usage is not None:
-                usage_data = chunk.usage
-
-        t_end = _time.perf_counter()
-        ttft = (t_first_token - t_request_start) if t_first_token else 0.0
-        decode_s = (t_end - t_first_token) if t_first_token else 0.0
-
-        prompt_tokens = getattr(usage_data, "prompt_tokens", 0) or 0 if usage_data else 0
-        completion_tokens = getattr(usage_data, "completion_tokens", 0) or 0 if usage_data else 0
-        tpot = (decode_s / completion_tokens) if completion_tokens > 0 else 0.0
-
-        return full_text, {
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": prompt_tokens + completion_tokens,
-            "ttft_s": ttft,
-            "decode_s": decode_s,
-            "tpot_s": tpot,
-        }
+    def _stream(self, kwargs: dict, action_parser=None, name: str = "request") -> tuple[str, dict]:
+        """Run a streaming chat completion and collect (text, usage_dict); traced as `name`."""
+        with trace.span(name, "model", model=kwargs["model"]):
+            t_request_start = _time.perf_counter()
+            stream = self.client.chat.completions.create(**kwargs)
+            return _consume_stream(stream, t_request_start, action_parser, self._tail_pool)
+
+    async def _astream(self, kwargs: dict, action_parser=None, name: str = "request") -> tuple[str, dict]:
+        """Async `_stream` over the AsyncOpenAI client."""
+        with trace.span(name, "model", model=kwargs["model"]):
+            t_request_start = _time.perf_counter()
+            stream = await self.aclient.chat.completions.create(**kwargs)
+            return await _aconsume_stream(stream, t_request_start, action_parser)
+
+    def _pass2_parser(self, action_parser):
+        """The early-stop parser for pass 2 (None when disabled)."""
+        if action_parser is None or self.early_action == "off":
+            return None
+        return action_parser
+
+    def _prewarm_kwargs(self, pass2_base_messages: list[dict]) -> dict:
+        # Same adapter and messages as pass 2, minus the assistant prefill: one
+        # decoded token is enough to leave the prefix blocks in vLLM's cache.
+        return dict(
+            model=self.lora_model,
+            messages=pass2_base_messages,
+            max_tokens=1,
+            extra_body={"chat_template_kwargs": {"enable_thinking": False}},
+        )
 
-    def generate(
+    def _prewarm(self, kwargs: dict) -> float | None:
+        """Blocking prewarm request; returns its wall time, or None if it failed."""
+        t0 = _time.perf_counter()
+        try:
+            with trace.span("pass2_prewarm", "model", model=kwargs["model"]):
+                self.client.chat.completions.create(**kwargs)
+        except Exception as e:
+            print(f"[PASS2/PREWARM] failed: {e}")
+            return None
+        return _time.perf_counter() - t0
+
+    async def _aprewarm(self, kwargs: dict) -> float | None:
+        t0 = _time.perf_counter()
+        try:
+            await self.aclient.chat.completions.create(**kwargs)
+        except Exception as e:
+            print(f"[PASS2/PREWARM] failed: {e}")
+            return None
+        return _time.perf_counter() - t0
+
+    def _pass_messages(
         self,
         prompt: str,
-        image_path: str | None = None,
-        history: list[dict] | None = None,
-        examples: list[dict] | None = None,
-        temperature: float | None = None,
-        enable_thinking: bool = False,  # accepted for API parity; ignored (this model is always 2-pass)
-        thinking_budget: int | None = None,
-        max_tokens: int | None = None,
-        pass1_prompt: str | None = None,
-        pass2_prompt: str | None = None,
-        pass2_history: list[dict] | None = None,
-    ) -> tuple[str, dict]:
-        """
-        pass1_prompt: a SHORT, format-free prompt for Pass 1 — e.g. just
-            "Task: <goal>\\n\\nWhat should happen next on this screen?"
-            This is critical: if Pass 1 receives the full formatted agent prompt
-            (with "Your response MUST follow this exact format: <action call>")
-            the base model puts the action inside <think> instead of reasoning,
-            which completely breaks Pass 2.
-            When None, falls back to the full `prompt` (suboptimal but won't crash).
-
-        pass2_prompt: optional replacement for `prompt` used to build pass2_base_messages.
-            Use this to give Pass 2 a differently-formatted history than Pass 1 sees
-            (e.g. action-call strings instead of English summaries).
-
-        pass2_history: optional replacement for `history` used to build pass2_base_messages.
-            Each item's "summary" field should be an action-call string matching the LoRA's
-            fine-tuning format rather than a natural-language description.
-        """
-        del enable_thinking  # always two-pass: pass 1 thinks, pass 2 acts
-
+        image_path: ImageInput | None,
+        history: list[dict] | None,
+        examples: list[dict] | None,
+        pass1_prompt: str | None,
+        pass2_prompt: str | None,
+        pass2_history: list[dict] | None,
+    ) -> tuple[list[dict], list[dict]]:
+        """Return (pass1_messages, pass2_base_messages)."""
         # Pass 2 gets the full formatted agent prompt (matches LoRA training distribution).
         # Use pass2_prompt / pass2_history overrides when provided so Pass 2 sees
         # action-call history rather than the English summaries Pass 1 receives.
@@ -342,19 +1233,24 @@ class DynamicLoRAVLLMModel:
             image_path,
             pass2_history if pass2_history is not None else history,
             examples,
+            self.image_transport,
+            self.prompt_layout,
         )
 
         # Pass 1 gets a minimal prompt: just the task + screenshot, no format rules
         if pass1_prompt is not None:
             p1_content: list[dict] = [{"type": "text", "text": pass1_prompt}]
-            if image_path:
-                p1_content.append(_image_content(image_path))
+            if image_path is not None:
+                p1_content.append(_image_content(image_path, self.image_transport))
             pass1_messages = [{"role": "user", "content": p1_content}]
         else:
             # Fallback: use the same messages as Pass 2 (suboptimal)
             pass1_messages = pass2_base_messages
+        return pass1_messages, pass2_base_messages
 
-        # ── Pass 1: base model generates the reasoning trace ─────────
+    def _pass1_kwargs(
+        self, pass1_messages: list[dict], temperature: float | None, thinking_budget: int | None,
+    ) -> dict:
         # The qwen3-vl chat template inserts `<think>\n` before the assistant
         # generation starts (enable_thinking=True).  We stop at </think> so we
         # only capture the reasoning body — the model never emits an action here.
@@ -375,7 +1271,16 @@ class DynamicLoRAVLLMModel:
             pass1_kwargs["stop"] = ["\nObservation:"]
         if temperature is not None:
             pass1_kwargs["temperature"] = temperature
-        thinking_body, p1_usage = self._stream(pass1_kwargs)
+        return pass1_kwargs
+
+    def _route_pass1(self, thinking_body: str, p1_usage: dict) -> tuple[str, str | None]:
+        """
+        Post-process the Pass 1 trace.
+
+        Returns (clean_thinking_body, bypass_response). `bypass_response` is not None
+        only in lora_as_tool mode when Pass 1 decided on a non-coordinate action; the
+        caller then returns it directly (with `p1_usage`, annotated here) and skips Pass 2/3.
+        """
         thinking_body_stripped = self._strip_think_wrapper(thinking_body)
 
         print(
@@ -384,53 +1289,61 @@ class DynamicLoRAVLLMModel:
         )
 
         clean_thinking_body = thinking_body_stripped
-        if self.lora_as_tool:
-            # Parse Complete: yes/no (explicit completion field — primary routing signal)
-            complete_match = re.search(r"Complete:\s*(yes|no)", thinking_body, re.IGNORECASE)
-            task_is_complete = complete_match and complete_match.group(1).lower() == "yes"
-
-            # Parse Is_Coordinate_Action (action-type routing)
-            is_coordinate = True  # default: route to LoRA
-            coord_match = re.search(r"Is_Coordinate_Action:\s*(True|False)", thinking_body, re.IGNORECASE)
-            if coord_match:
-                is_coordinate = coord_match.group(1).lower() == "true"
-            else:
-                # Fallback heuristic
-                if "task_complete" in thinking_body or "press_" in thinking_body:
-                    is_coordinate = False
+        if not self.lora_as_tool:
+            return clean_thinking_body, None
+
+        # Parse Complete: yes/no (explicit completion field — primary routing signal)
+        complete_match = re.search(r"Complete:\s*(yes|no)", thinking_body, re.IGNORECASE)
+        task_is_complete = complete_match and complete_match.group(1).lower() == "yes"
 
-            # Complete: yes overrides — never route to LoRA when task is done
-            if task_is_complete:
+        # Parse Is_Coordinate_Action (action-type routing)
+        is_coordinate = True  # default: route to LoRA
+        coord_match = re.search(r"Is_Coordinate_Action:\s*(True|False)", thinking_body, re.IGNORECASE)
+        if coord_match:
+            is_coordinate = coord_match.group(1).lower() == "true"
+        else:
+            # Fallback heuristic
+            if "task_complete" in thinking_body or "press_" in thinking_body:
                 is_coordinate = False
 
-            # Extract Observation + Thought for the LoRA prefill.
-            # Format is now: Observation / Thought / Complete / Action / Summary / Is_Coordinate_Action.
-            # Stop before Complete: (which immediately precedes Action:) so the LoRA
-            # never sees Pass 1's coordinate prediction and must generate its own.
-            reasoning_match = re.search(
-                r"((?:Observation:.*?)(?:Thought:.*?))(?=\s*Complete:|\s*Action:|\s*$)",
-                thinking_body_stripped,
-                re.DOTALL | re.IGNORECASE,
-            )
-            clean_thinking_body = reasoning_match.group(1).strip() if reasoning_match else re.sub(
-                r"\n?Complete:.*$", "", thinking_body_stripped, flags=re.DOTALL | re.IGNORECASE
-            ).strip()
+        # Complete: yes overrides — never route to LoRA when task is done
+        if task_is_complete:
+            is_coordinate = False
+
+        # Extract Observation + Thought for the LoRA prefill.
+        # Format is now: Observation / Thought / Complete / Action / Summary / Is_Coordinate_Action.
+        # Stop before Complete: (which immediately precedes Action:) so the LoRA
+        # never sees Pass 1's coordinate prediction and must generate its own.
+        reasoning_match = re.search(
+            r"((?:Observation:.*?)(?:Thought:.*?))(?=\s*Complete:|\s*Action:|\s*$)",
+            thinking_body_stripped,
+            re.DOTALL | re.IGNORECASE,
+        )
+        clean_thinking_body = reasoning_match.group(1).strip() if reasoning_match else re.sub(
+            r"\n?Complete:.*$", "", thinking_body_stripped, flags=re.DOTALL | re.IGNORECASE
+        ).strip()
 
-            if not is_coordinate:
-                print(f"\033[33m[PASS1/BASE] is_coordinate=False  task_is_complete={task_is_complete}, bypassing Pass 2.\033[0m")
-                # Construct a response that matches the expected format (action outside <think> block)
-                action_match = re.search(r"Action:\s*(.*?)(?=\nSummary:|\nIs_Coordinate_Action:|$)", thinking_body_stripped, re.DOTALL | re.IGNORECASE)
-                action_text = f"Action: {action_match.group(1).strip()}" if action_match else thinking_body_stripped
+        if is_coordinate:
+            return clean_thinking_body, None
 
-                # Pass 1 IS the executed action here, so its Summary field is accurate — extract it directly.
-                summary_m = re.search(r"Summary:\s*(.*?)$", thinking_body_stripped, re.MULTILINE | re.IGNORECASE)
-                p1_usage["pass3_summary"] = summary_m.group(1).strip() if summary_m else ""
-                p1_usage["pass1_raw"] = thinking_body_stripped
+        print(f"\033[33m[PASS1/BASE] is_coordinate=False  task_is_complete={task_is_complete}, bypassing Pass 2.\033[0m")
+        # Construct a response that matches the expected format (action outside <think> block)
+        action_match = re.search(r"Action:\s*(.*?)(?=\nSummary:|\nIs_Coordinate_Action:|$)", thinking_body_stripped, re.DOTALL | re.IGNORECASE)
+        action_text = f"Action: {action_match.group(1).strip()}" if action_match else thinking_body_stripped
 
-                simulated_response = f"<think>\n{clean_thinking_body}\n</think>\n{action_text}"
-                return simulated_response, p1_usage
+        # Pass 1 IS the executed action here, so its Summary field is accurate — extract it directly.
+        summary_m = re.search(r"Summary:\s*(.*?)$", thinking_body_stripped, re.MULTILINE | re.IGNORECASE)
+        p1_usage["pass3_summary"] = summary_m.group(1).strip() if summary_m else ""
+        p1_usage["pass1_raw"] = thinking_body_stripped
 
-        # ── Pass 2: LoRA generates the action with the trace prefilled ─
+        simulated_response = f"<think>\n{clean_thinking_body}\n</think>\n{action_text}"
+        return clean_thinking_body, simulated_response
+
+    def _pass2_kwargs(
+        self, pass2_base_messages: list[dict], clean_thinking_body: str, temperature: float | None,
+        guided_regex: str | None = None, early_stop: bool = False,
+    ) -> tuple[str, dict]:
+        """Return (prefill, pass2_kwargs)."""
         # Extract just the reasoning part for the LoRA prefill so we don't confuse it
         # with the Action/Is_Coordinate_Action format which it wasn't trained on.
 
@@ -448,7 +1361,8 @@ class DynamicLoRAVLLMModel:
             model=self.lora_model,
             messages=pass2_messages,
             stream=True,
-            stream_options={"include_usage": True},
+            # continuous usage keeps token counts available if we stop reading early
+            stream_options={"include_usage": True, "continuous_usage_stats": early_stop},
             max_tokens=self.action_max_tokens,
             extra_body={
                 "continue_final_message": True,
@@ -457,58 +1371,282 @@ class DynamicLoRAVLLMModel:
                 # telling the template enable_thinking=False prevents it from
                 # prepending a second <think> tag.
                 "chat_template_kwargs": {"enable_thinking": False},
+                **_guided_body(self.guided_decoding, guided_regex),
             },
         )
         if temperature is not None:
             pass2_kwargs["temperature"] = temperature
-        action_text, p2_usage = self._stream(pass2_kwargs)
-
-        print(
-            f"\033[32m[PASS2/LORA  action]\033[0m\n"
-            f"\033[32m{action_text}\033[0m"
-        )
+        return prefill, pass2_kwargs
 
-        # ── Pass 3: base model summarizes the action Pass 2 actually executed ──
+    def _pass3_kwargs(
+        self,
+        pass1_messages: list[dict],
+        clean_thinking_body: str,
+        action_text: str,
+        temperature: float | None,
+    ) -> dict:
         # Pass 2 (LoRA) may produce different coordinates than Pass 1 predicted, so
         # Pass 1's Summary field is unreliable.  Pass 3 re-uses the cached Pass 1
         # prefix (full prefix-cache hit on ViT encode + all Pass 1 text tokens) and
         # asks the base model to summarize the action that was actually taken.
+        action_m = re.search(r"Action:\s*(.*?)$", action_text, re.MULTILINE | re.IGNORECASE)
+        pass2_action_str = action_m.group(1).strip() if action_m else action_text.strip()
+
+        pass3_messages = pass1_messages + [
+            {"role": "assistant", "content": f"<think>\n{clean_thinking_body}\n</think>\n"},
+            {"role": "user", "content": (
+                f"The action that was actually executed was: {pass2_action_str}\n"
+                "Summarize what was done in one concise sentence starting with 'I'."
+            )},
+        ]
+        pass3_kwargs: dict = dict(
+            model=self.base_model,
+            messages=pass3_messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            max_tokens=64,
+            extra_body={"chat_template_kwargs": {"enable_thinking": False}},
+        )
+        if temperature is not None:
+            pass3_kwargs["temperature"] = temperature
+        return pass3_kwargs
+
+    @_pin_passes
+    def generate(
+        self,
+        prompt: str,
+        image_path: ImageInput | None = None,
+        history: list[dict] | None = None,
+        examples: list[dict] | None = None,
+        temperature: float | None = None,
+        enable_thinking: bool = False,  # accepted for API parity; ignored (this model is always 2-pass)
+        thinking_budget: int | None = None,
+        max_tokens: int | None = None,
+        pass1_prompt: str | None = None,
+        pass2_prompt: str | None = None,
+        pass2_history: list[dict] | None = None,
+        action_parser=None,
+        guided_regex: str | None = None,
+    ) -> tuple[str, dict]:
+        """
+        pass1_prompt: a SHORT, format-free prompt for Pass 1 — e.g. just
+            "Task: <goal>\\n\\nWhat should happen next on this screen?"
+            This is critical: if Pass 1 receives the full formatted agent prompt
+            (with "Your response MUST follow this exact format: <action call>")
+            the base model puts the action inside <think> instead of reasoning,
+            which completely breaks Pass 2.
+            When None, falls back to the full `prompt` (suboptimal but won't crash).
+
+        pass2_prompt: optional replacement for `prompt` used to build pass2_base_messages.
+            Use this to give Pass 2 a differently-formatted history than Pass 1 sees
+            (e.g. action-call strings instead of English summaries).
+
+        pass2_history: optional replacement for `history` used to build pass2_base_messages.
+            Each item's "summary" field should be an action-call string matching the LoRA's
+            fine-tuning format rather than a natural-language description.
+
+        action_parser: optional parse.StreamingActionParser for Pass 2; see
+            `VLLMModel.generate` and the `early_action` constructor option.
+
+        guided_regex: optional grammar for the Pass 2 continuation (after the prefill),
+            applied when guided_decoding is enabled.
+        """
+        del enable_thinking  # always two-pass: pass 1 thinks, pass 2 acts
+
+        pass1_messages, pass2_base_messages = self._pass_messages(
+            prompt, image_path, history, examples, pass1_prompt, pass2_prompt, pass2_history,
+        )
+
+        # ── Pass 2 prewarm: prefill the LoRA prefix while pass 1 decodes ─
+        prewarm = None
+        if self._prewarm_pool is not None:
+            prewarm = _submit(self._prewarm_pool, self._prewarm, self._prewarm_kwargs(pass2_base_messages))
+
+        # ── Pass 1: base model generates the reasoning trace ─────────
+        thinking_body, p1_usage = self._stream(
+            self._pass1_kwargs(pass1_messages, temperature, thinking_budget), name="pass1")
+        clean_thinking_body, bypass_response = self._route_pass1(thinking_body, p1_usage)
+        if bypass_response is not None:
+            return bypass_response, p1_usage
+
+        # ── Pass 2: LoRA generates the action with the trace prefilled ─
+        pass2_parser = self._pass2_parser(action_parser)
+        prefill, pass2_kwargs = self._pass2_kwargs(
+            pass2_base_messages, clean_thinking_body, temperature, guided_regex, early_stop=pass2_parser is not None)
+        prewarm_s = prewarm.result() if prewarm is not None else None
+        action_text, p2_usage = self._stream(pass2_kwargs, pass2_parser, "pass2")
+        self._print_pass2(action_text)
+
+        # ── Pass 3: base model summarizes the action Pass 2 actually executed ──
         # Only runs in lora_as_tool mode where the misalignment can occur.
         pass3_summary = ""
         p3_usage: dict = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0,
                           "ttft_s": 0.0, "decode_s": 0.0, "tpot_s": 0.0}
+        summary_future = None
         if self.lora_as_tool:
-            action_m = re.search(r"Action:\s*(.*?)$", action_text, re.MULTILINE | re.IGNORECASE)
-            pass2_action_str = action_m.group(1).strip() if action_m else action_text.strip()
-
-            pass3_messages = pass1_messages + [
-                {"role": "assistant", "content": f"<think>\n{clean_thinking_body}\n</think>\n"},
-                {"role": "user", "content": (
-                    f"The action that was actually executed was: {pass2_action_str}\n"
-                    "Summarize what was done in one concise sentence starting with 'I'."
-                )},
-            ]
-            pass3_kwargs: dict = dict(
-                model=self.base_model,
-                messages=pass3_messages,
-                stream=True,
-                stream_options={"include_usage": True},
-                max_tokens=64,
-                extra_body={"chat_template_kwargs": {"enable_thinking": False}},
-            )
-            if temperature is not None:
-                pass3_kwargs["temperature"] = temperature
-            pass3_raw, p3_usage = self._stream(pass3_kwargs)
-            pass3_summary = pass3_raw.strip()
-            print(
-                f"\033[35m[PASS3/BASE  summary]\033[0m\n"
-                f"\033[35m{pass3_summary}\033[0m"
-            )
+            pass3_kwargs = self._pass3_kwargs(pass1_messages, clean_thinking_body, action_text, temperature)
+            if self._pass3_pool is not None:
+                summary_future = _submit(self._pass3_pool, self._run_pass3, pass3_kwargs)
+            else:
+                pass3_summary, p3_usage = self._run_pass3(pass3_kwargs)
+
+        return self._finish(prefill, action_text, thinking_body, p1_usage, p2_usage, p3_usage,
+                            pass3_summary, prewarm_s, summary_future)
+
+    @_pin_passes
+    async def agenerate(
+        self,
+        prompt: str,
+        image_path: ImageInput | None = None,
+        history: list[dict] | None = None,
+        examples: list[dict] | None = None,
+        temperature: float | None = None,
+        enable_thinking: bool = False,
+        thinking_budget: int | None = None,
+        max_tokens: int | None = None,
+        pass1_prompt: str | None = None,
+        pass2_prompt: str | None = None,
+        pass2_history: list[dict] | None = None,
+        action_parser=None,
+        guided_regex: str | None = None,
+    ) -> tuple[str, dict]:
+        """Async `generate`: identical pass structure and (text, usage) contract over AsyncOpenAI."""
+        del enable_thinking
+
+        pass1_messages, pass2_base_messages = self._pass_messages(
+            prompt, image_path, history, examples, pass1_prompt, pass2_prompt, pass2_history,
+        )
+
+        prewarm = None
+        if self.pass2_prewarm:
+            prewarm = asyncio.create_task(self._aprewarm(self._prewarm_kwargs(pass2_base_messages)))
+
+        try:
+            thinking_body, p1_usage = await self._astream(
+                self._pass1_kwargs(pass1_messages, temperature, thinking_budget), name="pass1")
+            clean_thinking_body, bypass_response = self._route_pass1(thinking_body, p1_usage)
+        except BaseException:
+            await _acancel(prewarm)
+            raise
+        if bypass_response is not None:
+            # no pass 2: don't leave the prewarm pending past this call
+            await _acancel(prewarm)
+            return bypass_response, p1_usage
+
+        pass2_parser = self._pass2_parser(action_parser)
+        prefill, pass2_kwargs = self._pass2_kwargs(
+            pass2_base_messages, clean_thinking_body, temperature, guided_regex, early_stop=pass2_parser is not None)
+        prewarm_s = await prewarm if prewarm is not None else None
+        action_text, p2_usage = await self._astream(pass2_kwargs, pass2_parser, "pass2")
+        self._print_pass2(action_text)
+
+        pass3_summary = ""
+        p3_usage: dict = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0,
+                          "ttft_s": 0.0, "decode_s": 0.0, "tpot_s": 0.0}
+        summary_future = None
+        if self.lora_as_tool:
+            pass3_kwargs = self._pass3_kwargs(pass1_messages, clean_thinking_body, action_text, temperature)
+            if self._pass3_pool is not None:
+                # sync client on the worker thread: the future must outlive this event loop
+                summary_future = _submit(self._pass3_pool, self._run_pass3, pass3_kwargs)
+            else:
+                pass3_raw, p3_usage = await self._astream(pass3_kwargs, name="pass3")
+                pass3_summary = self._print_pass3(pass3_raw)
+
+        return self._finish(prefill, action_text, thinking_body, p1_usage, p2_usage, p3_usage,
+                            pass3_summary, prewarm_s, summary_future)
+
+    @_pin_passes
+    def generate_n(
+        self,
+        prompt: str,
+        n: int,
+        image_path: ImageInput | None = None,
+        history: list[dict] | None = None,
+        examples: list[dict] | None = None,
+        temperature: float | None = None,
+        enable_thinking: bool = False,
+        thinking_budget: int | None = None,
+        max_tokens: int | None = None,
+        pass1_prompt: str | None = None,
+        pass2_prompt: str | None = None,
+        pass2_history: list[dict] | None = None,
+        guided_regex: str | None = None,
+    ) -> tuple[list[tuple[str, float]], dict]:
+        """
+        One pass-1 trace, then `n` pass-2 action candidates from a single LoRA request
+        sharing the prefilled trace. Returns ([(full_text, mean_token_logprob), ...], usage).
+        Pass 3 is skipped: callers fall back to each candidate's own Summary line.
+        """
+        del enable_thinking
+
+        pass1_messages, pass2_base_messages = self._pass_messages(
+            prompt, image_path, history, examples, pass1_prompt, pass2_prompt, pass2_history,
+        )
+        thinking_body, p1_usage = self._stream(
+            self._pass1_kwargs(pass1_messages, temperature, thinking_budget), name="pass1")
+        clean_thinking_body, bypass_response = self._route_pass1(thinking_body, p1_usage)
+        if bypass_response is not None:
+            return [(bypass_response, 0.0)], p1_usage
+
+        prefill, pass2_kwargs = self._pass2_kwargs(
+            pass2_base_messages, clean_thinking_body, temperature, guided_regex)
+        pass2_kwargs.update(n=n, logprobs=True)
+        with trace.span("pass2", "model", model=self.lora_model, n=n):
+            t_request_start = _time.perf_counter()
+            stream = self.client.chat.completions.create(**pass2_kwargs)
+            candidates, p2_usage = _consume_n_stream(stream, t_request_start, n)
+        for i, (action_text, logprob) in enumerate(candidates):
+            print(f"\033[32m[PASS2/LORA  candidate {i}  logprob={logprob:.3f}]\033[0m {action_text.strip()}")
+
+        usage = self._merge_usage(p1_usage, p2_usage)
+        usage["pass1_raw"] = self._strip_think_wrapper(thinking_body)
+        return [(f"{prefill}{action_text}", logprob) for action_text, logprob in candidates], usage
 
+    @staticmethod
+    def _print_pass2(action_text: str) -> None:
+        print(
+            f"\033[32m[PASS2/LORA  action]\033[0m\n"
+            f"\033[32m{action_text}\033[0m"
+        )
+
+    def _run_pass3(self, pass3_kwargs: dict) -> tuple[str, dict]:
+        """Blocking pass 3; returns (pass3_summary, pass3_usage)."""
+        pass3_raw, p3_usage = self._stream(pass3_kwargs, name="pass3")
+        return self._print_pass3(pass3_raw), p3_usage
+
+    @staticmethod
+    def _print_pass3(pass3_raw: str) -> str:
+        pass3_summary = pass3_raw.strip()
+        print(
+            f"\033[35m[PASS3/BASE  summary]\033[0m\n"
+            f"\033[35m{pass3_summary}\033[0m"
+        )
+        return pass3_summary
+
+    def _finish(
+        self,
+        prefill: str,
+        action_text: str,
+        thinking_body: str,
+        p1_usage: dict,
+        p2_usage: dict,
+        p3_usage: dict,
+        pass3_summary: str,
+        prewarm_s: float | None = None,
+        summary_future: Future | None = None,
+    ) -> tuple[str, dict]:
         full_text = f"{prefill}{action_text}"
         usage = self._merge_usage(p1_usage, p2_usage, p3_usage, pass3_summary)
-        usage["pass1_raw"] = thinking_body_stripped
+        usage["pass1_raw"] = self._strip_think_wrapper(thinking_body)
         usage["pass2_raw"] = action_text
+        # pass2_ttft_s with pass2_prewarmed=True vs False is the prewarm's payoff
+        usage["pass2_prewarmed"] = prewarm_s is not None
+        usage["pass2_prewarm_s"] = round(prewarm_s or 0.0, 4)
+        usage["early_stopped"] = p2_usage.get("early_stopped", False)
+        summary_future = summary_future or p2_usage.get("summary_future")
+        if summary_future is not None:
+            usage["summary_future"] = summary_future
         return full_text, usage
 
     @staticmethod
@@ -517,6 +1655,7 @@ class DynamicLoRAVLLMModel:
         prompt_tokens = p1["prompt_tokens"] + p2["prompt_tokens"] + p3.get("prompt_tokens", 0)
         completion_tokens = p1["completion_tokens"] + p2["completion_tokens"] + p3.get("completion_tokens", 0)
         total_tokens = prompt_tokens + completion_tokens
+        cached_tokens = p1.get("cached_tokens", 0) + p2.get("cached_tokens", 0) + p3.get("cached_tokens", 0)
         # TTFT is dominated by pass-1 prefill (first user-visible latency before any token).
         # decode time is the sum of all passes' decode windows.
         ttft_s = p1["ttft_s"]
@@ -526,15 +1665,18 @@ class DynamicLoRAVLLMModel:
             "prompt_tokens": prompt_tokens,
             "completion_tokens": completion_tokens,
             "total_tokens": total_tokens,
+            "cached_tokens": cached_tokens,
             "ttft_s": round(ttft_s, 4),
             "decode_s": round(decode_s, 4),
             "tpot_s": round(tpot_s, 4),
             # per-pass breakdown
             "pass1_prompt_tokens": p1["prompt_tokens"],
+            "pass1_cached_tokens": p1.get("cached_tokens", 0),
             "pass1_completion_tokens": p1["completion_tokens"],
             "pass1_ttft_s": round(p1["ttft_s"], 4),
             "pass1_decode_s": round(p1["decode_s"], 4),
             "pass2_prompt_tokens": p2["prompt_tokens"],
+            "pass2_cached_tokens": p2.get("cached_tokens", 0),
             "pass2_completion_tokens": p2["completion_tokens"],
             "pass2_ttft_s": round(p2["ttft_s"], 4),
             "pass2_decode_s": round(p2["decode_s"], 4),
@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 
 # Matches a <think>...</think> block (greedy across newlines) at the start of a response,
 # tolerant of leading whitespace and either Unix or Windows line endings.
@@ -111,6 +112,49 @@ def parse_raw_response(rsp: str) -> dict | None:
     }
 
 
+# A complete Action line: the call has been decoded up to the newline that ends it.
+_ACTION_LINE_RE = re.compile(r"\bAction:[ \t]*(\S.*?)\r?\n")
+
+
+class StreamingActionParser:
+    """
+    Incremental action extraction over streamed text deltas.
+
+    `feed(delta)` accumulates the text and returns the `parse_fn` result (e.g.
+    parse_element_response) as soon as the `Action:` line is complete and outside
+    any still-open <think> block; until then it returns None. Everything after that
+    line (Summary etc.) is not needed to execute the action, so the caller may stop
+    decoding and, if it still wants the summary, recover it later with `summary()`.
+    """
+
+    def __init__(self, parse_fn=parse_element_response):
+        self.parse_fn = parse_fn
+        self.text = ""
+        self.result: dict | None = None
+
+    def feed(self, delta: str) -> dict | None:
+        self.text += delta
+        if self.result is None and "\n" in delta:
+            self.result = self._try_parse()
+        return self.result
+
+    def _try_parse(self) -> dict | None:
+        if re.match(r"\s*<think\b", self.text, re.IGNORECASE) and not _THINK_BLOCK_RE.match(self.text):
+            return None  # still inside the reasoning block
+        body = _strip_leading_think(self.text)
+        m = _ACTION_LINE_RE.search(body)
+        if m is None:
+            return None
+        # The full-response parsers only read the Action line itself, so parsing the
+        # prefix up to its newline gives the same action as parsing the whole text.
+        return self.parse_fn(body[:m.end()])
+
+    @staticmethod
+    def summary(full_text: str) -> str:
+        """Summary field of the complete response ('' if absent)."""
+        return _extract(_strip_leading_think(full_text), "Summary")
+
+
 def _parse_raw_action_string(act_str: str) -> dict | None:
     """Parser for raw normalized coordinate function calls."""
     act_str = act_str.strip()
@@ -212,6 +256,9 @@ def _parse_action_string(act_str: str, grid_mode: bool) -> dict | None:
         if act_name in TAP_ALIASES:
             inner = re.findall(r'\((.*)\)', act_str)[0]
             parts = [p.strip().strip('"').strip("'") for p in inner.split(",")]
+            if grid_mode and "." in parts[0]:
+                # the orion grid prompt targets normalized coordinates
+                return _parse_raw_action_string(act_str)
             if grid_mode and len(parts) >= 2:
                 return {"action": "tap_grid", "area": _to_int(parts[0]), "subarea": parts[1]}
             else:
@@ -240,6 +287,8 @@ def _parse_action_string(act_str: str, grid_mode: bool) -> dict | None:
         elif act_name in SWIPE_ALIASES:
             inner = re.findall(r'\((.*)\)', act_str)[0]
             parts = [p.strip().strip('"').strip("'") for p in inner.split(",")]
+            if grid_mode and "." in parts[0]:
+                return _parse_raw_action_string(act_str)
             if grid_mode and len(parts) >= 4:
                 return {
                     "action": "swipe_grid",
@@ -297,3 +346,122 @@ def _parse_action_string(act_str: str, grid_mode: bool) -> dict | None:
 
     except (IndexError, ValueError):
         return None
+
+
+# ── Action grammar (guided decoding) ──────────────────────────────────
+# Per agent mode: action name -> argument patterns. Every call these admit is
+# accepted by _parse_action_string / _parse_raw_action_string, so a response
+# decoded under `response_regex` always parses. Bounded repeats cap decode length.
+_G_STR    = r'"[^"\n]{0,200}"'
+_G_INT    = r"[0-9]{1,3}"
+_G_FLOAT  = r"(?:0(?:\.[0-9]{1,4})?|1(?:\.0{1,4})?)"
+_G_SUB    = r'"(?:center|top-left|top|top-right|left|right|bottom-left|bottom|bottom-right)"'
+_G_DIR    = r'"(?:up|down|left|right)"'
+_G_DIST   = r'"(?:short|medium|long)"'
+_G_SCROLL = r'"(?:up|down)"'
+_G_DONE   = r"(?:FINISH|task_complete\(\))"
+
+_COMMON_ACTIONS = {
+    "open": (_G_STR,), "text": (_G_STR,), "clear_text": (), "scroll": (_G_SCROLL,),
+    "answer": (_G_STR,), "wait": (_G_INT,),
+    "enter": (), "back": (), "home": (),
+    "press_enter": (), "press_back": (), "press_home": (),
+}
+
+ACTION_TABLE: dict[str, dict[str, tuple[str, ...]]] = {
+    "element": {
+        **_COMMON_ACTIONS,
+        "tap": (_G_INT,), "long_press": (_G_INT,), "swipe": (_G_INT, _G_DIR, _G_DIST),
+    },
+    "grid": {
+        **_COMMON_ACTIONS,
+        "tap": (_G_INT, _G_SUB), "long_press": (_G_INT, _G_SUB),
+        "swipe": (_G_INT, _G_SUB, _G_INT, _G_SUB),
+    },
+    "raw": {
+        **_COMMON_ACTIONS,
+        "tap": (_G_FLOAT, _G_FLOAT), "swipe": (_G_FLOAT, _G_FLOAT, _G_FLOAT, _G_FLOAT),
+    },
+    # grid2level coarse pass: targeting actions name a coarse area, the system zooms in
+    "grid2level": {**_COMMON_ACTIONS, "tap": (_G_INT,), "long_press": (_G_INT,)},
+    # grid2level fine pass: targeting only, no FINISH
+    "grid2level_fine": {
+        "tap": (_G_INT, _G_SUB), "long_press": (_G_INT, _G_SUB),
+        "swipe": (_G_INT, _G_SUB, _G_INT, _G_SUB),
+    },
+}
+
+FULL_FIELDS = ("Observation", "Thought", "Action", "Summary")
+
+
+def action_table(mode: str, prompt_style: str = "full", thinking_mode: bool = True) -> dict[str, tuple[str, ...]]:
+    """ACTION_TABLE[mode] adjusted to the actions the build_*_prompt for this style offers."""
+    table = dict(ACTION_TABLE[mode])
+    if prompt_style == "orion" and mode == "grid":
+        # the orion grid prompt targets normalized coordinates, like raw mode
+        del table["long_press"]
+        table.update(tap=ACTION_TABLE["raw"]["tap"], swipe=ACTION_TABLE["raw"]["swipe"])
+    if mode in ("grid", "raw") and not response_fields(prompt_style, thinking_mode):
+        # the bare-call (non-thinking) grid/raw prompts name the text action type()
+        table["type"] = (_G_STR,)
+    return table
+
+
+def response_fields(prompt_style: str = "full", thinking_mode: bool = True) -> tuple[str, ...]:
+    """Header lines the build_*_prompt for this style asks for (() = bare function call)."""
+    if prompt_style == "orion":
+        return ("Observation", "Action")
+    if prompt_style == "compact" or thinking_mode:
+        return FULL_FIELDS
+    return ()
+
+
+def action_regex(mode: str, prompt_style: str = "full", thinking_mode: bool = True) -> str:
+    """Regex matching exactly one action call (or FINISH) allowed in `mode` under this prompt."""
+    calls = [
+        re.escape(name) + r"\(" + ", ".join(args) + r"\)"
+        for name, args in action_table(mode, prompt_style, thinking_mode).items()
+    ]
+    if mode != "grid2level_fine":
+        calls.append(_G_DONE)
+    return "(?:" + "|".join(calls) + ")"
+
+
+@lru_cache(maxsize=None)
+def response_regex(
+    mode: str,
+    fields: tuple[str, ...] = FULL_FIELDS,
+    optional_fields: tuple[str, ...] = (),
+    max_field_chars: int = 400,
+    prompt_style: str = "full",
+    thinking_mode: bool = True,
+) -> str:
+    """
+    Regex for a whole response in `mode`: one `Field: value` line per entry of
+    `fields` (Action constrained by `action_regex`, the rest free text on one line),
+    then the `optional_fields` lines, each optional. No fields = a bare action call.
+    """
+    actions = action_regex(mode, prompt_style, thinking_mode)
+
+    def line(field: str) -> str:
+        value = actions if field == "Action" else rf"[^\n]{{1,{max_field_chars}}}"
+        return f"{field}: {value}"
+
+    if not fields:
+        return actions
+    pattern = r"\n".join(line(f) for f in fields)
+    for field in optional_fields:
+        pattern += rf"(?:\n{line(field)})?"
+    return pattern
+
+
+# "Example: tap(5)  ← comment" lines, and zero-argument actions listed without one
+_EXAMPLE_RE = re.compile(r"Example:\s*(.+?)\s*(?:←.*)?$", re.MULTILINE)
+_BARE_ACTION_RE = re.compile(r"^ {2}(\w+\(\)|FINISH)\s*$", re.MULTILINE)
+
+
+def unmatched_examples(prompt: str, mode: str, prompt_style: str = "full", thinking_mode: bool = True) -> list[str]:
+    """Action examples in a system prompt that `action_regex` for the same mode and style rejects."""
+    pattern = re.compile(action_regex(mode, prompt_style, thinking_mode))
+    examples = _EXAMPLE_RE.findall(prompt) + _BARE_ACTION_RE.findall(prompt)
+    return [ex for ex in examples if not pattern.fullmatch(ex)]
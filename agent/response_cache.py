@@ -0,0 +1,230 @@
+"""
+Record/replay cache for model calls.
+
+`CachedModel` wraps any backend from agent/model.py and stores each call's
+(text, usage) in a local SQLite file, keyed by a hash of the prompt, history,
+examples, image bytes and sampling params. Rerunning a recorded trajectory in
+"replay" mode then needs no GPU: parsers, history formatting and the benchmark
+loop can be iterated on in seconds.
+
+Modes:
+  record              always call the model; store (overwrite) the response
+  replay              serve from the cache; a miss raises CacheMiss
+  replay_fallthrough  serve from the cache; on a miss call the model and record it
+"""
+
+import hashlib, json, os, sqlite3, threading, time as _time
+from concurrent.futures import Future
+
+import numpy as np
+from PIL import Image
+
+from .model import _history_image
+
+MODES = ("record", "replay", "replay_fallthrough")
+
+# generate()-style methods whose results are cached; everything else is delegated
+_CACHED_METHODS = ("generate", "generate_n")
+
+# kwargs that never change the response (or are not hashable); history/example
+# entries carry paths that differ per run, so their frames are hashed by content
+_IGNORED_KWARGS = ("action_parser",)
+_HISTORY_PATH_KEYS = ("image", "image_path")
+
+
+class CacheMiss(KeyError):
+    """A replay-mode request that was never recorded."""
+
+
+def unwrap_model(model):
+    """The concrete backend behind any `CachedModel` wrappers."""
+    while isinstance(model, CachedModel):
+        model = model.model
+    return model
+
+
+class _Digester:
+    """Content hashes for the images inside a request; file digests are memoized by mtime."""
+
+    def __init__(self):
+        self._files: dict[tuple, str] = {}
+        self._lock = threading.Lock()
+
+    def image(self, image) -> str:
+        if isinstance(image, (str, os.PathLike)):
+            st = os.stat(image)
+            key = (os.path.abspath(image), st.st_mtime_ns, st.st_size)
+            with self._lock:
+                digest = self._files.get(key)
+            if digest is None:
+                with open(image, "rb") as f:
+                    digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+                with self._lock:
+                    self._files[key] = digest
+            return digest
+        if isinstance(image, (bytes, bytearray, memoryview)):
+            return hashlib.blake2b(image, digest_size=16).hexdigest()
+        if isinstance(image, Image.Image):
+            return hashlib.blake2b(image.tobytes(), digest_size=16).hexdigest()
+        return hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16).hexdigest()
+
+    def entries(self, items: list[dict] | None) -> list | None:
+        """History/ICL entries with their frame replaced by its content hash."""
+        if items is None:
+            return None
+        out = []
+        for h in items:
+            image = _history_image(h)
+            entry = {k: v for k, v in h.items() if k not in _HISTORY_PATH_KEYS}
+            entry["image"] = self.image(image) if image is not None else None
+            out.append(entry)
+        return out
+
+
+class CachedModel:
+    """
+    Record/replay wrapper: `generate`, `agenerate` and `generate_n` go through the
+    cache, every other attribute is the wrapped model's.
+
+    Identical requests within a run (e.g. the same prompt on a stalled screen) are
+    told apart by their occurrence count, so a replay reproduces the recorded
+    sequence; past the recorded count the last recording is reused.
+
+    A background `summary_future` in usage is recorded when it resolves and
+    replayed as an already-completed future.
+    """
+
+    def __init__(self, model, path: str, mode: str = "record"):
+        if mode not in MODES:
+            raise ValueError(f"response cache mode must be one of {MODES}, got {mode!r}")
+        self.model = model
+        self.path = path
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self._digest = _Digester()
+        self._occurrences: dict[str, int] = {}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT, occurrence INTEGER, method TEXT, response TEXT, usage TEXT,"
+            " summary TEXT, created REAL, PRIMARY KEY (key, occurrence))"
+        )
+        self._db.commit()
+        print(f"[response_cache] {mode} {path} "
+              f"({self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]} entries)")
+
+    def __getattr__(self, name: str):
+        # only reached for attributes not set in __init__
+        if name in _CACHED_METHODS:
+            method = getattr(self.model, name)  # AttributeError if the backend lacks it
+            return lambda *args, **kwargs: self._call(name, method, args, kwargs)
+        return getattr(self.model, name)
+
+    # ── Keys ─────────────────────────────────────────────────────────
+
+    def _key(self, method: str, args: tuple, kwargs: dict) -> str:
+        call = {k: v for k, v in kwargs.items() if k not in _IGNORED_KWARGS}
+        if "image_path" in call and call["image_path"] is not None:
+            call["image_path"] = self._digest.image(call["image_path"])
+        for k in ("history", "examples", "pass2_history"):
+            if k in call:
+                call[k] = self._digest.entries(call[k])
+        backend = unwrap_model(self.model)
+        payload = {
+            "backend": type(backend).__name__,
+            "models": [getattr(backend, a, None) for a in ("model_name", "base_model", "lora_model")],
+            "method": "generate_n" if method == "generate_n" else "generate",
+            "args": list(args),
+            "kwargs": call,
+            # early action stops change the returned text
+            "early_stop": kwargs.get("action_parser") is not None and getattr(backend, "early_action", "off") != "off",
+        }
+        blob = json.dumps(payload, sort_keys=True, default=str)
+        return hashlib.blake2b(blob.encode(), digest_size=20).hexdigest()
+
+    def _next_occurrence(self, key: str) -> int:
+        with self._lock:
+            n = self._occurrences.get(key, 0)
+            self._occurrences[key] = n + 1
+        return n
+
+    # ── Store ────────────────────────────────────────────────────────
+
+    def _load(self, key: str, occurrence: int):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response, usage, summary FROM responses WHERE key = ? AND occurrence <= ?"
+                " ORDER BY occurrence DESC LIMIT 1", (key, occurrence),
+            ).fetchone()
+        if row is None:
+            return None
+        response, usage, summary = json.loads(row[0]), json.loads(row[1]), row[2]
+        if summary is not None:
+            future = Future()
+            future.set_result(tuple(json.loads(summary)))
+            usage["summary_future"] = future
+        usage["cache_hit"] = True
+        return response, usage
+
+    def _store(self, key: str, occurrence: int, method: str, response, usage: dict) -> None:
+        summary_future = usage.get("summary_future")
+        stored_usage = {k: v for k, v in usage.items() if k != "summary_future"}
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, NULL, ?)",
+                (key, occurrence, method, json.dumps(response), json.dumps(stored_usage), _time.time()),
+            )
+            self._db.commit()
+        if summary_future is not None:
+            summary_future.add_done_callback(lambda f: self._store_summary(key, occurrence, f))
+
+    def _store_summary(self, key: str, occurrence: int, future: Future) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+        summary = future.result()
+        with self._lock:
+            self._db.execute("UPDATE responses SET summary = ? WHERE key = ? AND occurrence = ?",
+                             (json.dumps(list(summary)), key, occurrence))
+            self._db.commit()
+
+    # ── Calls ────────────────────────────────────────────────────────
+
+    def _lookup(self, method: str, args: tuple, kwargs: dict):
+        """Returns (key, occurrence, cached_or_None); raises CacheMiss in strict replay."""
+        key = self._key(method, args, kwargs)
+        occurrence = self._next_occurrence(key)
+        cached = self._load(key, occurrence) if self.mode != "record" else None
+        if cached is not None:
+            self.hits += 1
+        elif self.mode != "record":
+            self.misses += 1
+            if self.mode == "replay":
+                raise CacheMiss(f"no recorded response for {method} (key={key[:12]}, occurrence={occurrence})")
+        return key, occurrence, cached
+
+    def _call(self, method: str, fn, args: tuple, kwargs: dict):
+        key, occurrence, cached = self._lookup(method, args, kwargs)
+        if cached is not None:
+            return cached
+        response, usage = fn(*args, **kwargs)
+        self._store(key, occurrence, method, response, usage)
+        return response, usage
+
+    async def agenerate(self, *args, **kwargs):
+        key, occurrence, cached = self._lookup("agenerate", args, kwargs)
+        if cached is not None:
+            return cached
+        response, usage = await self.model.agenerate(*args, **kwargs)
+        self._store(key, occurrence, "agenerate", response, usage)
+        return response, usage
+
+    def stats(self) -> dict:
+        return {"mode": self.mode, "hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,216 @@
+"""
+Background scraper for the vLLM server's Prometheus `/metrics`.
+
+Client-side latency (TTFT, decode) says a step was slow; the server's counters say
+why: time spent queued behind other requests, prefix-cache misses, KV-cache pressure
+and preemptions. `ServerMetricsCollector` polls every endpoint's `/metrics` on a
+daemon thread and reduces the samples between two points in time to one window:
+
+    collector = ServerMetricsCollector("http://127.0.0.1:8000/v1")   # or a VLLM_BASE_URL list
+    mark = collector.mark()
+    ...                          # one agent step
+    collector.window(mark)       # {"queue_time_s": 0.012, "prefix_hit_rate": 0.41, ...}
+
+On a latency-sensitive path use `window(mark, refresh=False)`: the window then ends at
+the latest background sample instead of a synchronous scrape of every endpoint.
+
+Counters are differenced across the window (summed over endpoints); gauges report
+the mean and peak of the samples taken inside it. Both vLLM V1 and V0 metric names
+are understood (kv_cache_usage_perc / gpu_cache_usage_perc, prefix_cache_* counters /
+gpu_prefix_cache_hit_rate).
+"""
+
+import threading, time, urllib.request
+from collections import deque
+
+from .model import _base_urls
+
+# counters and histogram _sum/_count series, differenced over a window
+_COUNTERS = {
+    "queue_sum":      "vllm:request_queue_time_seconds_sum",
+    "queue_count":    "vllm:request_queue_time_seconds_count",
+    "ttft_sum":       "vllm:time_to_first_token_seconds_sum",
+    "ttft_count":     "vllm:time_to_first_token_seconds_count",
+    "prefix_queries": "vllm:prefix_cache_queries_total",
+    "prefix_hits":    "vllm:prefix_cache_hits_total",
+    "preemptions":    "vllm:num_preemptions_total",
+}
+# gauges, sampled over a window; V0 names are fallbacks for the V1 ones
+_GAUGES = {
+    "running":     ("vllm:num_requests_running",),
+    "waiting":     ("vllm:num_requests_waiting",),
+    "kv_usage":    ("vllm:kv_cache_usage_perc", "vllm:gpu_cache_usage_perc"),
+    "v0_prefix_hit_rate": ("vllm:gpu_prefix_cache_hit_rate",),
+}
+_TRACKED = set(_COUNTERS.values()) | {name for names in _GAUGES.values() for name in names}
+
+
+def _metrics_url(base_url: str) -> str:
+    # vLLM serves /metrics at the server root, next to /v1
+    root = base_url.rstrip("/")
+    return (root[:-3] if root.endswith("/v1") else root) + "/metrics"
+
+
+def parse_metrics(text: str, names: set[str] = _TRACKED) -> dict[str, float]:
+    """Prometheus text exposition -> {metric name: value summed over label sets}."""
+    values: dict[str, float] = {}
+    for line in text.splitlines():
+        if not line or line[0] == "#":
+            continue
+        brace = line.find("{")
+        if brace >= 0:
+            name, rest = line[:brace], line[line.rfind("}") + 1:]
+        else:
+            name, _, rest = line.partition(" ")
+        if name not in names:
+            continue
+        try:
+            value = float(rest.split()[0])
+        except (IndexError, ValueError):
+            continue
+        values[name] = values.get(name, 0.0) + value
+    return values
+
+
+class ServerMetricsCollector:
+    """Polls `/metrics` on each endpoint every `interval_s`; keeps `history_s` of samples."""
+
+    def __init__(self, base_url: str | list[str], interval_s: float = 0.5, history_s: float = 900.0,
+                 timeout_s: float = 2.0):
+        self.base_urls = _base_urls(base_url)
+        self.interval_s = interval_s
+        self.timeout_s = timeout_s
+        maxlen = max(int(history_s / interval_s), 16)
+        # per endpoint: deque of (monotonic time, {metric: value})
+        self._samples = {url: deque(maxlen=maxlen) for url in self.base_urls}
+        self._errors = {url: 0 for url in self.base_urls}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._poll_loop, name="server_metrics", daemon=True)
+        self._thread.start()
+        print(f"[server_metrics] polling {len(self.base_urls)} endpoint(s) every {interval_s}s")
+
+    # ── Sampling ─────────────────────────────────────────────────────
+
+    def _scrape(self, url: str) -> tuple[float, dict] | None:
+        try:
+            with urllib.request.urlopen(_metrics_url(url), timeout=self.timeout_s) as resp:
+                text = resp.read().decode("utf-8", "replace")
+        except Exception as e:
+            with self._lock:
+                self._errors[url] += 1
+                first = self._errors[url] == 1
+            if first:
+                print(f"[server_metrics] {_metrics_url(url)} unavailable: {e}")
+            return None
+        sample = (time.monotonic(), parse_metrics(text))
+        with self._lock:
+            self._samples[url].append(sample)
+        return sample
+
+    def _poll_loop(self) -> None:
+        while not self._stop.is_set():
+            for url in self.base_urls:
+                self._scrape(url)
+            self._stop.wait(self.interval_s)
+
+    def _latest(self, url: str) -> tuple[float, dict] | None:
+        with self._lock:
+            return self._samples[url][-1] if self._samples[url] else None
+
+    # ── Windows ──────────────────────────────────────────────────────
+
+    def mark(self) -> dict:
+        """Start of a window: the latest background sample per endpoint (no request is made)."""
+        return {"t": time.monotonic(), "baseline": {url: self._latest(url) for url in self.base_urls}}
+
+    def window(self, mark: dict, refresh: bool = True) -> dict:
+        """
+        Server activity since `mark`. With `refresh`, each endpoint is scraped once more
+        so the window closes after the caller's own requests finished.
+        """
+        totals = {key: 0.0 for key in _COUNTERS}
+        gauges: dict[str, list[float]] = {key: [] for key in _GAUGES}
+        peaks = {"running": 0.0, "waiting": 0.0}
+        n_samples = 0
+        for url in self.base_urls:
+            end = self._scrape(url) if refresh else None
+            end = end or self._latest(url)
+            start = mark["baseline"].get(url)
+            if end is None:
+                continue
+            with self._lock:
+                inside = [s for s in self._samples[url] if s[0] >= mark["t"]]
+            if start is None:
+                # collector started inside the window: count from its first sample
+                start = inside[0] if inside else end
+            for key, name in _COUNTERS.items():
+                delta = end[1].get(name, 0.0) - start[1].get(name, 0.0)
+                # a negative delta means the server restarted: its counters began at 0
+                totals[key] += delta if delta >= 0 else end[1].get(name, 0.0)
+            inside = inside or [end]
+            n_samples += len(inside)
+            for key, names in _GAUGES.items():
+                name = next((n for n in names if n in end[1]), None)
+                if name is None:
+                    continue
+                series = [s[1][name] for s in inside if name in s[1]]
+                if not series:
+                    continue
+                if key in peaks:
+                    # requests on different servers add up; peaks are per-endpoint upper bounds
+                    peaks[key] += max(series)
+                    gauges[key].append(sum(series) / len(series))
+                else:
+                    gauges[key] += series
+
+        if not n_samples:
+            return {}
+        return {
+            "window_s": round(time.monotonic() - mark["t"], 3),
+            "requests": int(totals["queue_count"]),
+            "queue_time_s": round(totals["queue_sum"] / totals["queue_count"], 4) if totals["queue_count"] else 0.0,
+            "server_ttft_s": round(totals["ttft_sum"] / totals["ttft_count"], 4) if totals["ttft_count"] else 0.0,
+            "prefix_queries": int(totals["prefix_queries"]),
+            "prefix_hit_rate": (round(totals["prefix_hits"] / totals["prefix_queries"], 4) if totals["prefix_queries"]
+                                else round(max(gauges["v0_prefix_hit_rate"], default=0.0), 4)),
+            "preemptions": int(totals["preemptions"]),
+            "running_avg": round(sum(gauges["running"]), 2),
+            "running_max": int(peaks["running"]),
+            "waiting_avg": round(sum(gauges["waiting"]), 2),
+            "waiting_max": int(peaks["waiting"]),
+            "kv_usage_max": round(max(gauges["kv_usage"], default=0.0), 4),
+            "samples": n_samples,
+        }
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join(timeout=self.timeout_s + self.interval_s)
+
+
+def summarize_windows(windows: list[dict]) -> dict:
+    """Combine per-step windows into one task-level record (rates weighted by their denominators)."""
+    windows = [w for w in windows if w]
+    if not windows:
+        return {}
+    requests = sum(w["requests"] for w in windows)
+    queries = sum(w["prefix_queries"] for w in windows)
+
+    def weighted(key: str, weight: str) -> float:
+        total = sum(w[weight] for w in windows)
+        return sum(w[key] * w[weight] for w in windows) / total if total else 0.0
+
+    return {
+        "requests": requests,
+        "queue_time_s": round(weighted("queue_time_s", "requests"), 4),
+        "queue_time_max_s": max(w["queue_time_s"] for w in windows),
+        "server_ttft_s": round(weighted("server_ttft_s", "requests"), 4),
+        "prefix_hit_rate": round(weighted("prefix_hit_rate", "prefix_queries"), 4) if queries
+                           else round(sum(w["prefix_hit_rate"] for w in windows) / len(windows), 4),
+        "preemptions": sum(w["preemptions"] for w in windows),
+        "running_avg": round(weighted("running_avg", "window_s"), 2),
+        "running_max": max(w["running_max"] for w in windows),
+        "waiting_avg": round(weighted("waiting_avg", "window_s"), 2),
+        "waiting_max": max(w["waiting_max"] for w in windows),
+        "kv_usage_max": max(w["kv_usage_max"] for w in windows),
+    }
@@ -0,0 +1,110 @@
+"""
+Lightweight span tracing in Chrome trace-event format (open the JSON in
+https://ui.perfetto.dev or chrome://tracing).
+
+Tracing is off until `begin(path)`; every call below is then a cheap no-op, so
+spans can stay in hot paths. `run_aw_benchmark.py --trace` writes one file per task:
+
+    trace.begin("output/.../task/trace.json")
+    with trace.span("step", step=3) as args:
+        ...
+        args["action"] = "tap(5)"          # attached to the span when it closes
+    trace.complete("prefill", t_request_start, t_first_token)   # measured elsewhere
+    trace.end()
+
+Timestamps are `time.perf_counter()` values, the clock every latency in this repo
+already uses, so existing measurements can be emitted retroactively.
+"""
+
+import json, os, threading, time
+from contextlib import contextmanager
+from functools import wraps
+
+_lock = threading.Lock()
+_events: list[dict] | None = None  # None while tracing is off
+_threads: dict[int, str] = {}
+_path: str | None = None
+_PID = os.getpid()
+
+
+def enabled() -> bool:
+    return _events is not None
+
+
+def begin(path: str) -> None:
+    """Start collecting spans for a new trace file (an unfinished trace is written first)."""
+    global _events, _path
+    end()
+    with _lock:
+        _events, _path = [], path
+        _threads.clear()
+
+
+def end() -> str | None:
+    """Stop tracing and write the collected events; returns the file path."""
+    global _events, _path
+    with _lock:
+        events, path, _events, _path = _events, _path, None, None
+        threads = dict(_threads)
+    if events is None:
+        return None
+    meta = [{"ph": "M", "name": "thread_name", "pid": _PID, "tid": tid, "args": {"name": name}}
+            for tid, name in threads.items()]
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": meta + events, "displayTimeUnit": "ms"}, f)
+    return path
+
+
+def _emit(event: dict) -> None:
+    thread = threading.current_thread()
+    tid = thread.native_id
+    event["pid"], event["tid"] = _PID, tid
+    with _lock:
+        if _events is None:
+            return
+        _events.append(event)
+        if tid not in _threads:
+            _threads[tid] = thread.name
+
+
+def complete(name: str, start: float, end: float, cat: str = "agent", **args) -> None:
+    """A span measured elsewhere, from two perf_counter() timestamps."""
+    if _events is None:
+        return
+    _emit({"ph": "X", "name": name, "cat": cat, "ts": start * 1e6, "dur": max(end - start, 0.0) * 1e6,
+           "args": args})
+
+
+def instant(name: str, cat: str = "agent", **args) -> None:
+    if _events is None:
+        return
+    _emit({"ph": "i", "s": "t", "name": name, "cat": cat, "ts": time.perf_counter() * 1e6, "args": args})
+
+
+@contextmanager
+def span(name: str, cat: str = "agent", **args):
+    """Time the enclosed block; yields its args dict so results can be added before it closes."""
+    if _events is None:
+        yield args
+        return
+    start = time.perf_counter()
+    try:
+        yield args
+    finally:
+        complete(name, start, time.perf_counter(), cat, **args)
+
+
+def traced(name: str | None = None, cat: str = "agent"):
+    """Decorator form of `span`, named after the function by default."""
+    def decorate(fn):
+        label = name or fn.__qualname__
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _events is None:
+                return fn(*args, **kwargs)
+            with span(label, cat):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
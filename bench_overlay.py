@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark: per-step preprocess time of the AWAgentAdapter overlays, drawn the
+old way (ImageDraw per rectangle and label, font loaded per call) versus the
+cached compositor in agent/overlay.py.
+
+Modes timed, each the same work the adapter counts as preprocess_s:
+  grid              numbered GRID_ROWS x GRID_COLS grid on the full frame
+  grid2level coarse COARSE_GRID_ROWS x COARSE_GRID_COLS grid on the full frame
+  grid2level fine   crop + resize to FINE_IMG_TARGET_SIZE + fine grid
+  element           boxes and number badges for --elements elements
+
+Each mode also checks the two renderings are pixel-identical.
+
+Usage:
+  python bench_overlay.py                          # examples/001_screenshot.png
+  python bench_overlay.py --image shot.png --elements 120 --iters 50
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from agent.android_controller import ElementStore, UIElement
+from agent.aw_adapter import (
+    CELL_H, CELL_W, DEFAULT_COARSE_COLS, DEFAULT_COARSE_ROWS, DEFAULT_FINE_COLS, DEFAULT_FINE_ROWS,
+    FINE_IMG_TARGET_SIZE, GRID_COLS, GRID_ROWS, SCREEN_H, SCREEN_W,
+    _draw_element_labels, _draw_numbered_grid,
+)
+
+COLOR = (255, 116, 113)
+
+
+# ── Reference: direct ImageDraw rendering ────────────────────────────
+
+def _load_font(size: int):
+    try:
+        return ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", size=size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def direct_grid(img: Image.Image, gr: int, gc: int, cw: int, ch: int) -> Image.Image:
+    draw = ImageDraw.Draw(img)
+    font = _load_font(max(20, min(cw, ch) // 4))
+    for r in range(gr):
+        for c in range(gc):
+            x0, y0 = c * cw, r * ch
+            draw.rectangle([x0, y0, x0 + cw, y0 + ch], outline=COLOR, width=3)
+            draw.text((x0 + 4, y0 + 4), str(r * gc + c + 1), fill=COLOR, font=font)
+    return img
+
+
+def direct_labels(img: Image.Image, elem_list) -> Image.Image:
+    draw = ImageDraw.Draw(img)
+    font = _load_font(28)
+    for idx, elem in enumerate(elem_list, 1):
+        (x1, y1), (x2, y2) = elem.bbox
+        x1, x2 = min(x1, x2), max(x1, x2)
+        y1, y2 = min(y1, y2), max(y1, y2)
+        if x1 == x2 or y1 == y2:
+            continue
+        draw.rectangle([x1, y1, x2, y2], outline=COLOR, width=3)
+        cx, cy = elem.center
+        label = str(idx)
+        tw, th = len(label) * 14 + 8, 28
+        lx, ly = cx - tw // 2, cy - th // 2
+        draw.rectangle([lx, ly, lx + tw, ly + th], fill=(0, 0, 0, 180))
+        draw.text((lx + 4, ly + 2), label, fill=COLOR, font=font)
+    return img
+
+
+# ── Workloads ────────────────────────────────────────────────────────
+
+def random_elements(n: int, seed: int = 0) -> ElementStore:
+    rng = random.Random(seed)
+    store = ElementStore()
+    while len(store) < n:
+        x, y = rng.randrange(0, SCREEN_W - 40), rng.randrange(0, SCREEN_H - 40)
+        w, h = rng.randrange(40, 400), rng.randrange(40, 200)
+        x2, y2 = min(x + w, SCREEN_W), min(y + h, SCREEN_H)
+        store.add(UIElement(uid=f"e{len(store)}", bbox=((x, y), (x2, y2)), center=((x + x2) // 2, (y + y2) // 2)))
+    return store
+
+
+def modes(frame: Image.Image, elems: ElementStore) -> dict:
+    coarse_cw, coarse_ch = SCREEN_W // DEFAULT_COARSE_COLS, SCREEN_H // DEFAULT_COARSE_ROWS
+    fine_cw, fine_ch = FINE_IMG_TARGET_SIZE[0] // DEFAULT_FINE_COLS, FINE_IMG_TARGET_SIZE[1] // DEFAULT_FINE_ROWS
+
+    def fine(draw_fn):
+        # zoom into the 2nd coarse cell, as the adapter does before drawing the fine grid
+        crop = frame.crop((coarse_cw, 0, 2 * coarse_cw, coarse_ch))
+        enlarged = crop.resize(FINE_IMG_TARGET_SIZE, Image.LANCZOS)
+        return draw_fn(enlarged.copy(), DEFAULT_FINE_ROWS, DEFAULT_FINE_COLS, fine_cw, fine_ch)
+
+    return {
+        "grid": (lambda: direct_grid(frame.copy(), GRID_ROWS, GRID_COLS, CELL_W, CELL_H),
+                 lambda: _draw_numbered_grid(frame.copy())),
+        "grid2level coarse": (
+            lambda: direct_grid(frame.copy(), DEFAULT_COARSE_ROWS, DEFAULT_COARSE_COLS, coarse_cw, coarse_ch),
+            lambda: _draw_numbered_grid(frame.copy(), DEFAULT_COARSE_ROWS, DEFAULT_COARSE_COLS,
+                                        coarse_cw, coarse_ch)),
+        "grid2level fine": (lambda: fine(direct_grid), lambda: fine(_draw_numbered_grid)),
+        "element": (lambda: direct_labels(frame.copy(), elems),
+                    lambda: _draw_element_labels(frame.copy(), elems)),
+    }
+
+
+def _median_ms(fn, iters: int) -> float:
+    times = []
+    for _ in range(iters):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", default="examples/001_screenshot.png")
+    parser.add_argument("--elements", type=int, default=60)
+    parser.add_argument("--iters", type=int, default=30)
+    args = parser.parse_args()
+
+    frame = Image.open(args.image).convert("RGB").resize((SCREEN_W, SCREEN_H))
+    elems = random_elements(args.elements)
+
+    print(f"{'mode':<20} {'direct ms':>10} {'cached ms':>10} {'saved':>7}  identical")
+    for name, (direct, cached) in modes(frame, elems).items():
+        same = np.array_equal(np.asarray(direct()), np.asarray(cached()))  # also warms the caches
+        t_direct, t_cached = _median_ms(direct, args.iters), _median_ms(cached, args.iters)
+        print(f"{name:<20} {t_direct:>10.2f} {t_cached:>10.2f} {1 - t_cached / t_direct:>6.0%}  {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Check that the "prefix" PROMPT_LAYOUT lets consecutive steps share a token prefix
+covering the history frames.
+
+Runs a synthetic element-mode episode through the agent's prompt builder
+(AWAgentAdapter._build_prompt) and vLLM message builder, renders each request with
+the stand-in server's chat template and feeds it to its PrefixCache. Every history
+frame a step sends must lie inside the prefix it shares with the next step's
+request, for as long as the MAX_HISTORY_STEPS window is filling (once it slides,
+the oldest frame drops out and the shared prefix ends at the first frame).
+The "default" layout is shown for comparison.
+
+Usage:
+  python check_prefix_cache.py                     # 6 steps, 3 history frames
+  python check_prefix_cache.py --steps 10 --history 4 --image-tokens 1024
+"""
+
+import argparse
+import os
+import random
+import sys
+
+import numpy as np
+from PIL import Image
+
+from agent.android_controller import ElementStore, UIElement
+from agent.aw_adapter import SCREEN_H, SCREEN_W, AWAgentAdapter, _action_dict_to_str
+from agent.model import _build_vllm_messages
+from agent.prompt import build_element_prompt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server"))
+from standin_server import PrefixCache, render_prompt  # noqa: E402
+
+
+def prompt_builder(layout: str, history_steps: int) -> AWAgentAdapter:
+    """An adapter with only the state `_build_prompt` reads (no env or model)."""
+    agent = object.__new__(AWAgentAdapter)
+    agent.element_prompt = build_element_prompt(SCREEN_W, SCREEN_H, thinking_mode=False)
+    agent.raw_prompt = agent.grid_prompt = agent.element_prompt
+    agent.agent_mode = "element"
+    agent._prompt_layout = layout
+    agent.max_history_steps = history_steps
+    agent._max_steps = 25
+    agent._history = []
+    agent._step_count = 0
+    agent._stall_count = 0
+    agent._elem_list = ElementStore()
+    return agent
+
+
+def random_screen(rng: random.Random) -> tuple[Image.Image, ElementStore]:
+    frame = Image.fromarray(np.random.default_rng(rng.randrange(2**32)).integers(0, 255, (96, 48, 3), np.uint8))
+    elems = ElementStore()
+    for i in range(rng.randrange(5, 15)):
+        x, y = rng.randrange(0, SCREEN_W - 200), rng.randrange(0, SCREEN_H - 100)
+        elems.add(UIElement(uid=f"e{i}", bbox=((x, y), (x + 200, y + 100)), center=(x + 100, y + 50),
+                            text=rng.choice(["OK", "Cancel", "Search", "Settings", ""])))
+    return frame, elems
+
+
+def run(layout: str, args) -> list[dict]:
+    """Per-step token counts: prompt, cached, end of the history frames, prefix shared with the previous step."""
+    rng = random.Random(args.seed)
+    agent = prompt_builder(layout, args.history)
+    cache = PrefixCache(block_size=args.block_size)
+    prev_tokens, rows = None, []
+    for step in range(1, args.steps + 1):
+        frame, agent._elem_list = random_screen(rng)
+        agent._stall_count = rng.choice([0, 0, 1])
+        window = agent._history[-args.history:] if args.history > 0 else []
+        messages = _build_vllm_messages(agent._build_prompt("Open the settings app and turn on wifi"),
+                                        frame, window, None, layout=layout)
+        tokens = render_prompt(messages, args.image_tokens, False, True)
+        ends = [i + 1 for i, t in enumerate(tokens) if t == "<|vision_end|>"]
+        shared = 0
+        if prev_tokens is not None:
+            while shared < min(len(tokens), len(prev_tokens)) and tokens[shared] == prev_tokens[shared]:
+                shared += 1
+        rows.append({"step": step, "frames": len(window), "prompt": len(tokens),
+                     "cached": cache.lookup_and_insert("model", tokens),
+                     "frames_end": ends[-2] if len(ends) > 1 else 0, "shared": shared})
+        action = {"action": "tap", "element": rng.randrange(1, len(agent._elem_list) + 1)}
+        agent._history.append({"summary": f"I tapped {_action_dict_to_str(action)}.", "action": action, "image": frame})
+        agent._step_count = step
+        prev_tokens = tokens
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--steps", type=int, default=6)
+    parser.add_argument("--history", type=int, default=3, help="MAX_HISTORY_STEPS")
+    parser.add_argument("--image-tokens", type=int, default=256)
+    parser.add_argument("--block-size", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    failed = False
+    for layout in ("default", "prefix"):
+        print(f"\n{layout} layout")
+        print(f"  {'step':>4} {'frames':>6} {'prompt':>7} {'cached':>7} {'hit':>5}  shared prefix")
+        rows = run(layout, args)
+        for prev, row in zip([None] + rows, rows):
+            status = ""
+            if prev is not None and prev["frames"]:
+                covered = row["shared"] >= prev["frames_end"]
+                status = "covers the previous step's frames" if covered else "ends before the previous step's frames"
+                if layout == "prefix" and row["frames"] > prev["frames"] and not covered:
+                    failed = True
+            print(f"  {row['step']:>4} {row['frames']:>6} {row['prompt']:>7} {row['cached']:>7} "
+                  f"{row['cached'] / row['prompt']:>5.0%}  {status}")
+    if failed:
+        sys.exit("FAIL: the prefix layout did not keep the history frames in the shared prefix")
+    print("\nOK: consecutive prefix-layout steps share every history frame while the window fills")
+
+
+if __name__ == "__main__":
+    main()
@@ -370,6 +370,17 @@ def load_run(run_id: str, base_dir: str) -> dict | None:
     total_prompt = sum(t.get("token_totals", {}).get("prompt_tokens", 0) for t in tasks)
     total_comp = sum(t.get("token_totals", {}).get("completion_tokens", 0) for t in tasks)
 
+    # vLLM /metrics windows (run_aw_benchmark.py --server_metrics)
+    servers = [t["server"] for t in tasks if t.get("server")]
+    server_avg = {
+        "queue_time_s": round(sum(s["queue_time_s"] for s in servers) / len(servers), 4),
+        "queue_time_max_s": max(s["queue_time_max_s"] for s in servers),
+        "prefix_hit_rate": round(sum(s["prefix_hit_rate"] for s in servers) / len(servers), 4),
+        "waiting_max": max(s["waiting_max"] for s in servers),
+        "kv_usage_max": max(s["kv_usage_max"] for s in servers),
+        "preemptions": sum(s["preemptions"] for s in servers),
+    } if servers else {}
+
     meta = ABLATION_LABELS.get(run_id, {})
     label = _get_run_label(run_id)
 
@@ -389,6 +400,7 @@ def load_run(run_id: str, base_dir: str) -> dict | None:
         "total_prompt_tokens": total_prompt,
         "total_completion_tokens": total_comp,
         "latency_avg": lat_avgs,
+        "server_avg": server_avg,
         "failure_counts": failure_counts,
         "tasks": tasks,
     }
@@ -921,6 +933,8 @@ def api_ablation_table():
                 "avg_ttft_s": 0,
                 "avg_decode_s": 0,
                 "avg_tpot_ms": 0,
+                "avg_queue_ms": 0,
+                "preemptions": 0,
             })
         else:
             for base in BASE_DIRS:
@@ -951,6 +965,8 @@ def api_ablation_table():
                     "avg_ttft_s": data["latency_avg"].get("ttft_s", 0),
                     "avg_decode_s": data["latency_avg"].get("decode_s", 0),
                     "avg_tpot_ms": data["latency_avg"].get("tpot_ms", 0),
+                    "avg_queue_ms": round(data["server_avg"].get("queue_time_s", 0) * 1000, 1),
+                    "preemptions": data["server_avg"].get("preemptions", 0),
                 })
                 break
     order_idx = {rid: i for i, rid in enumerate(RUN_ORDER)}
@@ -1227,6 +1243,8 @@ tr.expandable:hover td:first-child{text-decoration:underline}
           <th data-abl="avg_ttft_s" data-num>TTFT (s)</th>
           <th data-abl="avg_decode_s" data-num>Decode (s)</th>
           <th data-abl="avg_tpot_ms" data-num>TPOT (ms)</th>
+          <th data-abl="avg_queue_ms" data-num>Queue (ms)</th>
+          <th data-abl="preemptions" data-num>Preempt</th>
         </tr></thead>
         <tbody id="ablation-tbody"></tbody>
       </table>
@@ -1317,6 +1335,8 @@ function renderAblation() {
       <td class="num">${isMa ? '—' : r.avg_ttft_s}</td>
       <td class="num">${isMa ? '—' : r.avg_decode_s}</td>
       <td class="num">${isMa ? '—' : r.avg_tpot_ms}</td>
+      <td class="num">${isMa ? '—' : r.avg_queue_ms}</td>
+      <td class="num">${isMa ? '—' : r.preemptions}</td>
     </tr>`;
   }).join('');
 }
@@ -1626,7 +1646,7 @@ async function renderCompare() {
 function exportToCSV() {
   if (currentTab === 'ablation') {
     if (!ablationData) return;
-    const cols = ["experiment", "model", "agent_mode", "thinking", "stall_action", "notes", "accuracy", "avg_steps", "avg_comp_tokens", "avg_prompt_tokens", "total_wall_clock_h", "avg_step_total_s", "avg_screenshot_s", "avg_preprocess_s", "avg_inference_s", "avg_action_s", "avg_ttft_s", "avg_decode_s", "avg_tpot_ms"];
+    const cols = ["experiment", "model", "agent_mode", "thinking", "stall_action", "notes", "accuracy", "avg_steps", "avg_comp_tokens", "avg_prompt_tokens", "total_wall_clock_h", "avg_step_total_s", "avg_screenshot_s", "avg_preprocess_s", "avg_inference_s", "avg_action_s", "avg_ttft_s", "avg_decode_s", "avg_tpot_ms", "avg_queue_ms", "preemptions"];
     let csv = cols.join(",") + "\n";
     let data = [...ablationData];
     if (ablSortKey) {
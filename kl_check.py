@@ -20,7 +20,6 @@ Usage:
 """
 
 import argparse
-import base64
 import json
 import math
 import os
@@ -30,15 +29,13 @@ import sys
 import time
 import traceback
 from collections import defaultdict
-from pathlib import Path
-
-import io
 
 import numpy as np
-from PIL import Image
 from openai import OpenAI
 from tqdm import tqdm
 
+from agent.model import ImageTransport, image_data_url
+
 MAX_RETRIES = 3
 RETRY_BACKOFF = 5  # seconds, doubles each retry
 
@@ -66,26 +63,22 @@ N_GEN_PROMPT_TOKENS = 4
 # Helpers
 # ---------------------------------------------------------------------------
 
-def load_image_b64(path: str, max_pixels: int | None = None) -> str:
-    """Load image as base64.  Optionally resize so total pixels ≤ max_pixels
-    (reduces vision-token count and GPU memory for prompt_logprobs)."""
-    if max_pixels is None:
-        return base64.b64encode(Path(path).read_bytes()).decode()
-    img = Image.open(path)
-    w, h = img.size
-    if w * h > max_pixels:
-        scale = (max_pixels / (w * h)) ** 0.5
-        img = img.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
-    buf = io.BytesIO()
-    img.save(buf, format="JPEG", quality=80)
-    return base64.b64encode(buf.getvalue()).decode()
+def load_image_url(path: str, max_pixels: int | None = None) -> str:
+    """Load image as a data URL.  Optionally resize so total pixels ≤ max_pixels
+    (reduces vision-token count and GPU memory for prompt_logprobs); resized
+    images are sent as JPEG, otherwise the file goes out untouched."""
+    transport = (
+        ImageTransport(format="jpeg", quality=80, max_pixels=max_pixels)
+        if max_pixels is not None else ImageTransport()
+    )
+    return image_data_url(path, transport)
 
 
-def _img_block(b64: str) -> dict:
-    return {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64}"}}
+def _img_block(url: str) -> dict:
+    return {"type": "image_url", "image_url": {"url": url}}
 
 
-def _text_and_image_blocks(text: str, img_b64: str) -> list[dict]:
+def _text_and_image_blocks(text: str, img_url: str) -> list[dict]:
     """Split text on <image> placeholder and interleave with image blocks."""
     parts = text.split("<image>")
     blocks = []
@@ -93,23 +86,23 @@ def _text_and_image_blocks(text: str, img_b64: str) -> list[dict]:
         if seg:
             blocks.append({"type": "text", "text": seg})
         if i < len(parts) - 1:
-            blocks.append(_img_block(img_b64))
+            blocks.append(_img_block(img_url))
     return blocks
 
 
 def build_ni_messages(entry: dict, image_dir: str, max_pixels: int | None = None) -> list[dict]:
     """Natural-Inference prompt: asks the model to reason then act."""
     user_text = entry["messages"][0]["content"]
-    img_b64 = load_image_b64(os.path.join(image_dir, entry["images"][0]), max_pixels)
+    img_url = load_image_url(os.path.join(image_dir, entry["images"][0]), max_pixels)
     ni_text = user_text.replace(ORIGINAL_INSTRUCTION, REASONING_INSTRUCTION_NI)
-    return [{"role": "user", "content": _text_and_image_blocks(ni_text, img_b64)}]
+    return [{"role": "user", "content": _text_and_image_blocks(ni_text, img_url)}]
 
 
 def build_tf_messages(entry: dict, image_dir: str, max_pixels: int | None = None) -> list[dict]:
     """Teacher-Forcing prompt: reveals the correct action, asks for reasoning."""
     user_text = entry["messages"][0]["content"]
     target_action = entry["messages"][1]["content"]
-    img_b64 = load_image_b64(os.path.join(image_dir, entry["images"][0]), max_pixels)
+    img_url = load_image_url(os.path.join(image_dir, entry["images"][0]), max_pixels)
     tf_instruction = (
         f"The correct next action is: {target_action}\n"
         "Your response MUST follow this exact format:\n"
@@ -117,7 +110,7 @@ def build_tf_messages(entry: dict, image_dir: str, max_pixels: int | None = None
         "  Action: <repeat the correct action above>"
     )
     tf_text = user_text.replace(ORIGINAL_INSTRUCTION, tf_instruction)
-    return [{"role": "user", "content": _text_and_image_blocks(tf_text, img_b64)}]
+    return [{"role": "user", "content": _text_and_image_blocks(tf_text, img_url)}]
 
 
 def decode_prompt_logprob_entry(entry: dict) -> tuple[str, float, dict]:
@@ -18,9 +18,15 @@ from dotenv import load_dotenv
 from android_world import registry
 from android_world.env import env_launcher
 from agent.aw_adapter import AWAgentAdapter
-from agent.model import GeminiModel, VLLMModel
+from agent.model import IMAGE_CACHE, GeminiModel, VLLMModel
+from agent.response_cache import CacheMiss, CachedModel
+from agent.server_metrics import summarize_windows
+from agent import trace
+from agent.live_metrics import LiveMetrics
 
-def check_with_oracle(oracle_model, goal: str, image_path: str) -> bool:
+@trace.traced("oracle_check")
+def check_with_oracle(oracle_model, goal: str, image_path) -> bool:
+    """`image_path` may be a file path or an in-memory image (see agent.model.ImageInput)."""
     prompt = (
         f"Task Goal: {goal}\n\n"
         "Look at the provided Android screenshot. Has this goal been successfully achieved? "
@@ -32,11 +38,31 @@ def check_with_oracle(oracle_model, goal: str, image_path: str) -> bool:
         text = response_text.strip()
         print(f"  [Oracle check] '{text}'")
         return text.lower().strip().endswith("yes")
+    except CacheMiss:
+        raise
     except Exception as e:
         print(f"  [Oracle check Error] {e}")
         return False
 
 
+def _pass2_ttft_split(step_records: list[dict]) -> dict:
+    """Average dynamic-LoRA pass-2 TTFT separately for prewarmed and cold steps."""
+    out = {}
+    for label, flag in (("prewarmed", True), ("cold", False)):
+        vals = [r["latency"]["pass2_ttft_s"] for r in step_records
+                if "pass2_ttft_s" in r["latency"] and r["latency"].get("pass2_prewarmed") == flag]
+        if vals:
+            out[f"pass2_ttft_{label}_s"] = round(sum(vals) / len(vals), 4)
+    return out
+
+
+def _prefix_hit_rate(step_records: list[dict]) -> float:
+    """Share of prompt tokens served from the server's prefix cache over `step_records`."""
+    prompt = sum(r["latency"].get("prompt_tokens", 0) for r in step_records)
+    cached = sum(r["latency"].get("cached_tokens", 0) for r in step_records)
+    return round(cached / prompt, 4) if prompt else 0.0
+
+
 def main():
     parser = argparse.ArgumentParser(description="Run AndroidWorld benchmark")
     parser.add_argument(
@@ -92,6 +118,11 @@ def main():
         help="Prompt verbosity: 'full' (default), 'compact' (shorter), 'minimal' (action-only), "
              "'orion' (Observation+Action+Summary, no Thought).",
     )
+    parser.add_argument(
+        "--prompt_layout", type=str, default=None, choices=["default", "prefix"],
+        help="'prefix' orders prompts static -> dynamic (system prompt, task, history, screen, image) "
+             "for vLLM prefix-cache hits (overrides PROMPT_LAYOUT in config.yaml).",
+    )
     parser.add_argument(
         "--thinking_budget", type=int, default=None,
         help="Max thinking tokens (Gemini ThinkingConfig / vLLM thinking_token_budget). 0 disables thinking.",
@@ -117,8 +148,8 @@ def main():
         help="Number of consecutive stalled steps before nudging/terminating (overrides MAX_STALL_STEPS in config.yaml).",
     )
     parser.add_argument(
-        "--stall_action", type=str, default=None, choices=["nudge", "terminate", "escalate"],
-        help="Action on screen stall: 'escalate' = ramp temp + thinking, 'nudge' = text warning, 'terminate' = kill run (overrides STALL_ACTION in config.yaml).",
+        "--stall_action", type=str, default=None, choices=["nudge", "terminate", "escalate", "nbest"],
+        help="Action on screen stall: 'escalate' = ramp temp + thinking, 'nbest' = rank STALL_NBEST_N samples from one request, 'nudge' = text warning, 'terminate' = kill run (overrides STALL_ACTION in config.yaml).",
     )
     parser.add_argument(
         "--stall_threshold", type=float, default=None,
@@ -128,6 +159,27 @@ def main():
         "--success_if_env_done", action="store_true",
         help="Count a task as success when AndroidWorld reports is_successful, even if the agent never output FINISH (default: success requires FINISH / agent_done).",
     )
+    parser.add_argument(
+        "--response_cache", type=str, default=None,
+        help="SQLite file for recorded model responses (overrides RESPONSE_CACHE in config.yaml).",
+    )
+    parser.add_argument(
+        "--cache_mode", type=str, default=None, choices=["record", "replay", "replay_fallthrough"],
+        help="'record' = call the model and store, 'replay' = serve recorded responses only (a miss aborts), "
+             "'replay_fallthrough' = replay, calling the model on a miss (overrides RESPONSE_CACHE_MODE in config.yaml).",
+    )
+    parser.add_argument(
+        "--metrics_port", type=int, default=None,
+        help="Serve live Prometheus metrics (progress, step latency, tokens, failures) on this port during the run.",
+    )
+    parser.add_argument(
+        "--trace", action="store_true",
+        help="Write a Chrome trace-event timeline (trace.json, open in Perfetto) per task.",
+    )
+    parser.add_argument(
+        "--server_metrics", action="store_true",
+        help="Scrape the vLLM server's /metrics and record queueing/prefix-cache/KV windows per step (sets SERVER_METRICS).",
+    )
     args = parser.parse_args()
 
     load_dotenv()
@@ -138,6 +190,8 @@ def main():
     config["THINKING_MODE"] = args.thinking_mode
     config["LORA_AS_TOOL"] = args.lora_as_tool
     config["PROMPT_STYLE"] = args.prompt_style
+    if args.prompt_layout is not None:
+        config["PROMPT_LAYOUT"] = args.prompt_layout
     if args.thinking_budget is not None:
         config["THINKING_BUDGET"] = args.thinking_budget
     if args.max_tokens is not None:
@@ -151,6 +205,12 @@ def main():
         config["STALL_ACTION"] = args.stall_action
     if args.stall_threshold is not None:
         config["SCREEN_CHANGE_THRESHOLD"] = args.stall_threshold
+    if args.response_cache is not None:
+        config["RESPONSE_CACHE"] = args.response_cache
+    if args.cache_mode is not None:
+        config["RESPONSE_CACHE_MODE"] = args.cache_mode
+    if args.server_metrics:
+        config["SERVER_METRICS"] = True
 
     adb_path = os.path.expanduser(os.environ.get("ADB_PATH", "") or "adb")
     config["ADB_PATH"] = adb_path
@@ -176,6 +236,8 @@ def main():
             )
     else:
         oracle_model = None
+    if oracle_model is not None and config.get("RESPONSE_CACHE"):
+        oracle_model = CachedModel(oracle_model, config["RESPONSE_CACHE"], config.get("RESPONSE_CACHE_MODE", "record"))
 
     task_registry = registry.TaskRegistry()
     aw_registry = task_registry.get_registry(task_registry.ANDROID_WORLD_FAMILY)
@@ -196,6 +258,11 @@ def main():
     session_dir = os.path.join(args.output_dir, run_id)
     os.makedirs(session_dir, exist_ok=True)
     results = []
+    # One adapter for the whole run: the model client (keep-alive connections) and the
+    # prompts are built once; each episode only calls reset_episode().
+    adapter: AWAgentAdapter | None = None
+    live = LiveMetrics(args.metrics_port) if args.metrics_port else None
+    n_episodes = len(task_names) * args.n_task_combinations
     print(f"\n{'=' * 60}")
     print(f"AndroidWorld Benchmark: {len(task_names)} tasks x {args.n_task_combinations} combos")
     print(f"Backend: {args.backend}  |  Output directory: {session_dir}")
@@ -224,6 +291,9 @@ def main():
                     break
                 except RuntimeError as e:
                     print(f"[{task_name}] env.reset failed (attempt {_reset_attempt+1}/3): {e}")
+                    if live:
+                        live.inc("aw_bench_env_reset_retries_total")
+                        live.inc("aw_bench_adb_reconnects_total")
                     try:
                         env.controller.refresh_env()
                     except Exception:
@@ -233,6 +303,8 @@ def main():
             else:
                 print(f"[{task_name}] SKIPPED — could not reset env after 3 attempts")
                 results.append({"task": task_name, "combo": combo_idx, "goal": "", "success": False, "steps": 0, "time_s": 0, "latency_avg": {}, "token_totals": {}})
+                if live:
+                    live.task_finished("skipped", sum(r["success"] for r in results), len(results), n_episodes - len(results))
                 continue
 
             if task is not None:
@@ -241,6 +313,8 @@ def main():
                 except Exception as e:
                     print(f"[{task_name}] SKIPPED — initialize_task failed: {e}")
                     results.append({"task": task_name, "combo": combo_idx, "goal": "", "success": False, "steps": 0, "time_s": 0, "latency_avg": {}, "token_totals": {}})
+                    if live:
+                        live.task_finished("skipped", sum(r["success"] for r in results), len(results), n_episodes - len(results))
                     continue
 
             print(f"[{task_name}] (combo {combo_idx + 1}/{args.n_task_combinations})")
@@ -263,9 +337,12 @@ def main():
                     time.sleep(1.0)
                 continue
 
-            adapter = AWAgentAdapter(env=env, config=config, output_dir=task_dir, transition_pause=1.0)
+            if adapter is None:
+                adapter = AWAgentAdapter(env=env, config=config, output_dir=task_dir, transition_pause=1.0)
             adapter.set_max_steps(max_steps)
-            adapter.reset_episode()
+            adapter.reset_episode(output_dir=task_dir)
+            if args.trace:
+                trace.begin(os.path.join(task_dir, "trace.json"))
 
             # run agent loop
             t_start = time.perf_counter()
@@ -277,8 +354,12 @@ def main():
                     if args.oracle_mode == "every_step" and oracle_model is not None:
                         kwargs = {"oracle_model": oracle_model, "oracle_fn": check_with_oracle}
                     response = adapter.step(goal, **kwargs)
+                except CacheMiss:
+                    raise  # strict replay: the rerun has diverged from the recording
                 except Exception as e:
                     print(f"[step {step_idx+1}] STEP CRASHED: {e}")
+                    if live:
+                        live.inc("aw_bench_step_crashes_total")
                     try:
                         env.controller.refresh_env()
                     except Exception:
@@ -287,6 +368,8 @@ def main():
                     continue
                 if response.data and "latency" in response.data:
                     step_records.append(response.data)
+                    if live:
+                        live.step(task_name, response.data)
                 if response.data and response.data.get("stall_terminated"):
                     print(f"  \033[33m[screen-stall] Run terminated: screen unchanged for "
                           f"{response.data.get('stall_count', '?')} consecutive steps\033[0m")
@@ -294,7 +377,9 @@ def main():
                 if response.done:
                     if args.oracle_mode == "intercept" and oracle_model is not None:
                         print(f"  model said FINISH. Checking with Oracle...")
-                        oracle_is_done = check_with_oracle(oracle_model, goal, response.data["image_path"])
+                        adapter.flush_artifacts()
+                        oracle_image = response.data.get("image_path") or adapter.last_observation
+                        oracle_is_done = check_with_oracle(oracle_model, goal, oracle_image)
                         if oracle_is_done:
                             agent_done = True
                             print("  \033[32mOracle confirmed task complete.\033[0m")
@@ -311,15 +396,19 @@ def main():
                         print("model said FINISH")
                         break
             t_elapsed = time.perf_counter() - t_start
+            trace.complete("task", t_start, t_start + t_elapsed, task=task_name, combo=combo_idx)
             # success = env confirms AND agent explicitly terminated
             task_successful = False
             if task is not None:
                 for is_success_attempt in range(3):
                     try:
-                        task_successful = task.is_successful(env) == 1.0
+                        with trace.span("is_successful", "env"):
+                            task_successful = task.is_successful(env) == 1.0
                         break
                     except Exception as e:
                         print(f"Error during is_successful check (attempt {is_success_attempt + 1}/3): {e}")
+                        if live:
+                            live.inc("aw_bench_adb_reconnects_total")
                         subprocess.run(["adb", "reconnect"], capture_output=True)
                         time.sleep(3)
             else:
@@ -385,6 +474,8 @@ def main():
                 "time_s": round(t_elapsed, 2),
                 "stall_terminated": stall_terminated,
                 "max_stall_count": max_stall_in_run,
+                "prompt_style": args.prompt_style,
+                "prompt_layout": config.get("PROMPT_LAYOUT", "default"),
                 "latency_avg": {
                     "screenshot_s":  round(sum(r["latency"]["screenshot_s"]  for r in step_records) / len(step_records), 3),
                     "preprocess_s":  round(sum(r["latency"]["preprocess_s"]  for r in step_records) / len(step_records), 3),
@@ -395,17 +486,33 @@ def main():
                     "ttft_s":        round(sum(r["latency"].get("ttft_s", 0)  for r in step_records) / len(step_records), 4),
                     "decode_s":      round(sum(r["latency"].get("decode_s", 0) for r in step_records) / len(step_records), 4),
                     "tpot_ms":       round(sum(r["latency"].get("tpot_ms", 0) for r in step_records) / len(step_records), 2),
+                    "prefix_hit_rate": _prefix_hit_rate(step_records),
+                    **_pass2_ttft_split(step_records),
                 } if step_records else {},
                 "token_totals": {
                     "prompt_tokens":     sum(r["latency"].get("prompt_tokens", 0)     for r in step_records),
                     "completion_tokens": sum(r["latency"].get("completion_tokens", 0) for r in step_records),
                     "total_tokens":      sum(r["latency"].get("total_tokens", 0)      for r in step_records),
+                    "cached_tokens":     sum(r["latency"].get("cached_tokens", 0)     for r in step_records),
                 } if step_records else {},
+                "server": summarize_windows([r["latency"].get("server") for r in step_records]),
             })
+            if results[-1]["server"]:
+                srv = results[-1]["server"]
+                print(f"   server: queue {srv['queue_time_s'] * 1000:.1f}ms avg / {srv['queue_time_max_s'] * 1000:.1f}ms max  "
+                      f"ttft {srv['server_ttft_s']:.3f}s  prefix hit {srv['prefix_hit_rate'] * 100:.1f}%  "
+                      f"waiting max {srv['waiting_max']}  kv max {srv['kv_usage_max'] * 100:.1f}%  "
+                      f"preemptions {srv['preemptions']}")
+
+            if args.trace:
+                adapter.flush_artifacts()  # the last step's PNG write belongs on this timeline
+                print(f"Trace written to: {trace.end()}")
 
             # ── Running accuracy table ────────────────────────────────
             n_done = len(results)
             n_success_so_far = sum(1 for r in results if r["success"])
+            if live:
+                live.task_finished("success" if success else "failure", n_success_so_far, n_done, n_episodes - n_done)
             acc_so_far = n_success_so_far / n_done * 100
             print(f"\n{'─' * 60}")
             print(f"  RUNNING ACCURACY: {n_success_so_far}/{n_done} = {acc_so_far:.1f}%  "
@@ -422,6 +529,11 @@ def main():
             except Exception:
                 pass
 
+    if adapter is not None:
+        adapter.close()
+    if live:
+        live.close()
+
     n_success = sum(1 for r in results if r["success"])
     n_total = len(results)
     accuracy = (n_success / n_total * 100) if n_total else 0
@@ -435,6 +547,13 @@ def main():
     if n_success > 0:
         avg_steps = sum(r["steps"] for r in results if r["success"]) / n_success
         print(f"Avg steps (success): {avg_steps:.1f}")
+    cache_stats = IMAGE_CACHE.stats()
+    print(f"Image cache: {cache_stats['hits']} hits / {cache_stats['misses']} misses")
+    prompt_total = sum(r.get("token_totals", {}).get("prompt_tokens", 0) for r in results)
+    cached_total = sum(r.get("token_totals", {}).get("cached_tokens", 0) for r in results)
+    if prompt_total:
+        print(f"Prefix cache: {cached_total}/{prompt_total} prompt tokens cached "
+              f"({cached_total / prompt_total * 100:.1f}%, layout={config.get('PROMPT_LAYOUT', 'default')})")
     print(f"{'=' * 60}")
 
     results_path = os.path.join(session_dir, "results.json")
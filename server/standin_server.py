@@ -0,0 +1,510 @@
+#!/usr/bin/env python3
+"""
+CPU-only stand-in for the vLLM OpenAI server (stdlib only).
+
+Implements the /v1/chat/completions subset used by VLLMModel, DynamicLoRAVLLMModel
+and kl_check.py: streaming (SSE) and non-streaming, `n`, `stop`, `max_tokens`,
+`continue_final_message`, `stream_options.include_usage` / `continuous_usage_stats`,
+`logprobs` / `top_logprobs` and `prompt_logprobs`. Responses come from a scripted
+(or recorded) JSONL file, and are paced by a TTFT/TPOT latency model with a
+simulated block-level prefix cache, so agent-side overhead can be measured and
+load-tested without a GPU.
+
+Usage:
+  python server/standin_server.py --port 8000 --script server/standin_script.jsonl \\
+      --ttft-ms 40 --prefill-ms-per-1k 60 --tpot-ms 12 --tpot-jitter-ms 2
+
+Script file: one JSON object per line, first match wins.
+  {"model": "action_lora", "match": "<regex on the rendered prompt>", "response": "Action: tap(3)\\n..."}
+  {"model": "Qwen/Qwen3-VL-8B-Instruct", "responses": ["...", "..."]}   # served in order, cycled
+Both "model" and "match" are optional. Unmatched requests get --default-response.
+
+Endpoints: POST /v1/chat/completions, GET /v1/models, GET /health, GET /metrics
+(vLLM metric names: vllm:prefix_cache_queries_total, vllm:request_queue_time_seconds,
+vllm:kv_cache_usage_perc, ...).
+"""
+
+import argparse, hashlib, json, os, random, re, threading, time, zlib
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+DEFAULT_RESPONSE = (
+    "Observation: The current screen is shown.\n"
+    "Thought: Wait for the screen to settle before acting.\n"
+    "Action: wait(1)\n"
+    "Summary: I waited for the screen to update."
+)
+
+# ChatML-ish special tokens are single tokens; words keep their leading space
+_TOKEN_RE = re.compile(r"<\|\w+\|>| ?\w+| ?[^\w\s]|\s+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Approximate tokenizer: the pieces always concatenate back to `text`."""
+    return _TOKEN_RE.findall(text)
+
+
+def token_id(token: str) -> int:
+    return zlib.crc32(token.encode()) % 151_000
+
+
+# ── Prompt rendering ──────────────────────────────────────────────────
+
+def _image_digest(url: str) -> str:
+    """Content hash of an image_url: data URLs hash their payload, file:// URLs the file."""
+    if url.startswith("file://"):
+        try:
+            with open(unquote(urlparse(url).path), "rb") as f:
+                return hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+        except OSError:
+            pass
+    return hashlib.blake2b(url.encode(), digest_size=8).hexdigest()
+
+
+def render_prompt(messages: list[dict], image_tokens: int, continue_final: bool, add_generation_prompt: bool) -> list[str]:
+    """Prompt tokens for a ChatML-style template; each image expands to `image_tokens` tokens."""
+    tokens: list[str] = []
+    for i, msg in enumerate(messages):
+        last = i == len(messages) - 1
+        tokens += ["<|im_start|>", msg.get("role", "user"), "\n"]
+        content = msg.get("content") or ""
+        parts = [{"type": "text", "text": content}] if isinstance(content, str) else content
+        for part in parts:
+            if part.get("type") == "image_url":
+                digest = _image_digest(part["image_url"]["url"])
+                tokens += ["<|vision_start|>"] + [f"<img:{digest}:{j}>" for j in range(image_tokens)] + ["<|vision_end|>"]
+            elif part.get("type") == "text":
+                tokens += tokenize(part.get("text", ""))
+        if last and continue_final and msg.get("role") == "assistant":
+            return tokens
+        tokens += ["<|im_end|>", "\n"]
+    if add_generation_prompt:
+        tokens += ["<|im_start|>", "assistant", "\n"]
+    return tokens
+
+
+# ── Prefix cache ──────────────────────────────────────────────────────
+
+class PrefixCache:
+    """
+    Block-level prefix cache in the style of vLLM's automatic prefix caching: full
+    blocks are chain-hashed (per model, so a LoRA has its own entries) and kept in
+    an LRU of `capacity_blocks`.
+    """
+
+    def __init__(self, block_size: int = 16, capacity_blocks: int = 20_000):
+        self.block_size = block_size
+        self.capacity_blocks = capacity_blocks
+        self._blocks: OrderedDict[int, None] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup_and_insert(self, model: str, tokens: list[str]) -> int:
+        """Return the number of cached prompt tokens, then cache every full block."""
+        hashes = []
+        h = hash(model)
+        for start in range(0, len(tokens) - self.block_size + 1, self.block_size):
+            h = hash((h, tuple(tokens[start:start + self.block_size])))
+            hashes.append(h)
+        with self._lock:
+            hit = 0
+            for h in hashes:
+                if h not in self._blocks:
+                    break
+                hit += 1
+            for h in hashes:
+                self._blocks[h] = None
+                self._blocks.move_to_end(h)
+            while len(self._blocks) > self.capacity_blocks:
+                self._blocks.popitem(last=False)
+        # like vLLM, the last prompt token is always recomputed
+        return min(hit * self.block_size, max(len(tokens) - 1, 0))
+
+    def usage(self) -> float:
+        """Fraction of the block pool holding cached prefixes (vllm:kv_cache_usage_perc)."""
+        with self._lock:
+            return len(self._blocks) / self.capacity_blocks
+
+
+# ── Metrics ───────────────────────────────────────────────────────────
+
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metrics:
+    """Prometheus text exposition of the vLLM metrics the agent tooling reads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = 0
+        self.waiting = 0
+        self.counters = {
+            "vllm:prompt_tokens_total": 0,
+            "vllm:generation_tokens_total": 0,
+            "vllm:prefix_cache_queries_total": 0,
+            "vllm:prefix_cache_hits_total": 0,
+            "vllm:request_success_total": 0,
+            "vllm:request_aborted_total": 0,
+            "vllm:num_preemptions_total": 0,  # never preempts; exported for collector parity
+        }
+        self.histograms = {
+            name: {"buckets": [0] * len(_BUCKETS), "sum": 0.0, "count": 0}
+            for name in ("vllm:time_to_first_token_seconds", "vllm:time_per_output_token_seconds",
+                         "vllm:e2e_request_latency_seconds", "vllm:request_queue_time_seconds")
+        }
+
+    def add(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            hist = self.histograms[name]
+            for i, bound in enumerate(_BUCKETS):
+                if value <= bound:
+                    hist["buckets"][i] += 1
+            hist["sum"] += value
+            hist["count"] += 1
+
+    def gauge(self, name: str, delta: int) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + delta)
+
+    def render(self, model_name: str, kv_cache_usage: float) -> str:
+        label = f'model_name="{model_name}"'
+        with self._lock:
+            lines = [
+                "# TYPE vllm:num_requests_running gauge",
+                f"vllm:num_requests_running{{{label}}} {self.running}",
+                "# TYPE vllm:num_requests_waiting gauge",
+                f"vllm:num_requests_waiting{{{label}}} {self.waiting}",
+                "# TYPE vllm:kv_cache_usage_perc gauge",
+                f"vllm:kv_cache_usage_perc{{{label}}} {kv_cache_usage:.6f}",
+            ]
+            for name, value in self.counters.items():
+                lines += [f"# TYPE {name} counter", f"{name}{{{label}}} {value}"]
+            for name, hist in self.histograms.items():
+                lines.append(f"# TYPE {name} histogram")
+                for bound, count in zip(_BUCKETS, hist["buckets"]):
+                    lines.append(f'{name}_bucket{{{label},le="{bound}"}} {count}')
+                lines += [f'{name}_bucket{{{label},le="+Inf"}} {hist["count"]}',
+                          f"{name}_sum{{{label}}} {hist['sum']}",
+                          f"{name}_count{{{label}}} {hist['count']}"]
+        return "\n".join(lines) + "\n"
+
+
+# ── Script ────────────────────────────────────────────────────────────
+
+class Script:
+    """Scripted/recorded responses: first entry whose model and regex match wins."""
+
+    def __init__(self, path: str | None, default: str):
+        self.default = default
+        self.entries: list[dict] = []
+        self._cursor: dict[int, int] = {}
+        self._lock = threading.Lock()
+        if path:
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        if "match" in entry:
+                            entry["_re"] = re.compile(entry["match"], re.DOTALL)
+                        self.entries.append(entry)
+            print(f"[standin] {len(self.entries)} scripted responses from {path}")
+
+    def responses(self, model: str, prompt_text: str, n: int) -> list[str]:
+        for i, entry in enumerate(self.entries):
+            if entry.get("model", model) != model:
+                continue
+            if "_re" in entry and not entry["_re"].search(prompt_text):
+                continue
+            if "responses" not in entry:
+                return [entry["response"]] * n
+            with self._lock:
+                start = self._cursor.get(i, 0)
+                self._cursor[i] = start + n
+            pool = entry["responses"]
+            return [pool[(start + k) % len(pool)] for k in range(n)]
+        return [self.default] * n
+
+
+# ── Server ────────────────────────────────────────────────────────────
+
+class StandIn:
+    def __init__(self, args):
+        self.args = args
+        self.script = Script(args.script, args.default_response)
+        self.cache = PrefixCache(args.block_size, args.cache_blocks)
+        self.metrics = Metrics()
+        self.slots = threading.BoundedSemaphore(args.max_num_seqs)
+        self.rng = random.Random(args.seed)
+        self._rng_lock = threading.Lock()
+
+    def _sleep(self, seconds: float) -> None:
+        if seconds > 0 and self.args.time_scale > 0:
+            time.sleep(seconds * self.args.time_scale)
+
+    def _jitter(self, mean_ms: float, std_ms: float) -> float:
+        with self._rng_lock:
+            return max(0.0, self.rng.gauss(mean_ms, std_ms)) / 1000
+
+    def ttft(self, uncached_tokens: int) -> float:
+        return (self._jitter(self.args.ttft_ms, self.args.ttft_jitter_ms)
+                + uncached_tokens * self.args.prefill_ms_per_1k / 1_000_000)
+
+    def tpot(self) -> float:
+        # decode steps slow down as more sequences share the batch
+        slowdown = 1 + self.args.batch_slowdown * max(self.metrics.running - 1, 0)
+        return self._jitter(self.args.tpot_ms, self.args.tpot_jitter_ms) * slowdown
+
+    @staticmethod
+    def logprob(token: str, position: int) -> float:
+        return -((zlib.crc32(f"{position}:{token}".encode()) % 1000) / 2000 + 0.001)
+
+    def token_logprobs(self, token: str, position: int, top: int) -> dict:
+        lp = self.logprob(token, position)
+        alts = [{"token": f"{token}#{k}", "logprob": lp - 1.5 * k, "bytes": None} for k in range(1, top)]
+        return {"token": token, "logprob": lp, "bytes": None,
+                "top_logprobs": [{"token": token, "logprob": lp, "bytes": None}] + alts}
+
+    def prompt_logprobs(self, tokens: list[str], top: int) -> list:
+        out: list = [None]
+        for pos, token in enumerate(tokens[1:], start=1):
+            lp = self.logprob(token, pos)
+            entry = {str(token_id(token)): {"logprob": lp, "rank": 1, "decoded_token": token}}
+            for k in range(1, top):
+                entry[str(token_id(f"{token}#{k}"))] = {"logprob": lp - 1.5 * k, "rank": k + 1,
+                                                        "decoded_token": f"{token}#{k}"}
+            out.append(entry)
+        return out
+
+    def plan(self, body: dict) -> dict:
+        """Everything about a request that does not depend on wall-clock time."""
+        model = body.get("model", self.args.served_model_name)
+        continue_final = bool(body.get("continue_final_message", False))
+        add_generation_prompt = body.get("add_generation_prompt", not continue_final)
+        prompt_tokens = render_prompt(body.get("messages", []), self.args.image_tokens,
+                                      continue_final, add_generation_prompt)
+        prompt_text = "".join(t for t in prompt_tokens if not t.startswith("<img:"))
+        n = int(body.get("n") or 1)
+
+        prefill = ""
+        if continue_final and body["messages"][-1].get("role") == "assistant":
+            content = body["messages"][-1].get("content") or ""
+            prefill = content if isinstance(content, str) else "".join(
+                p.get("text", "") for p in content if p.get("type") == "text")
+
+        stops = body.get("stop") or []
+        stops = [stops] if isinstance(stops, str) else stops
+        max_tokens = body.get("max_tokens") or body.get("max_completion_tokens")
+
+        choices = []
+        for text in self.script.responses(model, prompt_text, n):
+            if prefill and text.startswith(prefill):
+                text = text[len(prefill):]
+            finish = "stop"
+            cut = min((text.find(s) for s in stops if s in text), default=-1)
+            if cut >= 0:
+                text = text[:cut]
+            tokens = tokenize(text)
+            if max_tokens is not None and len(tokens) > max_tokens:
+                tokens, finish = tokens[:max_tokens], "length"
+            choices.append({"tokens": tokens, "finish_reason": finish})
+
+        cached = self.cache.lookup_and_insert(model, prompt_tokens)
+        self.metrics.add("vllm:prefix_cache_queries_total", len(prompt_tokens))
+        self.metrics.add("vllm:prefix_cache_hits_total", cached)
+        self.metrics.add("vllm:prompt_tokens_total", len(prompt_tokens))
+        return {"model": model, "prompt_tokens": prompt_tokens, "cached": cached, "choices": choices}
+
+    def usage(self, plan: dict, completion_tokens: int) -> dict:
+        usage = {"prompt_tokens": len(plan["prompt_tokens"]), "completion_tokens": completion_tokens,
+                 "total_tokens": len(plan["prompt_tokens"]) + completion_tokens}
+        if self.args.enable_prompt_tokens_details:
+            usage["prompt_tokens_details"] = {"cached_tokens": plan["cached"]}
+        return usage
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    standin: StandIn = None  # set in main()
+
+    def log_message(self, fmt, *args):
+        if self.standin.args.verbose:
+            super().log_message(fmt, *args)
+
+    def _send(self, status: int, payload, content_type: str = "application/json") -> None:
+        data = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            self._send(200, "", "text/plain")
+        elif path == "/metrics":
+            self._send(200, self.standin.metrics.render(self.standin.args.served_model_name,
+                                                        self.standin.cache.usage()),
+                       "text/plain; version=0.0.4")
+        elif path == "/v1/models":
+            names = [self.standin.args.served_model_name] + [lora.split("=")[0] for lora in self.standin.args.lora]
+            self._send(200, {"object": "list", "data": [
+                {"id": name, "object": "model", "owned_by": "standin"} for name in names]})
+        else:
+            self._send(404, {"error": {"message": f"unknown path {path}"}})
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/v1/chat/completions":
+            self._send(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except (ValueError, json.JSONDecodeError) as e:
+            self._send(400, {"error": {"message": f"bad request body: {e}"}})
+            return
+
+        standin = self.standin
+        t_start = time.perf_counter()
+        standin.metrics.gauge("waiting", 1)
+        with standin.slots:
+            standin.metrics.gauge("waiting", -1)
+            standin.metrics.observe("vllm:request_queue_time_seconds", time.perf_counter() - t_start)
+            standin.metrics.gauge("running", 1)
+            try:
+                plan = standin.plan(body)
+                if body.get("stream"):
+                    self._stream(body, plan, t_start)
+                else:
+                    self._complete(body, plan, t_start)
+            except (BrokenPipeError, ConnectionResetError):
+                standin.metrics.add("vllm:request_aborted_total")  # client closed the stream early
+                self.close_connection = True
+            finally:
+                standin.metrics.gauge("running", -1)
+
+    def _header(self, plan: dict) -> dict:
+        return {"id": f"chatcmpl-{os.urandom(8).hex()}", "created": int(time.time()), "model": plan["model"]}
+
+    def _finish_metrics(self, t_start: float, t_first: float, n_tokens: int) -> None:
+        metrics = self.standin.metrics
+        t_end = time.perf_counter()
+        metrics.observe("vllm:time_to_first_token_seconds", t_first - t_start)
+        if n_tokens > 1:
+            metrics.observe("vllm:time_per_output_token_seconds", (t_end - t_first) / (n_tokens - 1))
+        metrics.observe("vllm:e2e_request_latency_seconds", t_end - t_start)
+        metrics.add("vllm:generation_tokens_total", n_tokens)
+        metrics.add("vllm:request_success_total")
+
+    def _complete(self, body: dict, plan: dict, t_start: float) -> None:
+        standin = self.standin
+        top = int(body.get("top_logprobs") or 1)
+        standin._sleep(standin.ttft(len(plan["prompt_tokens"]) - plan["cached"]))
+        t_first = time.perf_counter()
+        steps = max((len(c["tokens"]) for c in plan["choices"]), default=0)
+        for _ in range(max(steps - 1, 0)):
+            standin._sleep(standin.tpot())
+
+        choices = []
+        for index, choice in enumerate(plan["choices"]):
+            logprobs = None
+            if body.get("logprobs"):
+                logprobs = {"content": [standin.token_logprobs(t, pos, top) for pos, t in enumerate(choice["tokens"])]}
+            choices.append({"index": index, "message": {"role": "assistant", "content": "".join(choice["tokens"])},
+                            "logprobs": logprobs, "finish_reason": choice["finish_reason"]})
+        n_tokens = sum(len(c["tokens"]) for c in plan["choices"])
+        payload = {**self._header(plan), "object": "chat.completion", "choices": choices,
+                   "usage": standin.usage(plan, n_tokens)}
+        if body.get("prompt_logprobs") is not None:
+            payload["prompt_logprobs"] = standin.prompt_logprobs(plan["prompt_tokens"], int(body["prompt_logprobs"]) or 1)
+        self._send(200, payload)
+        self._finish_metrics(t_start, t_first, n_tokens)
+
+    def _chunk(self, payload) -> None:
+        data = f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n".encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream(self, body: dict, plan: dict, t_start: float) -> None:
+        standin = self.standin
+        options = body.get("stream_options") or {}
+        include_usage = options.get("include_usage", False)
+        continuous = include_usage and options.get("continuous_usage_stats", False)
+        top = int(body.get("top_logprobs") or 1)
+        header = {**self._header(plan), "object": "chat.completion.chunk"}
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        standin._sleep(standin.ttft(len(plan["prompt_tokens"]) - plan["cached"]))
+        t_first = time.perf_counter()
+        generated = 0
+        steps = max((len(c["tokens"]) for c in plan["choices"]), default=0)
+        for step in range(steps):
+            if step:
+                standin._sleep(standin.tpot())
+            # one decode step emits the next token of every unfinished choice
+            for index, choice in enumerate(plan["choices"]):
+                if step >= len(choice["tokens"]):
+                    continue
+                token = choice["tokens"][step]
+                generated += 1
+                done = step == len(choice["tokens"]) - 1
+                delta = {"content": token, **({"role": "assistant"} if step == 0 else {})}
+                logprobs = {"content": [standin.token_logprobs(token, step, top)]} if body.get("logprobs") else None
+                self._chunk({**header, "choices": [{"index": index, "delta": delta, "logprobs": logprobs,
+                                                    "finish_reason": choice["finish_reason"] if done else None}],
+                             "usage": standin.usage(plan, generated) if continuous else None})
+        if include_usage:
+            self._chunk({**header, "choices": [], "usage": standin.usage(plan, generated)})
+        self._chunk("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+        self._finish_metrics(t_start, t_first, generated)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU-only OpenAI-compatible stand-in for the vLLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--served-model-name", default="Qwen/Qwen3-VL-8B-Instruct")
+    parser.add_argument("--lora", action="append", default=[], help="name=path, listed in /v1/models (any name is served)")
+    parser.add_argument("--script", default=None, help="JSONL of scripted/recorded responses")
+    parser.add_argument("--default-response", default=DEFAULT_RESPONSE)
+    # latency model
+    parser.add_argument("--ttft-ms", type=float, default=40.0, help="fixed TTFT component (scheduling + ViT)")
+    parser.add_argument("--ttft-jitter-ms", type=float, default=5.0)
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=60.0, help="prefill cost per 1k uncached prompt tokens")
+    parser.add_argument("--tpot-ms", type=float, default=12.0)
+    parser.add_argument("--tpot-jitter-ms", type=float, default=2.0)
+    parser.add_argument("--batch-slowdown", type=float, default=0.05, help="TPOT growth per extra running request")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="multiply every simulated delay (0 = no sleeping)")
+    parser.add_argument("--max-num-seqs", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    # prompt model
+    parser.add_argument("--image-tokens", type=int, default=1200, help="prompt tokens per image")
+    parser.add_argument("--block-size", type=int, default=16)
+    parser.add_argument("--cache-blocks", type=int, default=20_000)
+    parser.add_argument("--enable-prompt-tokens-details", action="store_true",
+                        help="report usage.prompt_tokens_details.cached_tokens, like vLLM's flag")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    Handler.standin = StandIn(args)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f"[standin] serving {args.served_model_name} on http://{args.host}:{args.port}/v1  "
+          f"(ttft={args.ttft_ms}ms  tpot={args.tpot_ms}ms  time_scale={args.time_scale})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,8 @@
 # Usage:
 #   ./start_server.sh                                  # base only
 #   ./start_server.sh --lora action_lora=/path/to/adapter   # base + named LoRA
+#   ./start_server.sh --media-dir /tmp/agent_media     # dir the agent writes file:// frames to
+#                                                      # (IMAGE_URL_MODE: "file" in config.yaml)
 # ──────────────────────────────────────────────────────────────────────
 set -euo pipefail
 
@@ -19,6 +21,7 @@ GPU=0
 PORT=8000
 MODEL="Qwen/Qwen3-VL-8B-Instruct"
 KEY_FILE="${KEY_FILE:-$HOME/.config/vllm/api.key}"
+MEDIA_DIR="${MEDIA_DIR:-/tmp/agent_media}"   # must match IMAGE_MEDIA_DIR in config.yaml
 
 # Optional LoRA adapter(s). Repeat --lora to register more than one.
 # Each value is `name=path`, e.g. `action_lora=/homes/orionf/LlamaFactory/saves/qwen3-vl-8b/lora/aitw_reasoning_tf_100`.
@@ -34,6 +37,7 @@ while [[ $# -gt 0 ]]; do
     --lora)           LORA_MODULES+=("$2");shift 2 ;;
     --max-lora-rank)  MAX_LORA_RANK="$2";  shift 2 ;;
     --max-loras)      MAX_LORAS="$2";      shift 2 ;;
+    --media-dir)      MEDIA_DIR="$2";      shift 2 ;;
     *) echo "Unknown option: $1"; exit 1 ;;
   esac
 done
@@ -51,6 +55,11 @@ fi
 
 export VLLM_API_KEY="$(cat "$KEY_FILE")"
 
+# Agent on the same host may send screenshots as file:// URLs under MEDIA_DIR
+# instead of base64 data URLs.
+mkdir -p "$MEDIA_DIR"
+echo "  local media path: $MEDIA_DIR"
+
 LORA_ARGS=()
 if (( ${#LORA_MODULES[@]} > 0 )); then
   LORA_ARGS+=(--enable-lora)
@@ -65,5 +74,7 @@ CUDA_VISIBLE_DEVICES="$GPU" vllm serve "$MODEL" \
     --dtype bfloat16 \
     --max-model-len 31972 \
     --enable-prefix-caching \
+    --enable-prompt-tokens-details \
     --max_num_seqs 32 \
+    --allowed-local-media-path "$MEDIA_DIR" \
     "${LORA_ARGS[@]}"
\ No newline at end of file